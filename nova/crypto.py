@@ -345,6 +345,25 @@ def _build_cipher(key, iv, encode=True):
     return M2Crypto.EVP.Cipher(alg='aes_128_cbc', key=key, iv=iv, op=operation)
 
 
+def decrypt_chunks(chunks, key, iv):
+    """Decrypt an iterable of 128bit AES CBC encrypted chunks.
+
+    key and iv are raw binary strings. Plaintext is yielded as soon as the
+    cipher produces it, so arbitrarily large payloads can be decrypted
+    without holding them in memory.
+
+    """
+    cipher = _build_cipher(key, iv, encode=False)
+    for chunk in chunks:
+        data = cipher.update(chunk)
+        if data:
+            yield data
+    data = cipher.final()
+    del cipher
+    if data:
+        yield data
+
+
 def encryptor(key, iv=None):
     """Simple symmetric key encryption."""
     key = base64.b64decode(key)
@@ -19,10 +19,10 @@
 """Proxy AMI-related calls from cloud controller to objectstore service."""
 
 import binascii
+import collections
+import itertools
 import os
-import shutil
 import tarfile
-import tempfile
 from xml.etree import ElementTree
 
 import boto.s3.connection
@@ -40,8 +40,10 @@ from nova.api.ec2 import ec2utils
 
 LOG = logging.getLogger("nova.image.s3")
 FLAGS = flags.FLAGS
-flags.DEFINE_string('image_decryption_dir', '/tmp',
-                    'parent dir for tempdir used for image decryption')
+flags.DEFINE_integer('s3_image_download_workers', 4,
+                     'number of image bundle parts downloaded in parallel')
+flags.DEFINE_integer('s3_image_chunk_size', 65536,
+                     'chunk size used when streaming bundles into glance')
 flags.DEFINE_string('s3_access_key', 'notchecked',
                     'access key to use for s3 server for images')
 flags.DEFINE_string('s3_secret_key', 'notchecked',
@@ -97,13 +99,6 @@ class S3ImageService(service.BaseImageService):
                                                port=FLAGS.s3_port,
                                                host=FLAGS.s3_host)
 
-    @staticmethod
-    def _download_file(bucket, filename, local_dir):
-        key = bucket.get_key(filename)
-        local_filename = os.path.join(local_dir, os.path.basename(filename))
-        key.get_contents_to_filename(local_filename)
-        return local_filename
-
     def _s3_parse_manifest(self, context, metadata, manifest):
         manifest = ElementTree.fromstring(manifest)
         image_format = 'ami'
@@ -179,8 +174,6 @@ class S3ImageService(service.BaseImageService):
     def _s3_create(self, context, metadata):
         """Gets a manifext from s3 and makes an image."""
 
-        image_path = tempfile.mkdtemp(dir=FLAGS.image_decryption_dir)
-
         image_location = metadata['properties']['image_location']
         bucket_name = image_location.split('/')[0]
         manifest_path = image_location[len(bucket_name) + 1:]
@@ -191,145 +184,220 @@ class S3ImageService(service.BaseImageService):
         manifest, image = self._s3_parse_manifest(context, metadata, manifest)
         image_id = image['id']
 
-        def delayed_create():
-            """This handles the fetching and decrypting of the part files."""
-            log_vars = {'image_location': image_location,
-                        'image_path': image_path}
-            metadata['properties']['image_state'] = 'downloading'
-            self.service.update(context, image_id, metadata)
+        def set_state(state):
+            if metadata['properties'].get('image_state') != state:
+                metadata['properties']['image_state'] = state
+                self.service.update(context, image_id, metadata)
 
-            try:
-                parts = []
-                elements = manifest.find('image').getiterator('filename')
-                for fn_element in elements:
-                    part = self._download_file(bucket,
-                                               fn_element.text,
-                                               image_path)
-                    parts.append(part)
-
-                # NOTE(vish): this may be suboptimal, should we use cat?
-                enc_filename = os.path.join(image_path, 'image.encrypted')
-                with open(enc_filename, 'w') as combined:
-                    for filename in parts:
-                        with open(filename) as part:
-                            shutil.copyfileobj(part, combined)
+        def delayed_create():
+            """This streams the part files through decryption into glance.
 
-            except Exception:
-                LOG.exception(_("Failed to download %(image_location)s "
-                                "to %(image_path)s"), log_vars)
-                metadata['properties']['image_state'] = 'failed_download'
-                self.service.update(context, image_id, metadata)
-                return
+            Parts are downloaded in parallel, decrypted, gunzipped and
+            untarred on the fly and the resulting image is uploaded
+            directly from the stream, so nothing is written to local disk.
+            image_state follows the pipeline as each stage starts producing
+            data and names the stage that failed on error.
 
-            metadata['properties']['image_state'] = 'decrypting'
-            self.service.update(context, image_id, metadata)
+            """
+            log_vars = {'image_location': image_location}
+            set_state('downloading')
 
             try:
-                hex_key = manifest.find('image/ec2_encrypted_key').text
-                encrypted_key = binascii.a2b_hex(hex_key)
-                hex_iv = manifest.find('image/ec2_encrypted_iv').text
-                encrypted_iv = binascii.a2b_hex(hex_iv)
+                filenames = [fn_element.text for fn_element in
+                             manifest.find('image').getiterator('filename')]
+                chunks = _stage('downloading', set_state,
+                                self._fetch_parts(bucket, filenames))
 
                 # FIXME(vish): grab key from common service so this can run on
                 #              any host.
                 cloud_pk = crypto.key_path(context.project_id)
-
-                dec_filename = os.path.join(image_path, 'image.tar.gz')
-                self._decrypt_image(enc_filename, encrypted_key,
-                                    encrypted_iv, cloud_pk,
-                                    dec_filename)
-            except Exception:
-                LOG.exception(_("Failed to decrypt %(image_location)s "
-                                "to %(image_path)s"), log_vars)
-                metadata['properties']['image_state'] = 'failed_decrypt'
-                self.service.update(context, image_id, metadata)
+                chunks = _stage('decrypting', set_state,
+                                self._decrypt_chunks(chunks, manifest,
+                                                     cloud_pk))
+
+                chunks = _stage('untarring', set_state,
+                                self._untar_chunks(chunks))
+
+                # NOTE: pulling the first chunk runs every stage once, so the
+                #       states are reported in order and early failures are
+                #       caught before an upload is started.
+                first = list(itertools.islice(chunks, 1))
+
+                set_state('uploading')
+                self.service.update(context, image_id, metadata,
+                                    _ChunkReader(itertools.chain(first,
+                                                                 chunks)))
+            except _StageError as e:
+                LOG.error(_("Failed %(stage)s %(image_location)s"),
+                          dict(log_vars, stage=e.stage))
+                set_state('failed_%s' % _FAILED_STATES[e.stage])
                 return
-
-            metadata['properties']['image_state'] = 'untarring'
-            self.service.update(context, image_id, metadata)
-
-            try:
-                unz_filename = self._untarzip_image(image_path, dec_filename)
             except Exception:
-                LOG.exception(_("Failed to untar %(image_location)s "
-                                "to %(image_path)s"), log_vars)
-                metadata['properties']['image_state'] = 'failed_untar'
-                self.service.update(context, image_id, metadata)
-                return
-
-            metadata['properties']['image_state'] = 'uploading'
-            self.service.update(context, image_id, metadata)
-            try:
-                with open(unz_filename) as image_file:
-                    self.service.update(context, image_id,
-                                        metadata, image_file)
-            except Exception:
-                LOG.exception(_("Failed to upload %(image_location)s "
-                                "to %(image_path)s"), log_vars)
-                metadata['properties']['image_state'] = 'failed_upload'
-                self.service.update(context, image_id, metadata)
+                LOG.exception(_("Failed to upload %(image_location)s"),
+                              log_vars)
+                set_state('failed_upload')
                 return
 
             metadata['properties']['image_state'] = 'available'
             metadata['status'] = 'active'
             self.service.update(context, image_id, metadata)
 
-            shutil.rmtree(image_path)
-
         eventlet.spawn_n(delayed_create)
 
         return image
 
     @staticmethod
-    def _decrypt_image(encrypted_filename, encrypted_key, encrypted_iv,
-                       cloud_private_key, decrypted_filename):
-        key, err = utils.execute('openssl',
+    def _download_part(bucket, filename):
+        return bucket.get_key(filename).get_contents_as_string()
+
+    def _fetch_parts(self, bucket, filenames):
+        """Yield the contents of filenames, in order, downloading ahead.
+
+        Up to FLAGS.s3_image_download_workers parts are fetched
+        concurrently; at most that many parts are held in memory.
+
+        """
+        workers = max(1, FLAGS.s3_image_download_workers)
+        filenames = iter(filenames)
+        pending = collections.deque()
+        try:
+            for filename in itertools.islice(filenames, workers):
+                pending.append(eventlet.spawn(self._download_part,
+                                              bucket, filename))
+            while pending:
+                data = pending.popleft().wait()
+                for filename in itertools.islice(filenames, 1):
+                    pending.append(eventlet.spawn(self._download_part,
+                                                  bucket, filename))
+                yield data
+        finally:
+            for thread in pending:
+                thread.kill()
+
+    @staticmethod
+    def _decrypt_key(encrypted, cloud_private_key):
+        out, err = utils.execute('openssl',
                                  'rsautl',
                                  '-decrypt',
                                  '-inkey', '%s' % cloud_private_key,
-                                 process_input=encrypted_key,
+                                 process_input=encrypted,
                                  check_exit_code=False)
+        return out, err
+
+    @staticmethod
+    def _decrypt_chunks(chunks, manifest, cloud_private_key):
+        hex_key = manifest.find('image/ec2_encrypted_key').text
+        encrypted_key = binascii.a2b_hex(hex_key)
+        hex_iv = manifest.find('image/ec2_encrypted_iv').text
+        encrypted_iv = binascii.a2b_hex(hex_iv)
+
+        key, err = S3ImageService._decrypt_key(encrypted_key,
+                                               cloud_private_key)
         if err:
             raise exception.Error(_('Failed to decrypt private key: %s')
                                   % err)
-        iv, err = utils.execute('openssl',
-                                'rsautl',
-                                '-decrypt',
-                                '-inkey', '%s' % cloud_private_key,
-                                process_input=encrypted_iv,
-                                check_exit_code=False)
+        iv, err = S3ImageService._decrypt_key(encrypted_iv,
+                                              cloud_private_key)
         if err:
             raise exception.Error(_('Failed to decrypt initialization '
                                     'vector: %s') % err)
 
-        _out, err = utils.execute('openssl', 'enc',
-                                  '-d', '-aes-128-cbc',
-                                  '-in', '%s' % (encrypted_filename,),
-                                  '-K', '%s' % (key,),
-                                  '-iv', '%s' % (iv,),
-                                  '-out', '%s' % (decrypted_filename,),
-                                  check_exit_code=False)
-        if err:
-            raise exception.Error(_('Failed to decrypt image file '
-                                    '%(image_file)s: %(err)s') %
-                                    {'image_file': encrypted_filename,
-                                     'err': err})
+        for data in crypto.decrypt_chunks(chunks,
+                                          binascii.a2b_hex(key.strip()),
+                                          binascii.a2b_hex(iv.strip())):
+            yield data
 
     @staticmethod
-    def _test_for_malicious_tarball(path, filename):
-        """Raises exception if extracting tarball would escape extract path"""
-        tar_file = tarfile.open(filename, 'r|gz')
-        for n in tar_file.getnames():
-            if not os.path.abspath(os.path.join(path, n)).startswith(path):
-                tar_file.close()
+    def _untar_chunks(chunks):
+        """Yield the contents of the first file of a streamed tar.gz."""
+        tar_file = tarfile.open(fileobj=_ChunkReader(chunks), mode='r|gz')
+        try:
+            member = tar_file.next()
+            if member is not None and not _safe_member_name(member.name):
                 raise exception.Error(_('Unsafe filenames in image'))
-        tar_file.close()
+            if member is None or not member.isfile():
+                raise exception.Error(_('Image bundle does not start '
+                                        'with a regular file'))
+            image_file = tar_file.extractfile(member)
+            while True:
+                data = image_file.read(FLAGS.s3_image_chunk_size)
+                if not data:
+                    break
+                yield data
+        finally:
+            tar_file.close()
 
-    @staticmethod
-    def _untarzip_image(path, filename):
-        S3ImageService._test_for_malicious_tarball(path, filename)
-        tar_file = tarfile.open(filename, 'r|gz')
-        tar_file.extractall(path)
-        image_file = tar_file.getnames()[0]
-        tar_file.close()
-        return os.path.join(path, image_file)
+
+def _safe_member_name(name):
+    """Returns whether extracting tar member name stays in the extract
+    path."""
+    name = os.path.normpath(name)
+    return not os.path.isabs(name) and name.split(os.sep)[0] != os.pardir
+
+
+_FAILED_STATES = {'downloading': 'download',
+                  'decrypting': 'decrypt',
+                  'untarring': 'untar'}
+
+
+class _StageError(Exception):
+    """Raised when a stage of the image registration pipeline fails."""
+
+    def __init__(self, stage):
+        super(_StageError, self).__init__(stage)
+        self.stage = stage
+
+
+def _stage(name, set_state, chunks):
+    """Wrap a pipeline stage to report its state and attribute failures.
+
+    set_state is called with name when the stage produces its first chunk.
+    Exceptions raised by the stage itself are re-raised as _StageError,
+    errors of upstream stages pass through unchanged.
+
+    """
+    chunks = iter(chunks)
+    started = False
+    while True:
+        try:
+            chunk = chunks.next()
+        except StopIteration:
+            return
+        except _StageError:
+            raise
+        except Exception:
+            LOG.exception(_('Image pipeline stage %s failed'), name)
+            raise _StageError(name)
+        if not started:
+            started = True
+            set_state(name)
+        yield chunk
+
+
+class _ChunkReader(object):
+    """Read-only file-like object over an iterable of string chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = ''
+        self._offset = 0
+
+    def read(self, size=-1):
+        # NOTE: chunks can be whole bundle parts, so keep an offset into the
+        #       current chunk instead of re-slicing it on every small read.
+        data = []
+        while size:
+            if self._offset >= len(self._chunk):
+                try:
+                    self._chunk = self._chunks.next()
+                except StopIteration:
+                    break
+                self._offset = 0
+                continue
+            end = len(self._chunk)
+            if size > 0:
+                end = min(end, self._offset + size)
+                size -= end - self._offset
+            data.append(self._chunk[self._offset:end])
+            self._offset = end
+        return ''.join(data)
@@ -62,7 +62,9 @@ class LocalAPI(base.Base):
                 raise exception.ApiError(_("Snapshot is deleted: %s") % snapshot_id)
 
             if not size:
-                size = image_info['size']
+                # NOTE: incremental snapshots only hold the changed chunks
+                properties = image_info.get('properties') or {}
+                size = properties.get('volume_size') or image_info['size']
 
         size = int(size)
 
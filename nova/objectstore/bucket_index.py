@@ -0,0 +1,190 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Persistent sorted key index for nova-objectstore buckets.
+
+Listing a bucket used to walk and stat the whole bucket directory on every
+request. A BucketIndex keeps the sorted object names of one bucket together
+with their size and mtime, so a listing with prefix/marker is a bisect plus
+a range scan.
+
+The index is persisted as a snapshot file plus an append-only journal of
+puts and deletes, and the journal is folded into a new snapshot once it
+grows larger than the snapshot. On load, the index is rebuilt from the
+filesystem if it is missing, unreadable, or older than any directory of the
+bucket (i.e. objects were changed behind the server's back).
+
+"""
+
+import bisect
+import json
+import os
+
+from nova import log as logging
+
+
+LOG = logging.getLogger('nova.objectstore.bucket_index')
+
+MIN_JOURNAL_ENTRIES = 1000
+
+
+class BucketIndex(object):
+    """Sorted index of the objects stored in one bucket directory."""
+
+    def __init__(self, index_path, bucket_path, bucket_depth=0):
+        self.snapshot_path = index_path + '.snapshot'
+        self.journal_path = index_path + '.journal'
+        self.bucket_path = bucket_path
+        self.bucket_depth = bucket_depth
+        self.names = []
+        self.info = {}
+        self.journal_entries = 0
+
+    def load(self):
+        """Load the index from disk, rebuilding it if it is stale."""
+        if self._is_stale():
+            self.rebuild()
+            return
+        try:
+            self._read()
+        except (IOError, ValueError, TypeError, IndexError):
+            LOG.warn(_('Index %s is corrupt, rebuilding'),
+                     self.snapshot_path)
+            self.rebuild()
+
+    def rebuild(self):
+        """Rebuild the index by walking the bucket directory."""
+        LOG.info(_('Rebuilding index of %s'), self.bucket_path)
+        skip = len(self.bucket_path) + 1
+        for i in range(self.bucket_depth):
+            skip += 2 * (i + 1) + 1
+        info = {}
+        for root, _dirs, files in os.walk(self.bucket_path):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                stat = os.stat(path)
+                info[path[skip:]] = (stat.st_size, stat.st_mtime)
+        self.info = info
+        self.names = sorted(info)
+        self._write_snapshot()
+
+    def add(self, name, size, mtime):
+        """Record that object name was written."""
+        if name not in self.info:
+            bisect.insort(self.names, name)
+        self.info[name] = (size, mtime)
+        self._append(['+', name, size, mtime])
+
+    def remove(self, name):
+        """Record that object name was deleted."""
+        if name not in self.info:
+            return
+        del self.info[name]
+        del self.names[bisect.bisect_left(self.names, name)]
+        self._append(['-', name])
+
+    def destroy(self):
+        """Remove the persisted index files."""
+        for path in (self.snapshot_path, self.journal_path):
+            if os.path.exists(path):
+                os.unlink(path)
+        self.names = []
+        self.info = {}
+        self.journal_entries = 0
+
+    def list(self, prefix='', marker='', max_keys=None):
+        """Return (entries, truncated) for a bucket listing.
+
+        entries is a list of (name, size, mtime) tuples of at most max_keys
+        objects that sort after marker and start with prefix.
+
+        """
+        start_pos = 0
+        if marker:
+            start_pos = bisect.bisect_right(self.names, marker, start_pos)
+        if prefix:
+            start_pos = bisect.bisect_left(self.names, prefix, start_pos)
+
+        entries = []
+        for pos in xrange(start_pos, len(self.names)):
+            name = self.names[pos]
+            if not name.startswith(prefix):
+                break
+            if max_keys is not None and len(entries) >= max_keys:
+                return entries, True
+            size, mtime = self.info[name]
+            entries.append((name, size, mtime))
+        return entries, False
+
+    def _is_stale(self):
+        if not os.path.exists(self.snapshot_path):
+            return True
+        index_mtime = os.stat(self.snapshot_path).st_mtime
+        if os.path.exists(self.journal_path):
+            index_mtime = max(index_mtime,
+                              os.stat(self.journal_path).st_mtime)
+        # NOTE: creating or unlinking an object touches its directory, and
+        #       the index is always written after the object, so only the
+        #       directories need to be checked, not every object.
+        for root, _dirs, _files in os.walk(self.bucket_path):
+            if os.stat(root).st_mtime > index_mtime:
+                return True
+        return False
+
+    def _read(self):
+        with open(self.snapshot_path) as snapshot:
+            keys = json.load(snapshot)
+        info = dict((_utf8(name), (size, mtime))
+                    for name, size, mtime in keys)
+        journal_entries = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as journal:
+                for line in journal:
+                    entry = json.loads(line)
+                    name = _utf8(entry[1])
+                    if entry[0] == '+':
+                        info[name] = (entry[2], entry[3])
+                    else:
+                        info.pop(name, None)
+                    journal_entries += 1
+        self.info = info
+        self.names = sorted(info)
+        self.journal_entries = journal_entries
+
+    def _write_snapshot(self):
+        keys = [(name,) + self.info[name] for name in self.names]
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as snapshot:
+            json.dump(keys, snapshot)
+        os.rename(tmp_path, self.snapshot_path)
+        if os.path.exists(self.journal_path):
+            os.unlink(self.journal_path)
+        self.journal_entries = 0
+
+    def _append(self, entry):
+        if self.journal_entries >= max(MIN_JOURNAL_ENTRIES, len(self.names)):
+            self._write_snapshot()
+            return
+        with open(self.journal_path, 'a') as journal:
+            journal.write(json.dumps(entry) + '\n')
+        self.journal_entries += 1
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
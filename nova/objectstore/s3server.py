@@ -34,12 +34,16 @@ S3 client with this module:
 
 """
 
-import bisect
 import datetime
 import hashlib
+import json
 import os
 import os.path
+import re
+import shutil
 import urllib
+import uuid
+from xml.etree import ElementTree
 
 import routes
 import webob
@@ -48,12 +52,16 @@ from nova import flags
 from nova import log as logging
 from nova import utils
 from nova import wsgi
+from nova.objectstore import bucket_index
 
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string('buckets_path', '$state_path/buckets',
                     'path to s3 buckets')
 
+CHUNK_SIZE = 64 * 1024
+MAX_PART_NUMBER = 10000
+
 
 class S3Application(wsgi.Router):
     """Implementation of an S3-like storage server based on local files.
@@ -62,6 +70,16 @@ class S3Application(wsgi.Router):
     to prevent hitting file system limits for number of files in each
     directories. 1 means one level of directories, 2 means 2, etc.
 
+    Each bucket has a sorted key index stored under the hidden .index
+    directory, which is loaded (and rebuilt if stale) on startup and kept
+    up to date on every put and delete.
+
+    Object data is streamed in both directions in CHUNK_SIZE pieces, so
+    large objects are never held in memory. Uploads are written to the
+    hidden .incoming directory and renamed into place once complete, and
+    S3 multipart uploads keep their parts under .uploads until they are
+    completed or aborted.
+
     """
 
     def __init__(self, root_directory, bucket_depth=0, mapper=None):
@@ -78,8 +96,47 @@ class S3Application(wsgi.Router):
         if not os.path.exists(self.directory):
             os.makedirs(self.directory)
         self.bucket_depth = bucket_depth
+        self.index_directory = os.path.join(self.directory, '.index')
+        if not os.path.exists(self.index_directory):
+            os.makedirs(self.index_directory)
+        self.incoming_directory = os.path.join(self.directory, '.incoming')
+        if os.path.exists(self.incoming_directory):
+            # NOTE: leftovers of uploads interrupted by a restart
+            shutil.rmtree(self.incoming_directory)
+        os.makedirs(self.incoming_directory)
+        self.uploads_directory = os.path.join(self.directory, '.uploads')
+        if not os.path.exists(self.uploads_directory):
+            os.makedirs(self.uploads_directory)
+        self.indexes = {}
+        for name in self.bucket_names():
+            self.bucket_index(name)
         super(S3Application, self).__init__(mapper)
 
+    def incoming_path(self):
+        """Return a unique path to receive an upload into."""
+        return os.path.join(self.incoming_directory, uuid.uuid4().hex)
+
+    def bucket_names(self):
+        return [name for name in os.listdir(self.directory)
+                if not name.startswith('.')]
+
+    def bucket_index(self, bucket_name):
+        """Return the loaded key index of bucket_name."""
+        index = self.indexes.get(bucket_name)
+        if index is None:
+            index = bucket_index.BucketIndex(
+                    os.path.join(self.index_directory, bucket_name),
+                    os.path.join(self.directory, bucket_name),
+                    self.bucket_depth)
+            index.load()
+            self.indexes[bucket_name] = index
+        return index
+
+    def drop_bucket_index(self, bucket_name):
+        index = self.bucket_index(bucket_name)
+        index.destroy()
+        del self.indexes[bucket_name]
+
 
 class BaseRequestHandler(object):
     """Base class emulating Tornado's web framework pattern in WSGI.
@@ -142,6 +199,40 @@ class BaseRequestHandler(object):
     def finish(self, body=''):
         self.response.body = utils.utf8(body)
 
+    def finish_file(self, object_file, length):
+        """Stream length bytes from object_file as the response body."""
+        self.response.app_iter = FileIterator(object_file, length)
+        self.response.content_length = length
+
+    def receive_body(self, path):
+        """Stream the request body into path and return its MD5 digest.
+
+        The body is written to a temporary file first and renamed to path
+        once it was received completely. Returns None, having answered 400,
+        if the client sent less than its Content-Length.
+
+        """
+        md5 = hashlib.md5()
+        length = self.request.content_length
+        incoming_path = self.application.incoming_path()
+        try:
+            with open(incoming_path, 'w') as incoming_file:
+                copied = copy_stream(self.request.body_file, incoming_file,
+                                     length, md5)
+            if length is not None and copied != length:
+                self.set_status(400)
+                self.render_xml({"Error": {
+                    "Code": "IncompleteBody",
+                    "Message": "You did not provide the number of bytes "
+                               "specified by the Content-Length HTTP header",
+                }})
+                return None
+            os.rename(incoming_path, path)
+        finally:
+            if os.path.exists(incoming_path):
+                os.unlink(incoming_path)
+        return md5.hexdigest()
+
     def invalid(self, **kwargs):
         pass
 
@@ -163,6 +254,8 @@ class BaseRequestHandler(object):
 
         if isinstance(value, basestring):
             parts.append(utils.xhtml_escape(value))
+        elif isinstance(value, bool):
+            parts.append(value and 'true' or 'false')
         elif isinstance(value, int) or isinstance(value, long):
             parts.append(str(value))
         elif isinstance(value, datetime.datetime):
@@ -192,7 +285,7 @@ class BaseRequestHandler(object):
 
 class RootHandler(BaseRequestHandler):
     def get(self):
-        names = os.listdir(self.application.directory)
+        names = self.application.bucket_names()
         buckets = []
         for name in names:
             path = os.path.join(self.application.directory, name)
@@ -216,41 +309,19 @@ class BucketHandler(BaseRequestHandler):
                                             bucket_name))
         terse = int(self.get_argument("terse", 0))
         if not path.startswith(self.application.directory) or \
-           not os.path.isdir(path):
+           bucket_name.startswith('.') or not os.path.isdir(path):
             self.set_status(404)
             return
-        object_names = []
-        for root, dirs, files in os.walk(path):
-            for file_name in files:
-                object_names.append(os.path.join(root, file_name))
-        skip = len(path) + 1
-        for i in range(self.application.bucket_depth):
-            skip += 2 * (i + 1) + 1
-        object_names = [n[skip:] for n in object_names]
-        object_names.sort()
+        index = self.application.bucket_index(bucket_name)
+        entries, truncated = index.list(prefix, marker, max_keys)
         contents = []
-
-        start_pos = 0
-        if marker:
-            start_pos = bisect.bisect_right(object_names, marker, start_pos)
-        if prefix:
-            start_pos = bisect.bisect_left(object_names, prefix, start_pos)
-
-        truncated = False
-        for object_name in object_names[start_pos:]:
-            if not object_name.startswith(prefix):
-                break
-            if len(contents) >= max_keys:
-                truncated = True
-                break
-            object_path = self._object_path(bucket_name, object_name)
+        for object_name, size, mtime in entries:
             c = {"Key": object_name}
             if not terse:
-                info = os.stat(object_path)
                 c.update({
                     "LastModified": datetime.datetime.utcfromtimestamp(
-                        info.st_mtime),
-                    "Size": info.st_size,
+                        mtime),
+                    "Size": size,
                 })
             contents.append(c)
             marker = object_name
@@ -267,74 +338,287 @@ class BucketHandler(BaseRequestHandler):
         path = os.path.abspath(os.path.join(
             self.application.directory, bucket_name))
         if not path.startswith(self.application.directory) or \
-           os.path.exists(path):
+           bucket_name.startswith('.') or os.path.exists(path):
             self.set_status(403)
             return
         os.makedirs(path)
+        self.application.bucket_index(bucket_name)
         self.finish()
 
     def delete(self, bucket_name):
         path = os.path.abspath(os.path.join(
             self.application.directory, bucket_name))
         if not path.startswith(self.application.directory) or \
-           not os.path.isdir(path):
+           bucket_name.startswith('.') or not os.path.isdir(path):
             self.set_status(404)
             return
         if len(os.listdir(path)) > 0:
             self.set_status(403)
             return
         os.rmdir(path)
+        self.application.drop_bucket_index(bucket_name)
         self.set_status(204)
         self.finish()
 
 
 class ObjectHandler(BaseRequestHandler):
-    def get(self, bucket, object_name):
+    def _get_object(self, bucket, object_name):
         object_name = urllib.unquote(object_name)
         path = self._object_path(bucket, object_name)
         if not path.startswith(self.application.directory) or \
-           not os.path.isfile(path):
+           bucket.startswith('.') or not os.path.isfile(path):
             self.set_status(404)
-            return
+            return None, None
         info = os.stat(path)
         self.set_header("Content-Type", "application/unknown")
         self.set_header("Last-Modified", datetime.datetime.utcfromtimestamp(
             info.st_mtime))
+        self.set_header("Accept-Ranges", "bytes")
+        return path, info
+
+    def head(self, bucket, object_name):
+        path, info = self._get_object(bucket, object_name)
+        if path is not None:
+            self.response.content_length = info.st_size
+
+    def get(self, bucket, object_name):
+        path, info = self._get_object(bucket, object_name)
+        if path is None:
+            return
+        start, stop = 0, info.st_size
+        byte_range = self.request.range
+        # NOTE: multiple ranges are not supported, the whole object is
+        #       returned instead, which RFC 2616 allows.
+        if byte_range is not None and len(byte_range.ranges) == 1:
+            byte_range = byte_range.range_for_length(info.st_size)
+            if byte_range is None:
+                self.set_header("Content-Range", "bytes */%d" % info.st_size)
+                self.set_status(416)
+                return
+            start, stop = byte_range
+            self.set_header("Content-Range", "bytes %d-%d/%d" %
+                            (start, stop - 1, info.st_size))
+            self.set_status(206)
         object_file = open(path, "r")
-        try:
-            self.finish(object_file.read())
-        finally:
-            object_file.close()
+        object_file.seek(start)
+        self.finish_file(object_file, stop - start)
 
     def put(self, bucket, object_name):
         object_name = urllib.unquote(object_name)
+        upload_id = self.request.str_GET.get('uploadId')
+        if upload_id is not None:
+            self._put_part(bucket, object_name, upload_id)
+            return
+        path = self._writable_object_path(bucket, object_name)
+        if path is None:
+            return
+        etag = self.receive_body(path)
+        if etag is None:
+            return
+        self._add_to_index(bucket, object_name, path)
+        self.set_header('ETag', '"%s"' % etag)
+        self.finish()
+
+    def post(self, bucket, object_name):
+        object_name = urllib.unquote(object_name)
+        if 'uploads' in self.request.str_GET:
+            self._initiate_upload(bucket, object_name)
+        elif 'uploadId' in self.request.str_GET:
+            self._complete_upload(bucket, object_name,
+                                  self.request.str_GET['uploadId'])
+        else:
+            self.set_status(400)
+
+    def delete(self, bucket, object_name):
+        object_name = urllib.unquote(object_name)
+        upload_id = self.request.str_GET.get('uploadId')
+        if upload_id is not None:
+            self._abort_upload(bucket, object_name, upload_id)
+            return
+        path = self._object_path(bucket, object_name)
+        if not path.startswith(self.application.directory) or \
+           bucket.startswith('.') or not os.path.isfile(path):
+            self.set_status(404)
+            return
+        os.unlink(path)
+        self.application.bucket_index(bucket).remove(object_name)
+        self.set_status(204)
+        self.finish()
+
+    def _writable_object_path(self, bucket, object_name):
         bucket_dir = os.path.abspath(os.path.join(
             self.application.directory, bucket))
         if not bucket_dir.startswith(self.application.directory) or \
-           not os.path.isdir(bucket_dir):
+           bucket.startswith('.') or not os.path.isdir(bucket_dir):
             self.set_status(404)
-            return
+            return None
         path = self._object_path(bucket, object_name)
         if not path.startswith(bucket_dir) or os.path.isdir(path):
             self.set_status(403)
-            return
+            return None
         directory = os.path.dirname(path)
         if not os.path.exists(directory):
             os.makedirs(directory)
-        object_file = open(path, "w")
-        object_file.write(self.request.body)
-        object_file.close()
-        self.set_header('ETag',
-                        '"%s"' % hashlib.md5(self.request.body).hexdigest())
+        return path
+
+    def _add_to_index(self, bucket, object_name, path):
+        info = os.stat(path)
+        self.application.bucket_index(bucket).add(object_name,
+                                                  info.st_size,
+                                                  info.st_mtime)
+
+    def _upload_dir(self, bucket, object_name, upload_id):
+        """Return the directory of an in-progress multipart upload."""
+        path = os.path.join(self.application.uploads_directory, upload_id)
+        if re.match('^[0-9a-f]+$', upload_id) and os.path.isdir(path):
+            with open(os.path.join(path, 'info')) as info_file:
+                info = json.load(info_file)
+            if (info['bucket'].encode('utf-8') == bucket and
+                info['key'].encode('utf-8') == object_name):
+                return path
+        self.set_status(404)
+        return None
+
+    def _initiate_upload(self, bucket, object_name):
+        if self._writable_object_path(bucket, object_name) is None:
+            return
+        upload_id = uuid.uuid4().hex
+        path = os.path.join(self.application.uploads_directory, upload_id)
+        os.makedirs(path)
+        with open(os.path.join(path, 'info'), 'w') as info_file:
+            json.dump({'bucket': bucket, 'key': object_name}, info_file)
+        self.render_xml({"InitiateMultipartUploadResult": {
+            "Bucket": bucket,
+            "Key": object_name,
+            "UploadId": upload_id,
+        }})
+
+    def _put_part(self, bucket, object_name, upload_id):
+        path = self._upload_dir(bucket, object_name, upload_id)
+        if path is None:
+            return
+        try:
+            part_number = int(self.request.str_GET.get('partNumber'))
+        except (TypeError, ValueError):
+            part_number = 0
+        if not 1 <= part_number <= MAX_PART_NUMBER:
+            self.set_status(400)
+            return
+        part_path = os.path.join(path, str(part_number))
+        etag = self.receive_body(part_path)
+        if etag is None:
+            return
+        with open(part_path + '.md5', 'w') as md5_file:
+            md5_file.write(etag)
+        self.set_header('ETag', '"%s"' % etag)
         self.finish()
 
-    def delete(self, bucket, object_name):
-        object_name = urllib.unquote(object_name)
-        path = self._object_path(bucket, object_name)
-        if not path.startswith(self.application.directory) or \
-           not os.path.isfile(path):
-            self.set_status(404)
+    def _complete_upload(self, bucket, object_name, upload_id):
+        path = self._upload_dir(bucket, object_name, upload_id)
+        if path is None:
             return
-        os.unlink(path)
+        parts = []
+        try:
+            for element in ElementTree.fromstring(
+                    self.request.body).getiterator():
+                if element.tag.endswith('PartNumber'):
+                    parts.append([int(element.text)])
+                elif element.tag.endswith('ETag'):
+                    parts[-1].append(element.text.strip().strip('"'))
+        except (SyntaxError, ValueError, IndexError, AttributeError):
+            self.set_status(400)
+            return
+        part_paths = []
+        for part in parts:
+            part_path = os.path.join(path, str(part[0]))
+            if len(part) != 2 or not os.path.isfile(part_path + '.md5'):
+                self.set_status(400)
+                return
+            with open(part_path + '.md5') as md5_file:
+                if md5_file.read() != part[1]:
+                    self.set_status(400)
+                    return
+            part_paths.append(part_path)
+        numbers = [part[0] for part in parts]
+        if not numbers or numbers != sorted(set(numbers)):
+            self.set_status(400)
+            return
+
+        object_path = self._writable_object_path(bucket, object_name)
+        if object_path is None:
+            return
+        incoming_path = self.application.incoming_path()
+        try:
+            with open(incoming_path, 'w') as incoming_file:
+                for part_path in part_paths:
+                    with open(part_path) as part_file:
+                        copy_stream(part_file, incoming_file)
+            os.rename(incoming_path, object_path)
+        finally:
+            if os.path.exists(incoming_path):
+                os.unlink(incoming_path)
+        self._add_to_index(bucket, object_name, object_path)
+        shutil.rmtree(path)
+
+        etag = hashlib.md5(''.join(part[1].decode('hex') for part in parts))
+        self.render_xml({"CompleteMultipartUploadResult": {
+            "Location": "/%s/%s" % (bucket, object_name),
+            "Bucket": bucket,
+            "Key": object_name,
+            "ETag": '"%s-%d"' % (etag.hexdigest(), len(parts)),
+        }})
+
+    def _abort_upload(self, bucket, object_name, upload_id):
+        path = self._upload_dir(bucket, object_name, upload_id)
+        if path is None:
+            return
+        shutil.rmtree(path)
         self.set_status(204)
         self.finish()
+
+
+class FileIterator(object):
+    """WSGI app_iter that reads length bytes of a file in chunks."""
+
+    def __init__(self, object_file, length):
+        self.object_file = object_file
+        self.length = length
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.length <= 0:
+            raise StopIteration
+        data = self.object_file.read(min(CHUNK_SIZE, self.length))
+        if not data:
+            raise StopIteration
+        self.length -= len(data)
+        return data
+
+    def close(self):
+        self.object_file.close()
+
+
+def copy_stream(source, destination, length=None, md5=None):
+    """Copy length bytes (or up to EOF) from source to destination.
+
+    Returns the number of bytes copied, which is less than length if
+    source ended first.
+
+    """
+    copied = 0
+    while length is None or length > 0:
+        size = CHUNK_SIZE
+        if length is not None:
+            size = min(size, length)
+        data = source.read(size)
+        if not data:
+            break
+        destination.write(data)
+        copied += len(data)
+        if md5 is not None:
+            md5.update(data)
+        if length is not None:
+            length -= len(data)
+    return copied
@@ -0,0 +1,351 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Long-lived process running commands as root for a service.
+
+Running a command as root normally means forking the service and running
+root_helper (sudo), which then runs the command; a single instance boot
+runs dozens of them. With --use_root_helper_daemon, the first command run
+as root starts nova-root-helper through root_helper instead. It listens on
+a unix socket only the service can use, tells the service where on its
+standard output, and runs the commands of COMMANDS that the service sends
+it, several at a time. Commands it doesn't run, or all commands if it
+can't be started, are run through root_helper as before.
+
+Whoever may run nova-root-helper with root_helper may send it commands, so
+it takes no flags: COMMANDS is fixed here, and the socket is made in a new
+directory of its own.
+
+A request is a JSON line {"cmd": [...], "input_length": n} followed by n
+bytes of input. The reply is a JSON line {"exit_code": n, "stdout_length":
+n, "stderr_length": n} followed by the output, or {"error": "..."} if the
+command is not allowed. The helper exits when its standard input, a pipe
+from the service, is closed.
+
+"""
+
+import json
+import os
+import shlex
+import sys
+import tempfile
+
+import eventlet
+from eventlet import greenio
+from eventlet import patcher
+from eventlet import semaphore
+from eventlet import timeout
+from eventlet import tpool
+from eventlet.green import socket
+from eventlet.green import subprocess
+
+from nova import exception
+from nova import flags
+from nova import log as logging
+
+
+native_subprocess = patcher.original('subprocess')
+
+LOG = logging.getLogger('nova.roothelper')
+
+FLAGS = flags.FLAGS
+flags.DEFINE_bool('use_root_helper_daemon', False,
+                  'run commands as root through one long-lived root helper '
+                  'process instead of running root_helper for each')
+flags.DEFINE_string('root_helper_daemon', 'nova-root-helper',
+                    'command run with root_helper to start the root helper')
+flags.DEFINE_integer('root_helper_start_timeout', 10,
+                     'seconds to wait for the root helper to start')
+
+# NOTE: the commands the root helper runs; others are run with root_helper.
+#       Changing the list takes changing this root-owned file.
+COMMANDS = ['arping', 'brctl', 'chmod', 'chown', 'dd', 'dhcp_release',
+            'dmsetup', 'e2fsck', 'ietadm', 'ip', 'ip6tables-restore',
+            'ip6tables-save', 'iptables-restore', 'iptables-save',
+            'iscsiadm', 'kill', 'lvcreate', 'lvremove', 'lvrename',
+            'lvresize', 'lvs', 'mount', 'ovs-vsctl', 'qemu-img', 'resize2fs',
+            'route', 'tee', 'tgtadm', 'tunctl', 'umount', 'vblade-persist',
+            'vconfig', 'vgs']
+
+
+def _send(sock_file, header, *data):
+    sock_file.write(json.dumps(header) + '\n')
+    for chunk in data:
+        sock_file.write(chunk)
+    sock_file.flush()
+
+
+def _receive(sock_file):
+    """Returns the next header of sock_file, None at the end."""
+    line = sock_file.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+def _read(sock_file, length):
+    data = sock_file.read(length)
+    if len(data) != length:
+        raise IOError(_('Connection closed after %(got)d of %(length)d '
+                        'bytes') % {'got': len(data), 'length': length})
+    return data
+
+
+class RootHelperServer(object):
+    """Runs the allowed commands sent to a unix socket."""
+
+    def __init__(self, commands=COMMANDS):
+        self.commands = set(commands)
+        self.socket_path = None
+        self._sock = None
+
+    def listen(self):
+        """Bind a socket only the invoking user can connect to, returns
+        its path."""
+        # NOTE: nobody but root can enter the new directory until the
+        #       socket in it is only writable by the service user, so
+        #       nobody else can connect in between.
+        socket_dir = tempfile.mkdtemp(prefix='nova-root-helper-')
+        self.socket_path = os.path.join(socket_dir, 'socket')
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.socket_path)
+        os.chmod(self.socket_path, 0600)
+        # NOTE: started through sudo, the socket belongs to the service
+        #       user so that nobody else can run commands through it.
+        if 'SUDO_UID' in os.environ:
+            os.chown(self.socket_path, int(os.environ['SUDO_UID']),
+                     int(os.environ.get('SUDO_GID', -1)))
+        os.chmod(socket_dir, 0711)
+        self._sock.listen(64)
+        return self.socket_path
+
+    def close(self):
+        """Close and remove the socket."""
+        if self._sock is None:
+            return
+        self._sock.close()
+        self._sock = None
+        os.unlink(self.socket_path)
+        os.rmdir(os.path.dirname(self.socket_path))
+
+    def serve(self):
+        while True:
+            conn, _address = self._sock.accept()
+            eventlet.spawn_n(self._handle, conn)
+
+    def _handle(self, conn):
+        sock_file = conn.makefile('rwb')
+        try:
+            while True:
+                request = _receive(sock_file)
+                if request is None:
+                    break
+                process_input = _read(sock_file,
+                                      request.get('input_length', 0))
+                self._run(sock_file, request['cmd'], process_input)
+        except Exception:
+            LOG.exception(_('Error handling root helper request'))
+        finally:
+            sock_file.close()
+            conn.close()
+
+    def _run(self, sock_file, cmd, process_input):
+        if not cmd or cmd[0] not in self.commands:
+            _send(sock_file, {'error': 'command not allowed'})
+            return
+        LOG.debug(_('Running cmd (root helper): %s'), ' '.join(cmd))
+        # NOTE: green subprocesses poll for the exit of the command every
+        #       10ms, longer than most commands take; native threads wait
+        #       for it instead.
+        exit_code, stdout, stderr = tpool.execute(_run_command, cmd,
+                                                  process_input)
+        _send(sock_file, {'exit_code': exit_code,
+                          'stdout_length': len(stdout),
+                          'stderr_length': len(stderr)},
+              stdout, stderr)
+
+
+def _run_command(cmd, process_input):
+    try:
+        obj = native_subprocess.Popen(cmd,
+                                      stdin=native_subprocess.PIPE,
+                                      stdout=native_subprocess.PIPE,
+                                      stderr=native_subprocess.PIPE,
+                                      close_fds=True)
+        stdout, stderr = obj.communicate(process_input or None)
+    except OSError as e:
+        # NOTE: what sudo does when the command can't be run
+        return 1, '', '%s: %s\n' % (cmd[0], e)
+    return obj.returncode, stdout, stderr
+
+
+def serve():
+    """Run the root helper until standard input is closed."""
+    server = RootHelperServer()
+    sys.stdout.write(server.listen() + '\n')
+    sys.stdout.flush()
+    eventlet.spawn_n(server.serve)
+    try:
+        stdin = greenio.GreenPipe(sys.stdin.fileno(), 'rb', 0)
+        while stdin.read(1):
+            pass
+    finally:
+        server.close()
+
+
+class RootHelperClient(object):
+    """Sends commands to a root helper it starts when first needed."""
+
+    def __init__(self):
+        self.socket_path = None
+        self._process = None
+        self._failed = False
+        self._idle = []
+        self._lock = semaphore.Semaphore()
+
+    def execute(self, cmd, process_input=None):
+        """Run cmd as root, returns (exit_code, stdout, stderr).
+
+        Returns None if cmd has to be run with root_helper instead.
+
+        """
+        if not cmd or cmd[0] not in COMMANDS:
+            return None
+        sock_file = self._connection()
+        if sock_file is None:
+            return None
+        process_input = process_input or ''
+        LOG.debug(_('Running cmd (root helper): %s'), ' '.join(cmd))
+        try:
+            _send(sock_file, {'cmd': cmd,
+                              'input_length': len(process_input)},
+                  process_input)
+            reply = _receive(sock_file)
+            if reply is None:
+                raise IOError(_('Connection closed'))
+            if 'error' in reply:
+                LOG.debug(_('Root helper refused %(cmd)s: %(error)s') %
+                          {'cmd': cmd, 'error': reply['error']})
+                self._idle.append(sock_file)
+                return None
+            stdout = _read(sock_file, reply['stdout_length'])
+            stderr = _read(sock_file, reply['stderr_length'])
+        except (socket.error, IOError, ValueError, KeyError) as e:
+            # NOTE: the command may have run, so it can't be run again
+            #       with root_helper; retrying is left to the caller.
+            sock_file.close()
+            if self._process is not None and self._process.poll() is not None:
+                self.stop()
+            raise exception.ProcessExecutionError(
+                    cmd=' '.join(cmd),
+                    description=_('Lost the root helper: %s') % e)
+        self._idle.append(sock_file)
+        return reply['exit_code'], stdout, stderr
+
+    def _connection(self):
+        if self._idle:
+            return self._idle.pop()
+        with self._lock:
+            if not self._start():
+                return None
+        if self._idle:
+            return self._idle.pop()
+        try:
+            return self._connect()
+        except socket.error as e:
+            LOG.warn(_('Unable to connect to the root helper, restarting '
+                       'it: %s'), e)
+            self.stop()
+            return None
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except socket.error:
+            sock.close()
+            raise
+        return sock.makefile('rwb')
+
+    def _start(self):
+        """Start the root helper unless it runs, returns if it does."""
+        if self._failed:
+            return False
+        if self._process is not None and self._process.poll() is None:
+            return True
+        self.stop()
+
+        cmd = shlex.split(FLAGS.root_helper) + [FLAGS.root_helper_daemon]
+        LOG.info(_('Starting root helper: %s'), ' '.join(cmd))
+        try:
+            self._process = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                             stdout=subprocess.PIPE,
+                                             close_fds=True)
+        except OSError as e:
+            return self._give_up(e)
+
+        # NOTE: the root helper writes the path of its socket once it
+        #       listens on it.
+        line = None
+        with timeout.Timeout(FLAGS.root_helper_start_timeout, False):
+            line = self._process.stdout.readline()
+        if line is None:
+            return self._give_up(_('did not start in %d seconds') %
+                                 FLAGS.root_helper_start_timeout)
+        if not line.strip():
+            return self._give_up(_('exited with %s') % self._process.wait())
+        self.socket_path = line.strip()
+        try:
+            self._idle.append(self._connect())
+        except socket.error as e:
+            return self._give_up(e)
+        return True
+
+    def _give_up(self, reason):
+        LOG.warn(_('Unable to start the root helper, running commands '
+                   'with root_helper: %s'), reason)
+        self.stop()
+        self._failed = True
+        return False
+
+    def stop(self):
+        """Close the connections to the root helper, which then exits."""
+        while self._idle:
+            self._idle.pop().close()
+        if self._process is not None:
+            if self._process.poll() is None:
+                self._process.stdin.close()
+                self._process.wait()
+            self._process.stdout.close()
+            self._process = None
+        self.socket_path = None
+
+
+_client = None
+
+
+def execute(cmd, process_input=None):
+    """Run cmd through the root helper of this process.
+
+    Returns (exit_code, stdout, stderr), or None if cmd has to be run
+    with root_helper instead.
+
+    """
+    global _client
+    if _client is None:
+        _client = RootHelperClient()
+    return _client.execute(cmd, process_input)
@@ -20,6 +20,7 @@
 from nova.utils import import_object
 from nova.rpc.common import RemoteError, LOG
 from nova import flags
+from nova import trace
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string('rpc_backend',
@@ -42,16 +43,24 @@ def create_connection(new=True):
 
 
 def call(context, topic, msg):
-    return get_impl().call(context, topic, msg)
+    with trace.span('rpc', '%s.%s' % (topic, msg.get('method')),
+                    type='call'):
+        return get_impl().call(context, topic, msg)
 
 
 def cast(context, topic, msg):
-    return get_impl().cast(context, topic, msg)
+    with trace.span('rpc', '%s.%s' % (topic, msg.get('method')),
+                    type='cast'):
+        return get_impl().cast(context, topic, msg)
 
 
 def fanout_cast(context, topic, msg):
-    return get_impl().fanout_cast(context, topic, msg)
+    with trace.span('rpc', '%s.%s' % (topic, msg.get('method')),
+                    type='fanout_cast'):
+        return get_impl().fanout_cast(context, topic, msg)
 
 
 def multicall(context, topic, msg):
-    return get_impl().multicall(context, topic, msg)
+    with trace.span('rpc', '%s.%s' % (topic, msg.get('method')),
+                    type='multicall'):
+        return get_impl().multicall(context, topic, msg)
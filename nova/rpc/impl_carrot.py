@@ -43,6 +43,7 @@ from nova import context
 from nova import exception
 from nova import fakerabbit
 from nova import flags
+from nova import trace
 import nova.rpc.common as rpc_common
 from nova.rpc.common import RemoteError, LOG
 
@@ -280,6 +281,7 @@ class AdapterConsumer(Consumer):
 
         node_func = getattr(self.proxy, str(method))
         node_args = dict((str(k), v) for k, v in args.iteritems())
+        request_trace = trace.start(ctxt.request_id, 'rpc %s' % method)
         # NOTE(vish): magic is fun!
         try:
             rval = node_func(context=ctxt, **node_args)
@@ -295,6 +297,8 @@ class AdapterConsumer(Consumer):
         except Exception as e:
             LOG.exception('Exception during message handling')
             ctxt.reply(None, sys.exc_info())
+        finally:
+            trace.finish(request_trace)
         return
 
 
@@ -34,6 +34,7 @@ import greenlet
 from nova import context
 from nova import exception
 from nova import flags
+from nova import trace
 import nova.rpc.common as rpc_common
 from nova.rpc.common import RemoteError, LOG
 
@@ -628,6 +629,7 @@ class ProxyCallback(object):
         object and calls it.
         """
 
+        request_trace = trace.start(ctxt.request_id, 'rpc %s' % method)
         try:
             node_func = getattr(self.proxy, str(method))
             node_args = dict((str(k), v) for k, v in args.iteritems())
@@ -644,6 +646,8 @@ class ProxyCallback(object):
         except Exception as e:
             LOG.exception('Exception during message handling')
             ctxt.reply(None, sys.exc_info())
+        finally:
+            trace.finish(request_trace)
         return
 
 
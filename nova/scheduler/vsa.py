@@ -19,6 +19,8 @@
 VSA Simple Scheduler
 """
 
+import bisect
+
 from nova import context
 from nova import db
 from nova import flags
@@ -49,6 +51,74 @@ def GB_TO_BYTES(gb):
     return gb << 30
 
 
+def _used_capacity(capabilities, qos_values):
+    return sum(values['TotalCapacity'] - values['AvailableCapacity']
+               for values in capabilities.itervalues())
+
+
+def _most_free_drives(capabilities, qos_values):
+    return -qos_values['FullDrive']['NumFreeDrives']
+
+
+def _most_available_capacity(capabilities, qos_values):
+    return -qos_values['AvailableCapacity']
+
+
+class HostIndex(object):
+    """Hosts with a qos group of the requested drive type.
+
+    Iterating yields (host, capabilities) of the hosts in the order of the
+    service states. ordered() yields them by a key of their capabilities
+    and qos group instead, from sorted lists that changed() keeps current
+    as qos groups are consumed, so that placing a drive starts with the
+    best hosts rather than matching the qos groups of every host again.
+    """
+
+    def __init__(self, hosts):
+        # NOTE: [(host, capabilities, qos_values)]
+        self._hosts = list(hosts)
+        self._positions = dict((id(qos_values), position)
+                               for position, (_host, _capabilities,
+                                              qos_values)
+                               in enumerate(self._hosts))
+        self._orders = {}
+
+    def __iter__(self):
+        for host, capabilities, _qos_values in self._hosts:
+            yield (host, capabilities)
+
+    def __len__(self):
+        return len(self._hosts)
+
+    def hosts(self):
+        return [host for host, _capabilities, _qos_values in self._hosts]
+
+    def ordered(self, key):
+        """Yields (host, capabilities, qos_values) by the lowest
+        key(capabilities, qos_values) first, and in the order of the
+        index for equal keys."""
+        if key not in self._orders:
+            keys = [key(capabilities, qos_values)
+                    for _host, capabilities, qos_values in self._hosts]
+            self._orders[key] = (keys, sorted((value, position)
+                                              for position, value
+                                              in enumerate(keys)))
+        _keys, order = self._orders[key]
+        for _value, position in order:
+            yield self._hosts[position]
+
+    def changed(self, qos_values):
+        """Moves the host of qos group qos_values after it was consumed."""
+        position = self._positions.get(id(qos_values))
+        if position is None:
+            return
+        _host, capabilities, _qos_values = self._hosts[position]
+        for key, (keys, order) in self._orders.iteritems():
+            del order[bisect.bisect_left(order, (keys[position], position))]
+            keys[position] = key(capabilities, qos_values)
+            bisect.insort(order, (keys[position], position))
+
+
 class VsaScheduler(simple.SimpleScheduler):
     """Implements Scheduler for volume placement."""
 
@@ -108,7 +178,7 @@ class VsaScheduler(simple.SimpleScheduler):
         if host_list is None:
             host_list = self._get_service_states().iteritems()
 
-        filtered_hosts = []     # returns list of (hostname, capability_dict)
+        filtered_hosts = []     # (hostname, capability_dict, qos_values)
         for host, host_dict in host_list:
             for service_name, service_dict in host_dict.iteritems():
                 if service_name != topic:
@@ -118,16 +188,27 @@ class VsaScheduler(simple.SimpleScheduler):
                 for qosgrp, qos_values in gos_info.iteritems():
                     if self._qosgrp_match(drive_type, qos_values):
                         if qos_values['AvailableCapacity'] > 0:
-                            filtered_hosts.append((host, gos_info))
+                            filtered_hosts.append((host, gos_info,
+                                                   qos_values))
                         else:
                             LOG.debug(_("Host %s has no free capacity. Skip"),
                                         host)
                         break
 
-        host_names = [item[0] for item in filtered_hosts]
-        LOG.debug(_("Filter hosts: %s"), host_names)
+        filtered_hosts = HostIndex(filtered_hosts)
+        LOG.debug(_("Filter hosts: %s"), filtered_hosts.hosts())
         return filtered_hosts
 
+    def _index_selected_hosts(self, request_spec, selected_hosts):
+        drive_type = request_spec['drive_type']
+        matched_hosts = []
+        for host, capabilities in selected_hosts:
+            for qosgrp, qos_values in capabilities.iteritems():
+                if self._qosgrp_match(drive_type, qos_values):
+                    matched_hosts.append((host, capabilities, qos_values))
+                    break
+        return HostIndex(matched_hosts)
+
     def _allowed_to_use_host(self, host, selected_hosts, unique):
         if unique == False or \
            host not in [item[0] for item in selected_hosts]:
@@ -141,7 +222,10 @@ class VsaScheduler(simple.SimpleScheduler):
 
     def host_selection_algorithm(self, request_spec, all_hosts,
                                 selected_hosts, unique):
-        """Must override this method for VSA scheduler to work."""
+        """Must override this method for VSA scheduler to work.
+
+        all_hosts is the HostIndex of the hosts to select from.
+        """
         raise NotImplementedError(_("Must implement host selection mechanism"))
 
     def _select_hosts(self, request_spec, all_hosts, selected_hosts=None):
@@ -155,8 +239,10 @@ class VsaScheduler(simple.SimpleScheduler):
             LOG.debug(_("Maximum number of hosts selected (%d)"),
                         len(selected_hosts))
             unique = False
+            selected_index = self._index_selected_hosts(request_spec,
+                                                        selected_hosts)
             (host, qos_cap) = self.host_selection_algorithm(request_spec,
-                                                            selected_hosts,
+                                                            selected_index,
                                                             selected_hosts,
                                                             unique)
 
@@ -270,6 +356,7 @@ class VsaScheduler(simple.SimpleScheduler):
             vol['host'] = host
             vol['capabilities'] = qos_cap
             self._consume_resource(qos_cap, vol['size'], -1)
+            all_hosts.changed(qos_cap)
 
     def schedule_create_volumes(self, context, request_spec,
                                 availability_zone=None, *_args, **_kwargs):
@@ -435,50 +522,33 @@ class VsaSchedulerLeastUsedHost(VsaScheduler):
     def host_selection_algorithm(self, request_spec, all_hosts,
                                 selected_hosts, unique):
         size = request_spec['size']
-        drive_type = request_spec['drive_type']
         best_host = None
         best_qoscap = None
         best_cap = None
         min_used = 0
 
-        for (host, capabilities) in all_hosts:
-
-            has_enough_capacity = False
-            used_capacity = 0
-            for qosgrp, qos_values in capabilities.iteritems():
+        for (host, capabilities, qos_values) in \
+                all_hosts.ordered(_used_capacity):
 
-                used_capacity = used_capacity + qos_values['TotalCapacity'] \
-                                - qos_values['AvailableCapacity']
-
-                if self._qosgrp_match(drive_type, qos_values):
-                    # we found required qosgroup
-
-                    if size == 0:   # full drive match
-                        if qos_values['FullDrive']['NumFreeDrives'] > 0:
-                            has_enough_capacity = True
-                            matched_qos = qos_values
-                        else:
-                            break
-                    else:
-                        if qos_values['AvailableCapacity'] >= size and \
-                           (qos_values['PartitionDrive'][
-                                            'NumFreePartitions'] > 0 or \
-                            qos_values['FullDrive']['NumFreeDrives'] > 0):
-                            has_enough_capacity = True
-                            matched_qos = qos_values
-                        else:
-                            break
+            if size == 0:   # full drive match
+                has_enough_capacity = \
+                    qos_values['FullDrive']['NumFreeDrives'] > 0
+            else:
+                has_enough_capacity = \
+                    qos_values['AvailableCapacity'] >= size and \
+                    (qos_values['PartitionDrive']['NumFreePartitions'] > 0 or \
+                     qos_values['FullDrive']['NumFreeDrives'] > 0)
 
             if has_enough_capacity and \
                self._allowed_to_use_host(host,
                                          selected_hosts,
-                                         unique) and \
-               (best_host is None or used_capacity < min_used):
+                                         unique):
 
-                min_used = used_capacity
+                min_used = _used_capacity(capabilities, qos_values)
                 best_host = host
-                best_qoscap = matched_qos
+                best_qoscap = qos_values
                 best_cap = capabilities
+                break
 
         if best_host:
             self._add_hostcap_to_list(selected_hosts, best_host, best_cap)
@@ -500,31 +570,27 @@ class VsaSchedulerMostAvailCapacity(VsaScheduler):
     def host_selection_algorithm(self, request_spec, all_hosts,
                                 selected_hosts, unique):
         size = request_spec['size']
-        drive_type = request_spec['drive_type']
         best_host = None
         best_qoscap = None
         best_cap = None
         max_avail = 0
 
-        for (host, capabilities) in all_hosts:
-            for qosgrp, qos_values in capabilities.iteritems():
-                if self._qosgrp_match(drive_type, qos_values):
-                    # we found required qosgroup
-
-                    if size == 0:   # full drive match
-                        available = qos_values['FullDrive']['NumFreeDrives']
-                    else:
-                        available = qos_values['AvailableCapacity']
-
-                    if available > max_avail and \
-                       self._allowed_to_use_host(host,
-                                                 selected_hosts,
-                                                 unique):
-                        max_avail = available
-                        best_host = host
-                        best_qoscap = qos_values
-                        best_cap = capabilities
-                    break   # go to the next host
+        if size == 0:   # full drive match
+            key = _most_free_drives
+        else:
+            key = _most_available_capacity
+
+        for (host, capabilities, qos_values) in all_hosts.ordered(key):
+            available = -key(capabilities, qos_values)
+            if available <= 0:
+                break   # and neither have the hosts after it
+
+            if self._allowed_to_use_host(host, selected_hosts, unique):
+                max_avail = available
+                best_host = host
+                best_qoscap = qos_values
+                best_cap = capabilities
+                break
 
         if best_host:
             self._add_hostcap_to_list(selected_hosts, best_host, best_cap)
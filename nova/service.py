@@ -19,10 +19,14 @@
 
 """Generic Node baseclass for all workers that run on hosts."""
 
+import errno
 import inspect
 import os
+import signal
+import time
 
 import eventlet
+import eventlet.hubs
 import greenlet
 
 from nova import context
@@ -51,6 +55,22 @@ flags.DEFINE_integer('ec2_listen_port', 8773, 'port for ec2 api to listen')
 flags.DEFINE_string('osapi_listen', "0.0.0.0",
                     'IP address for OpenStack API to listen')
 flags.DEFINE_integer('osapi_listen_port', 8774, 'port for os api to listen')
+flags.DEFINE_string('metadata_listen', "0.0.0.0",
+                    'IP address for metadata api to listen')
+flags.DEFINE_integer('metadata_listen_port', 8775,
+                     'port for metadata api to listen')
+flags.DEFINE_integer('ec2_workers', 0,
+                     'number of worker processes for the EC2 API, 0 to '
+                     'serve it from the nova-api process itself')
+flags.DEFINE_integer('osapi_workers', 0,
+                     'number of worker processes for the OpenStack API, 0 '
+                     'to serve it from the nova-api process itself')
+flags.DEFINE_integer('metadata_workers', 0,
+                     'number of worker processes for the metadata API, 0 '
+                     'to serve it from the nova-api process itself')
+flags.DEFINE_integer('worker_shutdown_timeout', 30,
+                     'seconds API workers wait for requests in progress '
+                     'to finish when they are stopped')
 flags.DEFINE_string('api_paste_config', "api-paste.ini",
                     'File name for the paste.deploy config for nova-api')
 
@@ -109,6 +129,144 @@ class Launcher(object):
                 pass
 
 
+class ProcessLauncher(object):
+    """Serve WSGI services from pre-forked worker processes.
+
+    The listening socket of every service is opened once in the parent,
+    which then forks the requested number of workers for each service,
+    restarts workers that exit and stops them all on SIGTERM or SIGINT.
+    Services that do not ask for workers get a single one.
+
+    """
+
+    def __init__(self):
+        """Initialize the process launcher.
+
+        :returns: None
+
+        """
+        self._servers = []
+        self._children = {}
+        self._running = False
+
+    def launch_server(self, server):
+        """Open the server's socket, its workers are forked by wait().
+
+        :param server: The WSGIService you would like to start.
+        :returns: None
+
+        """
+        server.listen()
+        self._servers.append(server)
+
+    def _start_child(self, server):
+        pid = os.fork()
+        if pid == 0:
+            self._child_process(server)
+        LOG.info(_('Started %(name)s worker %(pid)d'),
+                 {'name': server.name, 'pid': pid})
+        self._children[pid] = (server, time.time())
+
+    @staticmethod
+    def _child_process(server):
+        """Serve requests in a forked worker until signalled to stop."""
+
+        def _handle_signal(signo, frame):
+            # NOTE: only schedule the stop here, raising from a signal
+            #       handler would unwind the hub and abort the requests
+            #       that are still in progress.
+            eventlet.spawn_n(server.stop)
+
+        status = 0
+        try:
+            # NOTE: the parent's greenthreads must not run in the worker
+            eventlet.hubs.use_hub()
+            signal.signal(signal.SIGTERM, _handle_signal)
+            signal.signal(signal.SIGINT, _handle_signal)
+            server.start()
+            server.wait()
+            server.drain(FLAGS.worker_shutdown_timeout)
+        except BaseException:
+            LOG.exception(_('Unhandled exception in %s worker'), server.name)
+            status = 1
+        os._exit(status)
+
+    def _reap_child(self):
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError, e:
+            if e.errno != errno.ECHILD:
+                raise
+            return None
+        if not pid:
+            return None
+        server, started = self._children.pop(pid)
+        if os.WIFSIGNALED(status):
+            LOG.warn(_('%(name)s worker %(pid)d killed by signal %(sig)d'),
+                     {'name': server.name, 'pid': pid,
+                      'sig': os.WTERMSIG(status)})
+        else:
+            LOG.warn(_('%(name)s worker %(pid)d exited with status '
+                       '%(status)d'),
+                     {'name': server.name, 'pid': pid,
+                      'status': os.WEXITSTATUS(status)})
+        return server, started
+
+    def wait(self):
+        """Fork the workers and restart them as they exit, until signalled.
+
+        :returns: None
+
+        """
+        self._running = True
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+        for server in self._servers:
+            for _i in xrange(max(server.workers, 1)):
+                self._start_child(server)
+        while self._running:
+            child = self._reap_child()
+            if child is None:
+                eventlet.sleep(0.5)
+                continue
+            server, started = child
+            # NOTE: don't fork in a tight loop if workers die at start
+            if time.time() - started < 1:
+                eventlet.sleep(1)
+            if self._running:
+                self._start_child(server)
+        self.stop()
+
+    def _handle_signal(self, signo, frame):
+        LOG.info(_('Caught signal %d, stopping workers'), signo)
+        self._running = False
+
+    def stop(self):
+        """Stop the workers, killing those that don't exit in time.
+
+        :returns: None
+
+        """
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+        deadline = time.time() + FLAGS.worker_shutdown_timeout + 5
+        while self._children and time.time() < deadline:
+            if self._reap_child() is None:
+                eventlet.sleep(0.1)
+        for pid in self._children:
+            LOG.warn(_('Killing worker %d'), pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                pass
+        self._children = {}
+
+
 class Service(object):
     """Service object for binaries running on hosts.
 
@@ -294,11 +452,21 @@ class WSGIService(object):
         self.app = self.loader.load_app(name)
         self.host = getattr(FLAGS, '%s_listen' % name, "0.0.0.0")
         self.port = getattr(FLAGS, '%s_listen_port' % name, 0)
+        self.workers = getattr(FLAGS, '%s_workers' % name, 0)
         self.server = wsgi.Server(name,
                                   self.app,
                                   host=self.host,
                                   port=self.port)
 
+    def listen(self):
+        """Open the listening socket without serving requests yet.
+
+        :returns: None
+
+        """
+        self.server.listen()
+        self.port = self.server.port
+
     def start(self):
         """Start serving this service using loaded configuration.
 
@@ -319,6 +487,14 @@ class WSGIService(object):
         """
         self.server.stop()
 
+    def drain(self, timeout):
+        """Wait for requests in progress to finish after stop().
+
+        :returns: None
+
+        """
+        self.server.drain(timeout)
+
     def wait(self):
         """Wait for the service to stop serving this API.
 
@@ -337,7 +513,10 @@ _launcher = None
 def serve(*servers):
     global _launcher
     if not _launcher:
-        _launcher = Launcher()
+        if [server for server in servers if getattr(server, 'workers', 0)]:
+            _launcher = ProcessLauncher()
+        else:
+            _launcher = Launcher()
     for server in servers:
         _launcher.launch_server(server)
 
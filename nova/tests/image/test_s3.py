@@ -15,9 +15,16 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import base64
+import binascii
+import cStringIO
 import os
+import tarfile
+
+import eventlet
 
 from nova import context
+from nova import crypto
 from nova import exception
 from nova import test
 from nova.image import s3
@@ -55,6 +62,45 @@ ami_manifest_xml = """<?xml version="1.0" ?>
 </manifest>
 """
 
+bundle_manifest_xml = """<?xml version="1.0" ?>
+<manifest>
+        <machine_configuration>
+                <architecture>x86_64</architecture>
+        </machine_configuration>
+        <image>
+                <ec2_encrypted_key>%(key)s</ec2_encrypted_key>
+                <ec2_encrypted_iv>%(iv)s</ec2_encrypted_iv>
+                <parts count="%(count)d">
+%(parts)s
+                </parts>
+        </image>
+</manifest>
+"""
+
+
+class FakeKey(object):
+    def __init__(self, data):
+        self.data = data
+
+    def get_contents_as_string(self):
+        return self.data
+
+
+class FakeBucket(object):
+    def __init__(self, keys):
+        self.keys = keys
+
+    def get_key(self, name):
+        return FakeKey(self.keys[name])
+
+
+class FakeConnection(object):
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def get_bucket(self, name):
+        return self.bucket
+
 
 class TestS3ImageService(test.TestCase):
     def setUp(self):
@@ -116,10 +162,104 @@ class TestS3ImageService(test.TestCase):
              'no_device': True}]
         self.assertEqual(block_device_mapping, expected_bdm)
 
+    def _untar(self, filename):
+        with open(os.path.join(os.path.dirname(__file__), filename)) as f:
+            return list(s3.S3ImageService._untar_chunks([f.read()]))
+
     def test_s3_malicious_tarballs(self):
-        self.assertRaises(exception.Error,
-            self.image_service._test_for_malicious_tarball,
-            "/unused", os.path.join(os.path.dirname(__file__), 'abs.tar.gz'))
-        self.assertRaises(exception.Error,
-            self.image_service._test_for_malicious_tarball,
-            "/unused", os.path.join(os.path.dirname(__file__), 'rel.tar.gz'))
+        self.assertRaises(exception.Error, self._untar, 'abs.tar.gz')
+        self.assertRaises(exception.Error, self._untar, 'rel.tar.gz')
+
+    def test_fetch_parts_keeps_manifest_order(self):
+        self.flags(s3_image_download_workers=3)
+        names = ['part.%d' % i for i in xrange(10)]
+        bucket = FakeBucket(dict((name, name) for name in names))
+
+        def download_part(bucket, filename):
+            # finish later parts first
+            eventlet.sleep(0.001 * (10 - int(filename.split('.')[1])))
+            return bucket.get_key(filename).get_contents_as_string()
+
+        self.stubs.Set(s3.S3ImageService, '_download_part',
+                       staticmethod(download_part))
+        parts = list(self.image_service._fetch_parts(bucket, names))
+        self.assertEqual(parts, names)
+
+    def test_chunk_reader(self):
+        reader = s3._ChunkReader(['abc', '', 'defgh', 'i'])
+        self.assertEqual(reader.read(2), 'ab')
+        self.assertEqual(reader.read(4), 'cdef')
+        self.assertEqual(reader.read(), 'ghi')
+        self.assertEqual(reader.read(1), '')
+
+    def _make_bundle(self, image_data, part_size):
+        tar_data = cStringIO.StringIO()
+        tar_file = tarfile.open(fileobj=tar_data, mode='w:gz')
+        info = tarfile.TarInfo('image')
+        info.size = len(image_data)
+        tar_file.addfile(info, cStringIO.StringIO(image_data))
+        tar_file.close()
+
+        key = os.urandom(16)
+        iv = os.urandom(16)
+        encrypt = crypto.encryptor(base64.b64encode(key),
+                                   base64.b64encode(iv))
+        encrypted = base64.b64decode(encrypt(tar_data.getvalue()))
+        parts = {}
+        for i in xrange(0, len(encrypted), part_size):
+            parts['image.part.%d' % i] = encrypted[i:i + part_size]
+        # NOTE: the fake cloud key "encrypts" the hex key by identity
+        manifest = bundle_manifest_xml % {
+            'key': binascii.b2a_hex(binascii.b2a_hex(key)),
+            'iv': binascii.b2a_hex(binascii.b2a_hex(iv)),
+            'count': len(parts),
+            'parts': '\n'.join('<part><filename>%s</filename></part>' % name
+                               for name in sorted(parts,
+                                   key=lambda n: int(n.split('.')[-1])))}
+        parts['image.manifest.xml'] = manifest
+        return parts
+
+    def _register(self, bundle):
+        states = []
+        uploaded = []
+        service = self.image_service.service
+        real_update = service.update
+
+        def fake_update(context, image_id, metadata, data=None):
+            if data is None:
+                states.append(metadata['properties']['image_state'])
+            else:
+                uploaded.append(data.read())
+            return real_update(context, image_id, metadata)
+
+        self.stubs.Set(service, 'update', fake_update)
+        self.stubs.Set(self.image_service, '_conn',
+                       lambda context: FakeConnection(FakeBucket(bundle)))
+        self.stubs.Set(s3.S3ImageService, '_decrypt_key',
+                       staticmethod(lambda encrypted, pk: (encrypted, '')))
+        self.stubs.Set(eventlet, 'spawn_n', lambda func: func())
+        self.stubs.Set(crypto, 'key_path', lambda project_id: 'fake_pk')
+
+        metadata = {'properties': {'image_location':
+                                       'bucket/image.manifest.xml'}}
+        self.image_service.create(self.context, metadata)
+        return states, uploaded
+
+    def test_s3_create_streams_bundle(self):
+        self.flags(s3_image_chunk_size=1000)
+        image_data = os.urandom(100000)
+        states, uploaded = self._register(self._make_bundle(image_data,
+                                                            4096))
+        self.assertEqual(uploaded, [image_data])
+        self.assertEqual(states, ['downloading', 'decrypting', 'untarring',
+                                  'uploading', 'available'])
+
+    def test_s3_create_reports_failed_stage(self):
+        bundle = self._make_bundle(os.urandom(1000), 4096)
+        # a truncated, unpadded ciphertext cannot be decrypted
+        for name in bundle:
+            if name.startswith('image.part'):
+                bundle[name] = bundle[name][:-1]
+        states, uploaded = self._register(bundle)
+        self.assertEqual(uploaded, [])
+        self.assertEqual(states[-1], 'failed_decrypt')
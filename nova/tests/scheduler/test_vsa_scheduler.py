@@ -639,3 +639,58 @@ class VsaSchedulerTestCaseMostAvail(VsaSchedulerTestCase):
                                             ['NumFreePartitions'], 0)
             self.assertEqual(prev_dtype['PartitionDrive']
                                             ['PartitionSize'], 0)
+
+
+class HostIndexTestCase(test.TestCase):
+
+    def _qos_values(self, free_drives):
+        drive_capacity = vsa_sched.GB_TO_BYTES(100)
+        return {'TotalCapacity': 10 * drive_capacity,
+                'AvailableCapacity': free_drives * drive_capacity,
+                'FullDrive': {'NumFreeDrives': free_drives,
+                              'NumOccupiedDrives': 10 - free_drives}}
+
+    def _index(self, free_drives):
+        hosts = []
+        for i, free in enumerate(free_drives):
+            qos_values = self._qos_values(free)
+            hosts.append(('host_%d' % i, {'name_0': qos_values}, qos_values))
+        return vsa_sched.HostIndex(hosts)
+
+    def _ordered(self, index, key):
+        return [host for host, _capabilities, _qos_values
+                in index.ordered(key)]
+
+    def test_iterates_in_service_states_order(self):
+        index = self._index([3, 5, 1])
+        self.assertEqual(['host_0', 'host_1', 'host_2'],
+                         [host for host, _capabilities in index])
+        self.assertEqual(3, len(index))
+
+    def test_ordered_by_key(self):
+        index = self._index([3, 5, 1, 5])
+        self.assertEqual(['host_1', 'host_3', 'host_0', 'host_2'],
+                         self._ordered(index, vsa_sched._most_free_drives))
+        self.assertEqual(['host_1', 'host_3', 'host_0', 'host_2'],
+                         self._ordered(index,
+                                       vsa_sched._most_available_capacity))
+        self.assertEqual(['host_1', 'host_3', 'host_0', 'host_2'],
+                         self._ordered(index, vsa_sched._used_capacity))
+
+    def test_changed_moves_consumed_host(self):
+        index = self._index([3, 5, 1, 5])
+        _host, _capabilities, qos_values = list(index.ordered(
+                                    vsa_sched._most_free_drives))[0]
+        for i in range(3):
+            qos_values['FullDrive']['NumFreeDrives'] -= 1
+            index.changed(qos_values)
+
+        self.assertEqual(['host_3', 'host_0', 'host_1', 'host_2'],
+                         self._ordered(index, vsa_sched._most_free_drives))
+
+    def test_changed_ignores_other_qos_groups(self):
+        index = self._index([3, 5])
+        self._ordered(index, vsa_sched._most_free_drives)
+        index.changed(self._qos_values(0))
+        self.assertEqual(['host_1', 'host_0'],
+                         self._ordered(index, vsa_sched._most_free_drives))
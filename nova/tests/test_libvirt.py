@@ -16,6 +16,8 @@
 
 import copy
 import eventlet
+import gzip
+import StringIO
 import mox
 import os
 import re
@@ -35,8 +37,13 @@ from nova import utils
 from nova.api.ec2 import cloud
 from nova.compute import power_state
 from nova.compute import vm_states
+from nova.virt import images
 from nova.virt.libvirt import connection
+from nova.virt.libvirt import events
 from nova.virt.libvirt import firewall
+from nova.virt.libvirt import image
+from nova.virt.libvirt import incremental
+from nova.virt.libvirt import inventory
 
 libvirt = None
 FLAGS = flags.FLAGS
@@ -185,6 +192,389 @@ class CacheConcurrencyTestCase(test.TestCase):
             eventlet.sleep(0)
 
 
+class DomainStateTableTestCase(test.TestCase):
+
+    def setUp(self):
+        super(DomainStateTableTestCase, self).setUp()
+        self.table = events.DomainStateTable()
+        self.seen = []
+
+    def _wait_for(self, expected):
+        def callback(state):
+            self.seen.append(state)
+            return state == expected
+        return callback
+
+    def test_watch_woken_by_update(self):
+        done = self.table.watch('instance-1',
+                                self._wait_for(power_state.RUNNING))
+        self.assertFalse(done.ready())
+        self.table.update('instance-1', power_state.SHUTOFF)
+        self.assertFalse(done.ready())
+        self.table.update('instance-1', power_state.RUNNING)
+        self.assertTrue(done.wait())
+        self.assertEqual([None, power_state.SHUTOFF, power_state.RUNNING],
+                         self.seen)
+
+        # NOTE: finished watches are not called again
+        self.table.update('instance-1', power_state.PAUSED)
+        self.assertEqual(3, len(self.seen))
+
+    def test_watch_uses_known_state(self):
+        self.table.update('instance-1', power_state.RUNNING)
+        done = self.table.watch('instance-1',
+                                self._wait_for(power_state.RUNNING))
+        self.assertTrue(done.wait())
+
+    def test_watch_for_removal(self):
+        self.table.update('instance-1', power_state.RUNNING)
+        done = self.table.watch('instance-1', self._wait_for(None))
+        self.table.update('instance-1', None)
+        self.assertTrue(done.wait())
+        self.assertFalse('instance-1' in self.table.states)
+
+    def test_watch_timeout(self):
+        done = self.table.watch('instance-1',
+                                self._wait_for(power_state.RUNNING),
+                                timeout=0.01)
+        self.assertFalse(done.wait())
+        self.table.update('instance-1', power_state.RUNNING)
+        self.assertEqual([None], self.seen)
+
+    def test_register_loads_states(self):
+        class FakeDomain(object):
+            def name(self):
+                return 'instance-1'
+
+            def info(self):
+                return [power_state.RUNNING, 0, 0, 0, 0]
+
+        class FakeConnection(object):
+            def domainEventRegisterAny(self, dom, event_id, cb, opaque):
+                pass
+
+            def listDomainsID(self):
+                return [1]
+
+            def lookupByID(self, domain_id):
+                return FakeDomain()
+
+            def listDefinedDomains(self):
+                return ['instance-2']
+
+        class FakeLibvirt(object):
+            VIR_DOMAIN_EVENT_ID_LIFECYCLE = 0
+            libvirtError = Exception
+
+        self.stubs.Set(events, 'libvirt', FakeLibvirt)
+        self.table.update('instance-3', power_state.RUNNING)
+        self.table.register(FakeConnection())
+        self.assertTrue(self.table.running)
+        self.assertEqual({'instance-1': power_state.RUNNING,
+                          'instance-2': power_state.SHUTOFF},
+                         self.table.states)
+
+
+class DomainInventoryTestCase(test.TestCase):
+
+    domain_xml = ("<domain type='kvm'><name>instance-0000000a</name>"
+                  "<uuid>fake-uuid</uuid><memory>524288</memory>"
+                  "<vcpu>2</vcpu><devices>"
+                  "<disk type='file'><driver name='qemu' type='qcow2'/>"
+                  "<source file='/test/disk'/>"
+                  "<target dev='vda' bus='virtio'/></disk>"
+                  "<disk type='block'><driver name='qemu' type='raw'/>"
+                  "<source dev='/dev/sdb'/>"
+                  "<target dev='vdb' bus='virtio'/></disk>"
+                  "<interface type='bridge'><target dev='vnet0'/>"
+                  "</interface></devices></domain>")
+
+    class FakeDomain(object):
+
+        def __init__(self, xml):
+            self.xml = xml
+            self.xml_calls = 0
+
+        def UUIDString(self):
+            return 'fake-uuid'
+
+        def XMLDesc(self, flags):
+            self.xml_calls += 1
+            return self.xml
+
+    def setUp(self):
+        super(DomainInventoryTestCase, self).setUp()
+        self.inventory = inventory.DomainInventory()
+        self.domain = self.FakeDomain(self.domain_xml)
+
+    def test_parse_domain_xml(self):
+        info = inventory.parse_domain_xml(self.domain_xml)
+        self.assertEqual('instance-0000000a', info['name'])
+        self.assertEqual(2, info['vcpus'])
+        self.assertEqual(524288, info['memory'])
+        self.assertEqual(['vnet0'], info['interfaces'])
+        self.assertEqual([('file', 'vda', '/test/disk', 'qcow2'),
+                          ('block', 'vdb', '/dev/sdb', 'raw')],
+                         [(disk['type'], disk['target'], disk['source'],
+                           disk['driver_type']) for disk in info['disks']])
+        disk = xml_to_tree(info['disks'][1]['xml'])
+        self.assertEqual('vdb', disk.find('target').get('dev'))
+
+    def test_description_is_cached_until_invalidated(self):
+        self.inventory.get(self.domain)
+        self.inventory.get(self.domain)
+        self.assertEqual(1, self.domain.xml_calls)
+        self.assertEqual(2, self.inventory.get_cached(
+                                'instance-0000000a')['vcpus'])
+
+        self.inventory.invalidate(self.domain)
+        self.assertEqual(None,
+                         self.inventory.get_cached('instance-0000000a'))
+        self.inventory.get(self.domain)
+        self.assertEqual(2, self.domain.xml_calls)
+
+    def test_unparsable_description_is_not_cached(self):
+        domain = self.FakeDomain('<domain')
+        self.assertEqual([], self.inventory.get(domain)['disks'])
+        self.inventory.get(domain)
+        self.assertEqual(2, domain.xml_calls)
+
+
+class LvmThinImageTestCase(test.TestCase):
+
+    def setUp(self):
+        super(LvmThinImageTestCase, self).setUp()
+        self.flags(local_images_type='lvm-thin',
+                   lvm_volume_group='vg',
+                   lvm_thin_pool='pool')
+        self.commands = []
+        self.existing = set()
+
+        def fake_execute(*cmd, **kwargs):
+            self.commands.append(cmd)
+            return '', ''
+
+        self.stubs.Set(utils, 'execute', fake_execute)
+        self.stubs.Set(os.path, 'exists',
+                       lambda path: path in self.existing)
+        self.stubs.Set(images, 'virtual_size', lambda path: 1024)
+        driver = image.select_driver()
+        self.image = driver.create_image('instance-00000001', 'disk')
+
+    def test_create_from_raw_copies_base_once(self):
+        self.image.create_from_raw('/base/abcdef')
+        self.assertEqual([
+            ('lvcreate', '-T', 'vg/pool', '-V', '1024b',
+             '-n', 'base-abcdef-tmp'),
+            ('qemu-img', 'convert', '/base/abcdef', '-O', 'raw',
+             '/dev/vg/base-abcdef-tmp'),
+            ('lvrename', 'vg', 'base-abcdef-tmp', 'base-abcdef'),
+            ('lvcreate', '-s', '-kn', '-n', 'instance-00000001-disk',
+             'vg/base-abcdef')], self.commands)
+
+        self.commands = []
+        self.existing.add('/dev/vg/base-abcdef')
+        self.image.create_from_raw('/base/abcdef', 4096)
+        self.assertEqual([
+            ('lvcreate', '-s', '-kn', '-n', 'instance-00000001-disk',
+             'vg/base-abcdef'),
+            ('lvresize', '-f', '-L', '4096b',
+             '/dev/vg/instance-00000001-disk'),
+            ('e2fsck', '-fp', '/dev/vg/instance-00000001-disk'),
+            ('resize2fs', '/dev/vg/instance-00000001-disk')], self.commands)
+
+    def test_create_clean_allocates_from_pool(self):
+        self.image.create_clean(2048)
+        self.assertEqual([('lvcreate', '-T', 'vg/pool', '-V', '2048b',
+                           '-n', 'instance-00000001-disk')], self.commands)
+
+
+class SnapshotStreamTestCase(test.TestCase):
+
+    def setUp(self):
+        super(SnapshotStreamTestCase, self).setUp()
+        self.flags(root_helper='')
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'snapshot')
+        with open(self.path, 'wb') as snapshot:
+            snapshot.write('data' + '\0' * 2 * image.CHUNK_SIZE + 'end')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        super(SnapshotStreamTestCase, self).tearDown()
+
+    def _read_all(self, stream):
+        chunks = []
+        try:
+            while True:
+                chunk = stream.read(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            stream.close()
+        return ''.join(chunks)
+
+    def test_stream_command_output(self):
+        stream = image._ProcessStream(('cat', self.path))
+        self.assertEqual(open(self.path).read(), self._read_all(stream))
+
+    def test_stream_compressed(self):
+        stream = image._ProcessStream(('cat', self.path), compress=True)
+        data = self._read_all(stream)
+        self.assertTrue(len(data) < image.CHUNK_SIZE / 100)
+
+        compressed_path = os.path.join(self.temp_dir, 'compressed')
+        with open(compressed_path, 'wb') as compressed:
+            compressed.write(data)
+        unpacked = gzip.open(compressed_path)
+        self.assertEqual(open(self.path).read(), unpacked.read())
+        unpacked.close()
+
+    def test_failed_command_fails_read(self):
+        stream = image._ProcessStream(('cat', self.path + '.missing'))
+        self.assertRaises(exception.ProcessExecutionError,
+                          self._read_all, stream)
+
+    def test_stream_runs_through_root_helper(self):
+        self.flags(root_helper='false')
+        stream = image._ProcessStream(('cat', self.path))
+        self.assertRaises(exception.ProcessExecutionError,
+                          self._read_all, stream)
+
+    def test_sparse_file_skips_zeros(self):
+        target = os.path.join(self.temp_dir, 'target')
+        with open(target, 'wb') as image_file:
+            sparse_file = images.SparseFile(image_file)
+            sparse_file.write('data')
+            sparse_file.write('\0' * image.CHUNK_SIZE)
+            sparse_file.write('\0' * image.CHUNK_SIZE)
+            sparse_file.finish()
+        self.assertEqual('data' + '\0' * 2 * image.CHUNK_SIZE,
+                         open(target).read())
+        self.assertTrue(os.stat(target).st_blocks * 512 < image.CHUNK_SIZE)
+
+
+class IncrementalSnapshotTestCase(test.TestCase):
+
+    class FakeImageService(object):
+
+        def __init__(self):
+            self.images = {}
+
+        def show(self, context, image_id):
+            return self.images[image_id][0]
+
+        def get(self, context, image_id, data):
+            data.write(self.images[image_id][1])
+
+        def create(self, context, metadata, data=None):
+            image_id = 'image-%d' % len(self.images)
+            self.images[image_id] = (dict(metadata, id=image_id),
+                                     data and data.read() or '')
+            return self.images[image_id][0]
+
+        def update(self, context, image_id, metadata, data=None):
+            old_metadata, old_data = self.images.get(image_id, ({}, ''))
+            if data is not None:
+                old_data = ''.join(iter(lambda: data.read(65536), ''))
+            self.images[image_id] = (copy.deepcopy(metadata), old_data)
+
+    def setUp(self):
+        super(IncrementalSnapshotTestCase, self).setUp()
+        self.image_service = self.FakeImageService()
+        self.temp_dir = tempfile.mkdtemp()
+        self.flags(instances_path=self.temp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        super(IncrementalSnapshotTestCase, self).tearDown()
+
+    def _snapshot(self, image_id, volume, parent_id=None):
+        parent_hashes = None
+        if parent_id is not None:
+            parent_hashes = incremental.fetch_manifest(None,
+                self.image_service,
+                self.image_service.show(None, parent_id)['properties'])
+        chunks = incremental.ChangedChunks(StringIO.StringIO(volume), 4,
+                                           parent_hashes)
+        data = ''.join(iter(lambda: chunks.read(3), ''))
+        properties = {'snapshot_type': 'incremental',
+                      'chunk_size': '4',
+                      'volume_size': str(chunks.size),
+                      'manifest_id': incremental.upload_manifest(None,
+                          self.image_service, {'name': image_id},
+                          chunks.hashes)}
+        if parent_id is not None:
+            properties['parent_id'] = parent_id
+        self.image_service.images[image_id] = ({'properties': properties},
+                                               data)
+        return data
+
+    def _restore(self, image_id):
+        target = os.path.join(self.temp_dir, image_id)
+        incremental.restore(None, self.image_service, image_id, target)
+        return open(target).read()
+
+    def test_only_changed_chunks_are_stored(self):
+        volume = 'aaaa' + '\0' * 8 + 'bbbbcc'
+        self.assertEqual('aaaabbbbcc', self._snapshot('1', volume))
+
+        changed = 'aaaa' + '\0' * 4 + 'dddd' + 'bbbbce'
+        self.assertEqual('ddddce', self._snapshot('2', changed, '1'))
+        self.assertEqual('', self._snapshot('3', changed, '2'))
+
+        self.assertEqual(volume, self._restore('1'))
+        self.assertEqual(changed, self._restore('2'))
+        self.assertEqual(changed, self._restore('3'))
+
+    def test_zeroed_chunk_is_restored_as_zeros(self):
+        self._snapshot('1', 'aaaabbbb')
+        self.assertEqual('', self._snapshot('2', 'aaaa\0\0\0\0', '1'))
+        self.assertEqual('aaaa\0\0\0\0', self._restore('2'))
+
+    def test_manifest_of_large_volume_is_not_a_property(self):
+        # NOTE: a 500 GB volume of 64 MB chunks, every chunk changed
+        self.flags(incremental_snapshot_chunk_size=64 * 1024 * 1024)
+        hashes = [os.urandom(len(incremental.ZERO_CHUNK))
+                  for _i in xrange(500 * 16)]
+
+        class FakeChunks(object):
+
+            def __init__(self, source, chunk_size, parent_hashes=None):
+                self.chunk_size = chunk_size
+                self.hashes = hashes
+                self.size = len(hashes) * chunk_size
+                self.changed = len(hashes)
+
+            def read(self, size=-1):
+                return ''
+
+        self.stubs.Set(incremental, 'ChangedChunks', FakeChunks)
+        self.image_service.images['snap'] = ({}, '')
+        os.mkdir(os.path.join(self.temp_dir, 'instance-1'))
+        conn = connection.LibvirtConnection(True)
+        conn._upload_incremental_snapshot(None, self.image_service,
+                                          {'name': 'snap', 'properties': {}},
+                                          'snap', {'name': 'instance-1'},
+                                          'volume-1', None)
+
+        properties = self.image_service.show(None, 'snap')['properties']
+        # NOTE: Glance sends every property as an HTTP header line, which
+        #       the wsgi server limits to 8 KB.
+        for key, value in properties.iteritems():
+            self.assertTrue(len('x-image-meta-property-%s: %s' %
+                                (key, value)) < 1024)
+        self.assertEqual(hashes, incremental.fetch_manifest(None,
+                self.image_service, properties))
+
+    def test_corrupt_chunk_fails_restore(self):
+        self._snapshot('1', 'aaaabbbb')
+        properties = self.image_service.images['1'][0]
+        self.image_service.images['1'] = (properties, 'aaaabbbc')
+        self.assertRaises(exception.Error, self._restore, '1')
+
+
 class LibvirtConnTestCase(test.TestCase):
 
     def setUp(self):
@@ -305,6 +695,35 @@ class LibvirtConnTestCase(test.TestCase):
                                         False)
         self.assertTrue(len(result['nics']) == 2)
 
+    def test_render_template_compiles_once(self):
+        connection._late_load_cheetah()
+        source = '<vcpu>${vcpus}</vcpu>'
+        self.stubs.Set(connection, '_template_classes', {})
+
+        self.assertEqual('<vcpu>1</vcpu>',
+                         connection._render_template(source, [{'vcpus': 1}]))
+        template_class = connection._template_classes[source]
+        self.assertEqual('<vcpu>2</vcpu>',
+                         connection._render_template(source, [{'vcpus': 2}]))
+        self.assertTrue(connection._template_classes[source] is
+                        template_class)
+
+    def test_snapshot_cache_name_is_shared(self):
+        self.flags(image_service='nova.image.fake.FakeImageService')
+        image_service = utils.import_object(FLAGS.image_service)
+        conn = connection.LibvirtConnection(True)
+
+        fname = conn._snapshot_cache_name(self.context, '2')
+        self.assertEqual(fname, conn._snapshot_cache_name(self.context, '2'))
+        self.assertNotEqual(fname,
+                            conn._snapshot_cache_name(self.context, '3'))
+
+        image_meta = image_service.show(self.context, '2')
+        image_meta['checksum'] = 'abcdef'
+        image_service.update(self.context, '2', image_meta)
+        self.assertEqual(fname + '-abcdef',
+                         conn._snapshot_cache_name(self.context, '2'))
+
     def test_xml_and_uri_no_ramdisk_no_kernel(self):
         instance_data = dict(self.test_instance)
         self._check_xml_and_uri(instance_data,
@@ -884,6 +1303,8 @@ class LibvirtConnTestCase(test.TestCase):
 
         # Preparing mocks
         vdmock = self.mox.CreateMock(libvirt.virDomain)
+        self.mox.StubOutWithMock(vdmock, "UUIDString")
+        vdmock.UUIDString().AndReturn('fake-uuid')
         self.mox.StubOutWithMock(vdmock, "XMLDesc")
         vdmock.XMLDesc(0).AndReturn(dummyxml)
 
@@ -21,16 +21,21 @@ Unittets for S3 objectstore clone.
 """
 
 import boto
+import hashlib
 import os
+import re
 import shutil
 import tempfile
+import time
 
 from boto import exception as boto_exception
 from boto.s3 import connection as s3
+import webob
 
 from nova import flags
 from nova import wsgi
 from nova import test
+from nova.objectstore import bucket_index
 from nova.objectstore import s3server
 
 
@@ -128,6 +133,31 @@ class S3APITestCase(test.TestCase):
 
         self._ensure_no_buckets(bucket.get_all_keys())
 
+    def test_list_keys_with_prefix_and_marker(self):
+        bucket = self.conn.create_bucket('testbucket')
+        for name in ('a1', 'a2', 'a3', 'b1', 'c'):
+            bucket.new_key(name).set_contents_from_string(name * 2)
+
+        keys = bucket.get_all_keys(prefix='a')
+        self.assertEquals([k.name for k in keys], ['a1', 'a2', 'a3'])
+        self.assertEquals([k.size for k in keys], [4, 4, 4])
+
+        keys = bucket.get_all_keys(prefix='a', marker='a1', maxkeys=1)
+        self.assertEquals([k.name for k in keys], ['a2'])
+        self.assertTrue(keys.is_truncated)
+
+        bucket.delete_key('a2')
+        keys = bucket.get_all_keys(marker='a1')
+        self.assertEquals([k.name for k in keys], ['a3', 'b1', 'c'])
+
+    def test_index_survives_restart(self):
+        bucket = self.conn.create_bucket('testbucket')
+        bucket.new_key('somekey').set_contents_from_string('somevalue')
+        app = s3server.S3Application(FLAGS.buckets_path)
+        entries, truncated = app.bucket_index('testbucket').list()
+        self.assertEquals([e[0] for e in entries], ['somekey'])
+        self.assertEquals(entries[0][1], len('somevalue'))
+
     def test_unknown_bucket(self):
         bucket_name = 'falalala'
         self.assertRaises(boto_exception.S3ResponseError,
@@ -138,3 +168,203 @@ class S3APITestCase(test.TestCase):
         """Tear down test server."""
         self.server.stop()
         super(S3APITestCase, self).tearDown()
+
+
+class BucketIndexTestCase(test.TestCase):
+    """Test the persistent bucket key index."""
+
+    def setUp(self):
+        super(BucketIndexTestCase, self).setUp()
+        self.path = tempfile.mkdtemp(prefix='test_index-')
+        self.bucket_path = os.path.join(self.path, 'bucket')
+        os.mkdir(self.bucket_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(BucketIndexTestCase, self).tearDown()
+
+    def _index(self):
+        index = bucket_index.BucketIndex(os.path.join(self.path, 'index'),
+                                         self.bucket_path)
+        index.load()
+        return index
+
+    def _put(self, index, name, data='x'):
+        path = os.path.join(self.bucket_path, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        info = os.stat(path)
+        index.add(name, info.st_size, info.st_mtime)
+
+    def test_list(self):
+        index = self._index()
+        for name in ('b', 'a', 'ab', 'ac', 'c'):
+            self._put(index, name)
+        index.remove('ab')
+        entries, truncated = index.list(prefix='a')
+        self.assertEquals([e[0] for e in entries], ['a', 'ac'])
+        self.assertFalse(truncated)
+        entries, truncated = index.list(marker='a', max_keys=2)
+        self.assertEquals([e[0] for e in entries], ['ac', 'b'])
+        self.assertTrue(truncated)
+
+    def test_journal_is_replayed_and_compacted(self):
+        self.stubs.Set(bucket_index, 'MIN_JOURNAL_ENTRIES', 3)
+        index = self._index()
+        for i in xrange(10):
+            self._put(index, 'key%d' % i, 'x' * i)
+        os.unlink(os.path.join(self.bucket_path, 'key3'))
+        index.remove('key3')
+        self.assertTrue(index.journal_entries <= 9)
+
+        entries, _truncated = self._index().list()
+        self.assertEquals([e[0] for e in entries],
+                          ['key%d' % i for i in xrange(10) if i != 3])
+        self.assertEquals(entries[-1][1], 9)
+
+    def test_rebuild_when_stale(self):
+        index = self._index()
+        self._put(index, 'indexed')
+        # an object written behind the index's back
+        time.sleep(0.01)
+        with open(os.path.join(self.bucket_path, 'unindexed'), 'w') as f:
+            f.write('data')
+
+        entries, _truncated = self._index().list()
+        self.assertEquals([e[0] for e in entries], ['indexed', 'unindexed'])
+
+    def test_rebuild_when_corrupt(self):
+        index = self._index()
+        self._put(index, 'key')
+        with open(index.snapshot_path, 'w') as f:
+            f.write('garbage')
+        entries, _truncated = self._index().list()
+        self.assertEquals([e[0] for e in entries], ['key'])
+
+
+class ObjectStreamingTestCase(test.TestCase):
+    """Test ranged reads and multipart uploads of objects."""
+
+    def setUp(self):
+        super(ObjectStreamingTestCase, self).setUp()
+        self.path = tempfile.mkdtemp(prefix='test_oss-')
+        self.app = s3server.S3Application(self.path)
+        self.data = os.urandom(3 * s3server.CHUNK_SIZE + 17)
+        self._request('PUT', '/bucket/')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(ObjectStreamingTestCase, self).tearDown()
+
+    def _request(self, method, path, body=None, **headers):
+        request = webob.Request.blank(path)
+        request.method = method
+        request.headers.update(headers)
+        if body is not None:
+            request.body = body
+        return request.get_response(self.app)
+
+    def test_put_and_get(self):
+        response = self._request('PUT', '/bucket/key', self.data)
+        self.assertEqual(response.headers['ETag'],
+                         '"%s"' % hashlib.md5(self.data).hexdigest())
+        response = self._request('GET', '/bucket/key')
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_length, len(self.data))
+        self.assertEqual(response.body, self.data)
+        self.assertEqual(os.listdir(self.app.incoming_directory), [])
+
+    def _put_short(self, path):
+        request = webob.Request.blank(path)
+        request.method = 'PUT'
+        request.body = self.data[:1000]
+        request.headers['Content-Length'] = str(len(self.data))
+        return request.get_response(self.app)
+
+    def test_put_shorter_than_content_length(self):
+        response = self._put_short('/bucket/key')
+        self.assertEqual(response.status_int, 400)
+        self.assertTrue('<Code>IncompleteBody</Code>' in response.body)
+        self.assertEqual(self._request('GET', '/bucket/key').status_int, 404)
+        self.assertEqual(os.listdir(self.app.incoming_directory), [])
+
+    def test_get_range(self):
+        self._request('PUT', '/bucket/key', self.data)
+        response = self._request('GET', '/bucket/key', Range='bytes=10-99')
+        self.assertEqual(response.status_int, 206)
+        self.assertEqual(response.body, self.data[10:100])
+        self.assertEqual(response.headers['Content-Range'],
+                         'bytes 10-99/%d' % len(self.data))
+
+        response = self._request('GET', '/bucket/key', Range='bytes=-7')
+        self.assertEqual(response.status_int, 206)
+        self.assertEqual(response.body, self.data[-7:])
+
+        response = self._request('GET', '/bucket/key',
+                                 Range='bytes=%d-' % len(self.data))
+        self.assertEqual(response.status_int, 416)
+
+    def test_head(self):
+        self._request('PUT', '/bucket/key', self.data)
+        response = self._request('HEAD', '/bucket/key')
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_length, len(self.data))
+
+    def _initiate(self, key):
+        response = self._request('POST', '/bucket/%s?uploads' % key)
+        return re.search('<UploadId>(.*)</UploadId>', response.body).group(1)
+
+    def test_multipart_upload(self):
+        upload_id = self._initiate('big')
+        chunks = [self.data[:100000], self.data[100000:]]
+        etags = []
+        for number, chunk in enumerate(chunks):
+            response = self._request('PUT',
+                                     '/bucket/big?partNumber=%d&uploadId=%s'
+                                     % (number + 1, upload_id), chunk)
+            etags.append(response.headers['ETag'])
+        parts = ''.join('<Part><PartNumber>%d</PartNumber>'
+                        '<ETag>%s</ETag></Part>' % (number + 1, etag)
+                        for number, etag in enumerate(etags))
+        response = self._request('POST', '/bucket/big?uploadId=%s' % upload_id,
+                                 '<CompleteMultipartUpload>%s'
+                                 '</CompleteMultipartUpload>' % parts)
+        self.assertEqual(response.status_int, 200)
+        md5s = ''.join(hashlib.md5(chunk).digest() for chunk in chunks)
+        self.assertTrue('%s-2' % hashlib.md5(md5s).hexdigest()
+                        in response.body)
+
+        self.assertEqual(self._request('GET', '/bucket/big').body, self.data)
+        self.assertTrue('<Key>big</Key>'
+                        in self._request('GET', '/bucket/').body)
+        self.assertEqual(os.listdir(self.app.uploads_directory), [])
+
+    def test_multipart_upload_rejects_wrong_etag(self):
+        upload_id = self._initiate('big')
+        self._request('PUT', '/bucket/big?partNumber=1&uploadId=%s'
+                      % upload_id, self.data)
+        response = self._request('POST', '/bucket/big?uploadId=%s' % upload_id,
+                                 '<CompleteMultipartUpload><Part>'
+                                 '<PartNumber>1</PartNumber>'
+                                 '<ETag>"0000"</ETag>'
+                                 '</Part></CompleteMultipartUpload>')
+        self.assertEqual(response.status_int, 400)
+        self.assertEqual(self._request('GET', '/bucket/big').status_int, 404)
+
+    def test_short_part_is_not_kept(self):
+        upload_id = self._initiate('big')
+        response = self._put_short('/bucket/big?partNumber=1&uploadId=%s'
+                                   % upload_id)
+        self.assertEqual(response.status_int, 400)
+        self.assertEqual(os.listdir(self.app.incoming_directory), [])
+        upload_dir = os.path.join(self.app.uploads_directory, upload_id)
+        self.assertEqual(os.listdir(upload_dir), ['info'])
+
+    def test_abort_multipart_upload(self):
+        upload_id = self._initiate('big')
+        response = self._request('DELETE',
+                                 '/bucket/big?uploadId=%s' % upload_id)
+        self.assertEqual(response.status_int, 204)
+        response = self._request('PUT', '/bucket/big?partNumber=1&uploadId=%s'
+                                 % upload_id, self.data)
+        self.assertEqual(response.status_int, 404)
@@ -0,0 +1,119 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Tests for the root helper process
+"""
+
+import os
+import stat
+import sys
+import tempfile
+
+import eventlet
+
+from nova import roothelper
+from nova import test
+from nova import utils
+
+
+class RootHelperTestCase(test.TestCase):
+    """Test running commands through a root helper in this process."""
+
+    def setUp(self):
+        super(RootHelperTestCase, self).setUp()
+        self.stubs.Set(roothelper, 'COMMANDS', ['cat', 'echo', 'false'])
+        self.server = roothelper.RootHelperServer(['cat', 'echo', 'false'])
+        socket_path = self.server.listen()
+        self.server_thread = eventlet.spawn(self.server.serve)
+        self.client = roothelper.RootHelperClient()
+        self.stubs.Set(self.client, '_start', lambda: True)
+        self.client.socket_path = socket_path
+
+    def tearDown(self):
+        self.client.stop()
+        self.server_thread.kill()
+        self.server.close()
+        super(RootHelperTestCase, self).tearDown()
+
+    def test_socket_is_private(self):
+        socket_path = self.client.socket_path
+        self.assertEqual(0600, stat.S_IMODE(os.stat(socket_path).st_mode))
+        self.assertEqual(0711, stat.S_IMODE(
+                os.stat(os.path.dirname(socket_path)).st_mode))
+
+    def test_runs_allowed_command(self):
+        self.assertEqual((0, 'foo bar\n', ''),
+                         self.client.execute(['echo', 'foo', 'bar']))
+        self.assertEqual((0, 'in\0put', ''),
+                         self.client.execute(['cat'], 'in\0put'))
+        self.assertEqual(1, self.client.execute(['false'])[0])
+
+    def test_refused_command_is_run_directly(self):
+        self.stubs.Set(roothelper, 'COMMANDS',
+                       ['cat', 'echo', 'false', 'true'])
+        self.assertEqual(None, self.client.execute(['true']))
+        self.assertEqual(None, self.client.execute(['ls']))
+
+    def test_concurrent_commands(self):
+        pool = eventlet.GreenPool()
+        results = pool.imap(lambda i: self.client.execute(['echo', i]),
+                            map(str, range(10)))
+        self.assertEqual([(0, '%d\n' % i, '') for i in range(10)],
+                         list(results))
+
+
+class RootHelperStartTestCase(test.TestCase):
+    """Test starting bin/nova-root-helper."""
+
+    def test_start_and_stop(self):
+        self.flags(root_helper=sys.executable,
+                   root_helper_daemon=os.path.join(
+                       os.path.dirname(__file__), os.pardir, os.pardir,
+                       'bin', 'nova-root-helper'))
+        # NOTE: the root helper runs only its own list of commands
+        self.stubs.Set(roothelper, 'COMMANDS', ['chmod', 'echo'])
+        client = roothelper.RootHelperClient()
+        with tempfile.NamedTemporaryFile() as target:
+            try:
+                self.assertEqual((0, '', ''),
+                                 client.execute(['chmod', '640',
+                                                 target.name]))
+                self.assertEqual(None, client.execute(['echo', 'foo']))
+                socket_path = client.socket_path
+            finally:
+                client.stop()
+            self.assertEqual(0640,
+                             stat.S_IMODE(os.stat(target.name).st_mode))
+        self.assertFalse(os.path.exists(os.path.dirname(socket_path)))
+
+
+class RootHelperFallbackTestCase(test.TestCase):
+    """Test commands are run with root_helper without a root helper."""
+
+    def tearDown(self):
+        roothelper._client = None
+        super(RootHelperFallbackTestCase, self).tearDown()
+
+    def test_execute_falls_back(self):
+        self.flags(use_root_helper_daemon=True,
+                   root_helper='',
+                   root_helper_daemon='/nonexistent/nova-root-helper')
+        self.stubs.Set(roothelper, 'COMMANDS', ['echo'])
+        roothelper._client = None
+        self.assertEqual(('foo\n', ''),
+                         utils.execute('echo', 'foo', run_as_root=True))
@@ -0,0 +1,200 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Tests for the SSH connections of the SAN volume drivers
+"""
+
+import eventlet
+from eventlet.green import socket
+import paramiko
+
+from nova import exception
+from nova import flags
+from nova import test
+from nova.volume import san
+
+FLAGS = flags.FLAGS
+
+_HOST_KEY = None
+
+
+def _host_key():
+    global _HOST_KEY
+    if _HOST_KEY is None:
+        _HOST_KEY = paramiko.RSAKey.generate(1024)
+    return _HOST_KEY
+
+
+class FakeSanServer(paramiko.ServerInterface):
+    """SSH server on localhost running commands the SAN way: 'echo x'
+    prints x, 'fail' exits with 1.
+
+    It runs in greenthreads, as the paramiko threads do under the
+    monkey-patched test runner, so that stop() can end them.
+    """
+
+    def __init__(self):
+        self.commands = []
+        self.transports = []
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(5)
+        self.port = self._sock.getsockname()[1]
+        self._server_thread = eventlet.spawn(self._serve)
+
+    def _serve(self):
+        while True:
+            conn, _address = self._sock.accept()
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(_host_key())
+            transport.start_server(server=self)
+            self.transports.append(transport)
+
+    def stop(self):
+        # NOTE: closing the socket doesn't wake up a greenthread waiting
+        #       in accept(), which would then take the connections to the
+        #       next server listening on the same file descriptor.
+        self._server_thread.kill()
+        self._sock.close()
+        for transport in self.transports:
+            transport.close()
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        self.commands.append(command)
+        # NOTE: the reply to the request is sent once this returns, and a
+        #       channel closed before that fails the request.
+        eventlet.spawn_after(0.05, self._run, channel, command)
+        return True
+
+    def _run(self, channel, command):
+        if command.startswith('echo '):
+            channel.sendall(command[len('echo '):] + '\n')
+            channel.send_exit_status(0)
+        else:
+            channel.sendall_stderr('%s: failed\n' % command)
+            channel.send_exit_status(1)
+        channel.close()
+
+
+class SSHPoolTestCase(test.TestCase):
+    """Test case for the SSH connections to the SAN"""
+
+    def setUp(self):
+        super(SSHPoolTestCase, self).setUp()
+        self.server = FakeSanServer()
+        self.connections = []
+        self.pool = san.SSHPool(self._connect, 2)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+        super(SSHPoolTestCase, self).tearDown()
+
+    def _connect(self):
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect('127.0.0.1', port=self.server.port, username='admin',
+                    password='secret', look_for_keys=False,
+                    allow_agent=False)
+        self.connections.append(ssh)
+        return ssh
+
+    def test_connection_is_reused(self):
+        for word in ('a', 'b', 'c'):
+            self.assertEqual([('%s\n' % word, '')],
+                             self.pool.execute(['echo %s' % word]))
+        self.assertEqual(1, len(self.connections))
+        self.assertEqual(['echo a', 'echo b', 'echo c'],
+                         self.server.commands)
+
+    def test_commands_are_pipelined(self):
+        self.assertEqual([('a\n', ''), ('b\n', ''), ('c\n', '')],
+                         self.pool.execute(['echo a', 'echo b', 'echo c']))
+        self.assertEqual(1, len(self.connections))
+
+    def test_failed_command_keeps_connection(self):
+        self.assertRaises(exception.ProcessExecutionError,
+                          self.pool.execute, ['fail'])
+        self.assertEqual([('', 'fail: failed\n')],
+                         self.pool.execute(['fail'], check_exit_code=False))
+        self.assertEqual(1, len(self.connections))
+
+    def test_exit_code_checked_per_command(self):
+        self.assertEqual([('', 'fail: failed\n'), ('a\n', '')],
+                         self.pool.execute(['fail', 'echo a'],
+                                           check_exit_code=[False, True]))
+        self.assertRaises(exception.ProcessExecutionError,
+                          self.pool.execute, ['fail', 'echo a'],
+                          check_exit_code=[True, False])
+
+    def test_broken_connection_is_replaced(self):
+        self.pool.execute(['echo a'])
+        # NOTE: the connection is still in the pool, but the SAN dropped it
+        self.connections[0].get_transport().sock.close()
+        self.assertEqual([('b\n', '')], self.pool.execute(['echo b']))
+        self.assertEqual(2, len(self.connections))
+
+    def test_idle_connection_is_closed(self):
+        self.flags(san_ssh_idle_timeout=0)
+        self.pool.execute(['echo a'])
+        self.pool.execute(['echo b'])
+        self.assertEqual(2, len(self.connections))
+        # NOTE: closed clients drop their transport
+        self.assertEqual(None, self.connections[0].get_transport())
+
+
+class SolarisISCSIDriverTestCase(test.TestCase):
+    """Test case for the SSH commands of the Solaris SAN driver"""
+
+    def setUp(self):
+        super(SolarisISCSIDriverTestCase, self).setUp()
+        self.flags(iscsi_target_prefix='iqn.test:')
+        self.driver = san.SolarisISCSIDriver()
+        self.batches = []
+        self.stubs.Set(self.driver._ssh_pool, 'execute', self._execute)
+
+    def _execute(self, commands, check_exit_code=True):
+        self.batches.append(commands)
+        return [self._output(command) for command in commands]
+
+    def _output(self, command):
+        if 'list-lu' in command:
+            return ('600144f0\n', '')
+        if 'list-view' in command:
+            return ('View Entry: 0\n', '')
+        if 'list-target' in command:
+            return ('iqn.test:volume-1\n', '')
+        if 'list-tg' in command:
+            return ('Target group: tg-other\n', '')
+        return ('', '')
+
+    def test_remove_export_checks_in_one_batch(self):
+        self.driver.remove_export(None, {'name': 'volume-1'})
+        self.assertEqual(3, len(self.batches[1]))
+        self.assertEqual(['remove-view', 'offline-target', 'delete-target',
+                          'delete-tg', 'delete-lu'],
+                         [batch[0].split()[2] for batch in self.batches[2:]])
@@ -194,6 +194,15 @@ class TestWSGIService(test.TestCase):
         self.assertNotEqual(0, test_service.port)
         test_service.stop()
 
+    def test_service_listen_before_start(self):
+        test_service = service.WSGIService("test_service")
+        test_service.listen()
+        port = test_service.port
+        self.assertNotEqual(0, port)
+        test_service.start()
+        self.assertEqual(port, test_service.port)
+        test_service.stop()
+
 
 class TestLauncher(test.TestCase):
 
@@ -208,3 +217,12 @@ class TestLauncher(test.TestCase):
         launcher.launch_server(self.service)
         self.assertEquals(0, self.service.port)
         launcher.stop()
+
+    def test_serve_picks_process_launcher_for_workers(self):
+        self.stubs.Set(service, '_launcher', None)
+        self.service.workers = 2
+        service.serve(self.service)
+        self.assertTrue(isinstance(service._launcher,
+                                   service.ProcessLauncher))
+        self.assertNotEqual(0, self.service.port)
+        self.service.server._socket.close()
@@ -0,0 +1,117 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+import tempfile
+
+import webob
+import webob.dec
+
+from nova import context
+from nova import test
+from nova import trace
+
+
+class TraceTestCase(test.TestCase):
+
+    def setUp(self):
+        super(TraceTestCase, self).setUp()
+        self.flags(trace_requests=True)
+
+    def test_nothing_traced_when_disabled(self):
+        self.flags(trace_requests=False)
+        self.assertEqual(None, trace.start('req-1', 'test'))
+        with trace.span('db', 'instance_get') as record:
+            self.assertEqual(None, record)
+        app = object()
+        self.assertTrue(trace.wrap_application('App', app) is app)
+
+    def test_nested_spans(self):
+        request_trace = trace.start('req-1', 'test')
+        self.assertTrue(trace.current() is request_trace)
+        with trace.span('wsgi', 'Outer'):
+            with trace.span('rpc', 'compute.run_instance', type='cast'):
+                pass
+        trace.finish(request_trace)
+        self.assertEqual(None, trace.current())
+
+        outer, inner = request_trace.spans
+        self.assertEqual(('wsgi', 'Outer', 0),
+                         (outer['kind'], outer['name'], outer['depth']))
+        self.assertEqual(('rpc', 'compute.run_instance', 1, 'cast'),
+                         (inner['kind'], inner['name'], inner['depth'],
+                          inner['type']))
+        self.assertTrue(outer['duration'] >= inner['duration'])
+        self.assertNotEqual(None, request_trace.duration)
+
+    def test_db_decorator_counts_rows(self):
+        decorated = trace.db_decorator('nova.db.api.instance_get_all',
+                                       lambda context: [1, 2, 3])
+        request_trace = trace.start('req-1', 'test')
+        self.assertEqual([1, 2, 3], decorated(None))
+        trace.finish(request_trace)
+        span, = request_trace.spans
+        self.assertEqual(('db', 'instance_get_all', 3),
+                         (span['kind'], span['name'], span['rows']))
+
+    def test_trace_file(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.flags(trace_file=path)
+        try:
+            request_trace = trace.start('req-1', 'test')
+            with trace.span('db', 'instance_get'):
+                pass
+            trace.finish(request_trace)
+
+            with open(path) as trace_file:
+                lines = trace_file.readlines()
+        finally:
+            os.unlink(path)
+        self.assertEqual(1, len(lines))
+        record = json.loads(lines[0])
+        self.assertEqual('req-1', record['request_id'])
+        self.assertEqual(['instance_get'],
+                         [span['name'] for span in record['spans']])
+
+    def test_wrapped_application_traces_request(self):
+        traces = []
+        real_finish = trace.finish
+
+        def fake_finish(request_trace):
+            traces.append(request_trace)
+            real_finish(request_trace)
+
+        self.stubs.Set(trace, 'finish', fake_finish)
+        ctxt = context.RequestContext('fake', 'fake')
+
+        @webob.dec.wsgify
+        def inner(req):
+            req.environ['nova.context'] = ctxt
+            return 'ok'
+
+        app = trace.wrap_application('Outer',
+                                     trace.wrap_application('Inner', inner))
+        response = webob.Request.blank('/v1.1/servers').get_response(app)
+        self.assertEqual('ok', response.body)
+
+        request_trace, = traces
+        self.assertEqual(ctxt.request_id, request_trace.request_id)
+        self.assertEqual('GET /v1.1/servers', request_trace.name)
+        self.assertEqual(['Outer', 'Inner'],
+                         [span['name'] for span in request_trace.spans])
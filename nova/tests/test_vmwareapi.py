@@ -19,6 +19,10 @@
 Test suite for VMWareAPI.
 """
 
+import re
+
+import eventlet
+
 from nova import context
 from nova import db
 from nova import flags
@@ -29,7 +33,9 @@ from nova.tests.glance import stubs as glance_stubs
 from nova.tests.vmwareapi import db_fakes
 from nova.tests.vmwareapi import stubs
 from nova.virt import vmwareapi_conn
+from nova.virt.vmwareapi import error_util
 from nova.virt.vmwareapi import fake as vmwareapi_fake
+from nova.virt.vmwareapi import read_write_util
 
 
 FLAGS = flags.FLAGS
@@ -263,3 +269,181 @@ class VMWareAPIVMTestCase(test.TestCase):
         Dummy callback function to be passed to suspend, resume, etc., calls.
         """
         pass
+
+
+class VMWareAPIInventoryTestCase(test.TestCase):
+    """Unit tests for the inventory of the ESX host."""
+
+    def setUp(self):
+        super(VMWareAPIInventoryTestCase, self).setUp()
+        vmwareapi_fake.reset()
+        stubs.set_stubs(self.stubs)
+        self.calls = []
+        for method in ('_create_filter', '_check_for_updates',
+                       '_retrieve_properties'):
+            self._count_calls(method)
+        self.session = vmwareapi_conn.VMWareAPISession('test_url',
+                                                       'test_username',
+                                                       'test_pass', 1)
+        self.vmops = vmwareapi_conn.VMWareVMOps(self.session)
+
+    def tearDown(self):
+        super(VMWareAPIInventoryTestCase, self).tearDown()
+        vmwareapi_fake.cleanup()
+
+    def _count_calls(self, method):
+        orig = getattr(vmwareapi_fake.FakeVim, method)
+
+        def count(vim, *args, **kwargs):
+            self.calls.append(method)
+            return orig(vim, *args, **kwargs)
+        self.stubs.Set(vmwareapi_fake.FakeVim, method, count)
+
+    def _create_vm(self, name, powerstate='poweredOn'):
+        ds = vmwareapi_fake._get_objects("Datastore")[0]
+        vm = vmwareapi_fake.VirtualMachine(name=name, ds=ds,
+                                           powerstate=powerstate)
+        vmwareapi_fake._create_object("VirtualMachine", vm)
+        return vm
+
+    def test_lookups_do_not_scan_inventory(self):
+        for name in ('vm1', 'vm2', 'vm3'):
+            self._create_vm(name)
+        names = self.vmops.list_instances()
+        self.assertEquals(sorted(names), ['vm1', 'vm2', 'vm3'])
+        for name in names:
+            info = self.vmops.get_info(name)
+            self.assertEquals(info['state'], power_state.RUNNING)
+        self.assertEquals(self.calls.count('_create_filter'), 1)
+        self.assertEquals(self.calls.count('_retrieve_properties'), 0)
+
+    def test_tracks_changes(self):
+        vm = self._create_vm('vm1')
+        self.assertEquals(self.vmops.get_info('vm1')['state'],
+                          power_state.RUNNING)
+        vm.set("runtime.powerState", "suspended")
+        self.assertEquals(self.vmops.get_info('vm1')['state'],
+                          power_state.PAUSED)
+        del vmwareapi_fake._db_content["VirtualMachine"][vm.obj]
+        self.assertEquals(self.vmops.list_instances(), [])
+        self.assertEquals(self.calls.count('_create_filter'), 1)
+
+    def test_creates_filter_again_for_new_session(self):
+        self._create_vm('vm1')
+        self.assertEquals(self.vmops.list_instances(), ['vm1'])
+        self.session._create_session()
+        self._create_vm('vm2')
+        self.assertEquals(sorted(self.vmops.list_instances()),
+                          ['vm1', 'vm2'])
+        self.assertEquals(self.calls.count('_create_filter'), 2)
+
+    def test_destroys_filter_after_fault(self):
+        self._create_vm('vm1')
+        self.assertEquals(self.vmops.list_instances(), ['vm1'])
+        orig = vmwareapi_fake.FakeVim._check_for_updates
+        faults = [error_util.VimFaultException([], Exception('fault'))]
+
+        def check_for_updates(vim, *args, **kwargs):
+            if faults:
+                raise faults.pop()
+            return orig(vim, *args, **kwargs)
+        self.stubs.Set(vmwareapi_fake.FakeVim, '_check_for_updates',
+                       check_for_updates)
+        self._count_calls('_destroy_filter')
+        self.assertEquals(self.vmops.list_instances(), ['vm1'])
+        self.assertEquals(self.calls.count('_create_filter'), 2)
+        self.assertEquals(self.calls.count('_destroy_filter'), 1)
+        self.assertEquals(len(self.session._get_vim()._filters), 1)
+
+
+class FakeHTTPResponse(object):
+    """Response to a range request, failing after fail_after bytes."""
+
+    def __init__(self, data, start, end, fail_after=None):
+        self.code = 206
+        self.headers = {"Content-Range": "bytes %d-%d/%d" %
+                                         (start, end - 1, len(data))}
+        self._data = data[start:end]
+        self._fail_after = fail_after
+
+    def read(self, size):
+        if self._fail_after is not None and self._fail_after <= 0:
+            raise IOError("connection reset")
+        if self._fail_after is not None:
+            size = min(size, self._fail_after)
+            self._fail_after -= size
+        data, self._data = self._data[:size], self._data[size:]
+        return data
+
+    def close(self):
+        pass
+
+
+class VMWareAPITransferTestCase(test.TestCase):
+    """Unit tests for downloading files from the datastore in ranges."""
+
+    def setUp(self):
+        super(VMWareAPITransferTestCase, self).setUp()
+        self.flags(vmwareapi_transfer_connections=3,
+                   vmwareapi_transfer_range_size=1000)
+        self.stubs.Set(read_write_util, 'READ_CHUNKSIZE', 300)
+        self.stubs.Set(read_write_util, 'RANGE_RETRY_INTERVAL', 0)
+        self.data = ''.join(chr(i % 256) for i in xrange(4500))
+        self.requests = []
+        self.failures = {}
+        self.stubs.Set(read_write_util.urllib2, 'urlopen', self._urlopen)
+
+    def _urlopen(self, request):
+        match = re.match(r'bytes=(\d+)-(\d+)', request.headers['Range'])
+        start, end = int(match.group(1)), int(match.group(2)) + 1
+        self.requests.append((start, end))
+        return FakeHTTPResponse(self.data, start, min(end, len(self.data)),
+                                self.failures.pop(start, None))
+
+    def _read_all(self):
+        read_file = read_write_util.VMWareHTTPRangeReadFile(
+                'host', 'dc', 'ds', [], 'vm/vm-flat.vmdk')
+        self.assertEquals(read_file.get_size(), len(self.data))
+        chunks = []
+        try:
+            while True:
+                data = read_file.read(None)
+                if not data:
+                    break
+                chunks.append(data)
+        finally:
+            read_file.close()
+        return ''.join(chunks), read_file
+
+    def test_downloads_ranges_in_order(self):
+        data, read_file = self._read_all()
+        self.assertEquals(data, self.data)
+        self.assertEquals(sorted(self.requests),
+                          [(0, 1000), (1000, 2000), (2000, 3000),
+                           (3000, 4000), (4000, 4500)])
+
+    def test_spools_ranges_ahead_of_reader(self):
+        read_file = read_write_util.VMWareHTTPRangeReadFile(
+                'host', 'dc', 'ds', [], 'vm/vm-flat.vmdk')
+        eventlet.sleep(0)
+        self.assertEquals(sorted(self.requests),
+                          [(0, 1000), (1000, 2000), (2000, 3000)])
+        data = ''
+        while len(data) <= 1000:
+            data += read_file.read(None)
+        eventlet.sleep(0)
+        self.assertTrue((3000, 4000) in self.requests)
+        self.assertFalse((4000, 4500) in self.requests)
+        read_file.close()
+
+    def test_resumes_failed_range(self):
+        self.failures[2000] = 400
+        data, read_file = self._read_all()
+        self.assertEquals(data, self.data)
+        self.assertTrue((2400, 3000) in self.requests)
+        self.assertEquals(len(self.requests), 6)
+
+    def test_gives_up_after_retries(self):
+        self.flags(vmwareapi_transfer_retries=0)
+        self.failures[1000] = 0
+        self.assertRaises(IOError, self._read_all)
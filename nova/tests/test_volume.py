@@ -21,6 +21,11 @@ Tests for Volume Code.
 """
 
 import cStringIO
+import os
+import shutil
+import tempfile
+
+import eventlet
 
 from nova import context
 from nova import exception
@@ -31,6 +36,9 @@ from nova import rpc
 from nova import test
 from nova import utils
 from nova import volume
+from nova.volume import driver
+from nova.volume import san
+from nova.volume import wipe
 
 FLAGS = flags.FLAGS
 LOG = logging.getLogger('nova.tests.volume')
@@ -311,17 +319,156 @@ class VolumeDriverTestCase(DriverTestCase):
                        lambda x: False)
         self.stubs.Set(self.volume.driver, '_delete_volume',
                        lambda x, y: False)
-        # Want DriverTestCase._fake_execute to return 'o' so that
-        # volume.driver.delete_volume() raises the VolumeIsBusy exception.
-        self.output = 'o'
+        # Want DriverTestCase._fake_execute to list test1 as an origin so
+        # that volume.driver.delete_volume() raises VolumeIsBusy.
+        self.output = '  test1|owi-a-|1073741824|linear|\n'
         self.assertRaises(exception.VolumeIsBusy,
                           self.volume.driver.delete_volume,
                           {'name': 'test1', 'size': 1024})
-        # when DriverTestCase._fake_execute returns something other than
-        # 'o' volume.driver.delete_volume() does not raise an exception.
-        self.output = 'x'
+        # when DriverTestCase._fake_execute lists test1 as a plain volume
+        # volume.driver.delete_volume() does not raise an exception.
+        self.output = '  test1|-wi-a-|1073741824|linear|\n'
+        self.volume.driver._lvm.invalidate(FLAGS.volume_group)
         self.volume.driver.delete_volume({'name': 'test1', 'size': 1024})
 
+    def test_volume_inventory_lists_once(self):
+        """Test volumes are looked up with one lvs call."""
+        calls = []
+
+        def fake_execute(*cmd, **kwargs):
+            calls.append(cmd)
+            return ('  vol1|-wi-a-|1073741824|linear|\n'
+                    '  vol2|owi-a-|2147483648|linear|\n'), None
+        self.volume.driver._execute = fake_execute
+        self.assertFalse(self.volume.driver._volume_not_present('vol1'))
+        self.assertFalse(self.volume.driver._volume_not_present('vol2'))
+        self.assertEqual(1, len(calls))
+        self.assertEqual('lvs', calls[0][0])
+
+        # NOTE: a volume missing from the report is listed again
+        self.assertTrue(self.volume.driver._volume_not_present('vol3'))
+        self.assertEqual(2, len(calls))
+
+        self.assertRaises(exception.VolumeIsBusy,
+                          self.volume.driver.delete_volume,
+                          {'name': 'vol2', 'size': 2})
+        self.assertEqual(2, len(calls))
+
+    def _record_execute(self, lvs_output):
+        calls = []
+
+        def fake_execute(*cmd, **kwargs):
+            calls.append(cmd)
+            if cmd[0] == 'lvs':
+                return lvs_output, None
+            return '', None
+        self.volume.driver._execute = fake_execute
+        return calls
+
+    def test_create_volume_from_thin_snapshot(self):
+        """Test snapshots of thin volumes are cloned."""
+        calls = self._record_execute('  _snapshot-1|Vwi-a-|1073741824|thin|'
+                                     'vol1\n')
+        self.volume.driver.create_volume_from_snapshot(
+                {'name': 'vol2', 'size': 2},
+                {'name': 'snapshot-1', 'volume_name': 'vol1',
+                 'volume_size': 1})
+        vg = FLAGS.volume_group
+        self.assertEqual([('lvcreate', '-s', '-kn', '-n', 'vol2',
+                           '%s/_snapshot-1' % vg),
+                          ('lvresize', '-f', '-L', '2G', '%s/vol2' % vg)],
+                         [cmd for cmd in calls if cmd[0] != 'lvs'])
+
+    def test_create_volume_from_snapshot_copies(self):
+        """Test other snapshots are copied, sparsely into thin volumes."""
+        self.flags(volume_thin_pool='pool', volume_copy_ionice='-c3')
+        calls = self._record_execute('  vol2|Vwi-a-|2147483648|thin|\n')
+        self.volume.driver.create_volume_from_snapshot(
+                {'name': 'vol2', 'size': 2},
+                {'name': 'snapshot-1', 'volume_name': 'vol1',
+                 'volume_size': 1})
+        vg = FLAGS.volume_group
+        self.assertEqual([('lvcreate', '-T', '%s/pool' % vg, '-V', '2G',
+                           '-n', 'vol2'),
+                          ('ionice', '-c3', 'dd',
+                           'if=%s' % self.volume.driver.local_path(
+                                {'name': 'snapshot-1'}),
+                           'of=%s' % self.volume.driver.local_path(
+                                {'name': 'vol2'}),
+                           'count=256', 'bs=4M', 'conv=sparse')],
+                         [cmd for cmd in calls if cmd[0] != 'lvs'])
+
+
+class RBDTestCase(DriverTestCase):
+    """Test Case for RBDDriver"""
+    driver_name = "nova.volume.driver.RBDDriver"
+
+    def setUp(self):
+        super(RBDTestCase, self).setUp()
+        self.calls = []
+        self.info = 'format: 2\nprotected: False\n'
+        self.children = ''
+
+        def fake_execute(*cmd, **kwargs):
+            self.calls.append(cmd)
+            if 'info' in cmd:
+                return self.info, None
+            elif 'children' in cmd:
+                return self.children, None
+            return '', None
+        self.volume.driver._execute = fake_execute
+        self.snapshot = {'name': 'snap1', 'volume_name': 'vol1',
+                         'volume_size': 1}
+
+    def test_create_volume_uses_format_1_by_default(self):
+        self.volume.driver.create_volume({'name': 'vol1', 'size': 1})
+        self.assertEqual([('rbd', '--pool', FLAGS.rbd_pool, '--size', 1024,
+                           'create', 'vol1')], self.calls)
+
+    def test_create_volume_of_format_2(self):
+        self.flags(rbd_image_format=2)
+        self.volume.driver.create_volume({'name': 'vol1', 'size': 1})
+        self.assertEqual([('rbd', '--pool', FLAGS.rbd_pool,
+                           '--image-format', 2, '--size', 1024, 'create',
+                           'vol1')], self.calls)
+
+    def test_create_volume_from_snapshot_clones(self):
+        self.volume.driver.create_volume_from_snapshot(
+                {'name': 'vol2', 'size': 2}, self.snapshot)
+        pool = FLAGS.rbd_pool
+        self.assertEqual([('rbd', '--pool', pool, '--snap', 'snap1', 'info',
+                           'vol1'),
+                          ('rbd', '--pool', pool, 'snap', 'protect',
+                           '--snap', 'snap1', 'vol1'),
+                          ('rbd', 'clone', '%s/vol1@snap1' % pool,
+                           '%s/vol2' % pool),
+                          ('rbd', '--pool', pool, '--size', 2048, 'resize',
+                           'vol2')],
+                         self.calls)
+
+    def test_create_volume_from_format_1_snapshot_copies(self):
+        self.info = 'format: 1\n'
+        self.volume.driver.create_volume_from_snapshot(
+                {'name': 'vol2', 'size': 1}, self.snapshot)
+        pool = FLAGS.rbd_pool
+        self.assertEqual(('rbd', 'cp', '%s/vol1@snap1' % pool,
+                          '%s/vol2' % pool), self.calls[-1])
+
+    def test_delete_cloned_snapshot_flattens_clones(self):
+        self.info = 'format: 2\nprotected: True\n'
+        self.children = 'rbd/vol2\n'
+        self.volume.driver.delete_snapshot(self.snapshot)
+        pool = FLAGS.rbd_pool
+        self.assertEqual([('rbd', '--pool', pool, '--snap', 'snap1', 'info',
+                           'vol1'),
+                          ('rbd', 'children', '%s/vol1@snap1' % pool),
+                          ('rbd', 'flatten', 'rbd/vol2'),
+                          ('rbd', '--pool', pool, 'snap', 'unprotect',
+                           '--snap', 'snap1', 'vol1'),
+                          ('rbd', '--pool', pool, 'snap', 'rm',
+                           '--snap', 'snap1', 'vol1')],
+                         self.calls)
+
 
 class AOETestCase(DriverTestCase):
     """Test Case for AOEDriver"""
@@ -477,3 +624,133 @@ class ISCSITestCase(DriverTestCase):
         self.mox.UnsetStubs()
 
         self._detach_volume(volume_id_list)
+
+    def test_ensure_exports_skips_exported_targets(self):
+        """Only the missing parts of targets are created again."""
+        prefix = FLAGS.iscsi_target_prefix
+        show = ('Target 1: %(prefix)svolume-1\n'
+                '    System information:\n'
+                '        Driver: iscsi\n'
+                '    LUN information:\n'
+                '        LUN: 0\n'
+                '            Type: controller\n'
+                '        LUN: 1\n'
+                '            Type: disk\n'
+                '    ACL information:\n'
+                '        ALL\n'
+                'Target 2: %(prefix)svolume-2\n'
+                '    LUN information:\n'
+                '        LUN: 0\n'
+                '    ACL information:\n'
+                '        ALL\n') % locals()
+        calls = []
+
+        def fake_execute(*cmd, **kwargs):
+            calls.append(cmd)
+            return show, ''
+        self.volume.driver._execute = fake_execute
+        self.volume.driver._sync_exec = fake_execute
+        self.stubs.Set(self.volume.driver.db, 'volume_get_iscsi_target_num',
+                       lambda context, volume_id: volume_id)
+        volumes = [{'id': i, 'name': 'volume-%d' % i} for i in (1, 2, 3)]
+        self.volume.driver.ensure_exports(self.context, volumes)
+
+        self.assertEqual(1, len([cmd for cmd in calls if 'show' in cmd]))
+        created = [(cmd[2], [arg for arg in cmd if arg.startswith('--tid')])
+                   for cmd in calls if 'show' not in cmd]
+        self.assertEqual([('bind', ['--tid=3']), ('new', ['--tid=2']),
+                          ('new', ['--tid=3']), ('new', ['--tid=3'])],
+                         sorted(created))
+
+
+class WipeQueueTestCase(test.TestCase):
+    """Test Case for the background volume wipe queue."""
+
+    def setUp(self):
+        super(WipeQueueTestCase, self).setUp()
+        self.state_path = tempfile.mkdtemp()
+        self.flags(volume_wipe_state_path=self.state_path,
+                   volume_wipe_rate=0,
+                   volume_wipe_step=2)
+        self.commands = []
+        self.volumes = ['volume-1|-wi-a-|4194304|linear|']
+        self.wipe_queue = wipe.WipeQueue('vg', self._fake_execute)
+
+    def tearDown(self):
+        if self.wipe_queue._worker is not None:
+            self.wipe_queue._worker.kill()
+        shutil.rmtree(self.state_path)
+        super(WipeQueueTestCase, self).tearDown()
+
+    def _fake_execute(self, *cmd, **kwargs):
+        self.commands.append(cmd)
+        if cmd[0] == 'lvs':
+            return '\n'.join(self.volumes), ''
+        return '', ''
+
+    def _wipe_commands(self):
+        return [(cmd[0],) + cmd[4:6] for cmd in self.commands
+                if cmd[0] in ('dd', 'lvremove')]
+
+    def test_delete_parks_and_wipes_in_steps(self):
+        self.wipe_queue.start()
+        self.wipe_queue.delete('volume-1')
+        renames = [cmd for cmd in self.commands if cmd[0] == 'lvrename']
+        self.assertEqual(1, len(renames))
+        self.assertEqual(('vg', 'volume-1'), renames[0][1:3])
+        self.assertTrue(renames[0][3].startswith('wipe-volume-1-'))
+        self.assertEqual('volume-1',
+                         self.wipe_queue._load(renames[0][3])['lv_name'])
+        eventlet.sleep(0)
+        self.assertEqual([('dd', 'seek=0', 'count=2'),
+                          ('dd', 'seek=2', 'count=2'),
+                          ('lvremove',)],
+                         self._wipe_commands())
+        self.assertEqual({}, self.wipe_queue.progress())
+
+    def test_deleting_a_reused_name_parks_it_again(self):
+        self.wipe_queue.start()
+        self.wipe_queue.delete('volume-1')
+        self.wipe_queue.delete('volume-1')
+        parked = [cmd[3] for cmd in self.commands if cmd[0] == 'lvrename']
+        self.assertEqual(2, len(parked))
+        self.assertNotEqual(parked[0], parked[1])
+        self.assertEqual(sorted(parked),
+                         sorted(self.wipe_queue.progress().keys()))
+
+    def test_only_lvm_drivers_resume_wiping(self):
+        self.flags(background_volume_wipe=True, volume_group='vg')
+        started = []
+        self.stubs.Set(wipe, 'get_queue',
+                       lambda volume_group, execute: started.append(
+                           volume_group))
+        for driver_class in (driver.ISCSIDriver, driver.AOEDriver):
+            driver_class(execute=self._fake_execute).do_setup(None)
+        self.assertEqual(['vg', 'vg'], started)
+        for driver_class in (driver.RBDDriver, driver.SheepdogDriver,
+                             san.SolarisISCSIDriver):
+            driver_class(execute=self._fake_execute).do_setup(None)
+        self.assertEqual(['vg', 'vg'], started)
+
+    def test_thin_volume_is_not_wiped(self):
+        self.volumes = ['volume-1|Vwi-a-|4194304|thin|']
+        self.wipe_queue.start()
+        self.wipe_queue.delete('volume-1')
+        eventlet.sleep(0)
+        self.assertEqual([('lvremove',)], self._wipe_commands())
+
+    def test_wipe_resumes_after_restart(self):
+        os.makedirs(os.path.join(self.state_path, 'vg'))
+        self.wipe_queue._save('wipe-volume-1', {'size': 4194304,
+                                                'offset': 2097152,
+                                                'wipe': True})
+        self.wipe_queue._save('wipe-volume-2', {'size': 4194304,
+                                                'offset': 0,
+                                                'wipe': True})
+        self.volumes = ['wipe-volume-1|-wi-a-|4194304|linear|',
+                        'volume-3|-wi-a-|4194304|linear|']
+        self.wipe_queue.start()
+        eventlet.sleep(0)
+        self.assertEqual([('dd', 'seek=2', 'count=2'), ('lvremove',)],
+                         self._wipe_commands())
+        self.assertEqual({}, self.wipe_queue.progress())
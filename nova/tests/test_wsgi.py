@@ -93,3 +93,13 @@ class TestWSGIServer(unittest.TestCase):
         self.assertNotEqual(0, server.port)
         server.stop()
         server.wait()
+
+    def test_listen_keeps_socket(self):
+        server = nova.wsgi.Server("test_listen", None, host="127.0.0.1")
+        server.listen()
+        port = server.port
+        self.assertNotEqual(0, port)
+        server.start()
+        self.assertEqual(port, server.port)
+        server.stop()
+        server.wait()
@@ -22,6 +22,11 @@ import os
 import re
 import stubout
 import ast
+import tempfile
+import time
+
+import eventlet
+from eventlet import queue
 
 from nova import db
 from nova import context
@@ -33,6 +38,7 @@ from nova.compute import instance_types
 from nova.compute import power_state
 from nova import exception
 from nova.virt import xenapi_conn
+from nova.virt.xenapi import events
 from nova.virt.xenapi import fake as xenapi_fake
 from nova.virt.xenapi import volume_utils
 from nova.virt.xenapi import vmops
@@ -1061,3 +1067,322 @@ class HostStateTestCase(test.TestCase):
         self.assertEquals(stats['host_memory_overhead'], 20)
         self.assertEquals(stats['host_memory_free'], 30)
         self.assertEquals(stats['host_memory_free_computed'], 40)
+
+
+class FakeEventSession(object):
+    """Fake XenAPI session with tasks and event.from."""
+
+    def __init__(self):
+        self.tasks = {}
+        self.get_record_calls = 0
+        self.events = queue.Queue()
+
+    def __getattr__(self, name):
+        # NOTE: XenAPISession.call_xenapi calls __getattr__ itself
+        if name in ('xenapi', 'event', 'session', 'task'):
+            return self
+        if name == 'from':
+            return self._event_from
+        return object.__getattribute__(self, name)
+
+    def login_with_password(self, user, pw):
+        pass
+
+    def logout(self):
+        pass
+
+    def get_record(self, ref):
+        self.get_record_calls += 1
+        return self.tasks[ref]
+
+    def _event_from(self, classes, token, timeout):
+        if not token:
+            return {'events': [], 'token': '0'}
+        return {'events': [self.events.get()], 'token': token}
+
+    def send_event(self, cls, ref, snapshot):
+        self.events.put({'class': cls, 'operation': 'mod', 'ref': ref,
+                         'snapshot': snapshot})
+
+
+class XenAPIEventWatcherTestCase(test.TestCase):
+    """Unit tests for waiting for tasks and VDIs with XenAPI events."""
+
+    def setUp(self):
+        super(XenAPIEventWatcherTestCase, self).setUp()
+        self.fake_session = FakeEventSession()
+        self.stubs.Set(xenapi_conn.XenAPISession, '_create_session',
+                       lambda s, url: self.fake_session)
+        self.stubs.Set(xenapi_conn.XenAPISession, 'get_imported_xenapi',
+                       lambda s: xenapi_fake)
+        # NOTE: the fake session blocks greenthreads, not native threads
+        self.stubs.Set(events.tpool, 'execute',
+                       lambda f, *args, **kwargs: f(*args, **kwargs))
+        self.session = xenapi_conn.XenAPISession('test_url', 'root', 'pw')
+
+    def tearDown(self):
+        if self.session._watcher:
+            self.session._watcher.stop()
+        super(XenAPIEventWatcherTestCase, self).tearDown()
+
+    def test_wait_for_task_with_events(self):
+        self.fake_session.tasks['task1'] = {'name_label': 'Async.VM.start',
+                                            'status': 'pending'}
+        waiter = eventlet.spawn(self.session.wait_for_task, 'task1')
+        eventlet.sleep(0)
+        self.fake_session.send_event('task', 'task1',
+                                     {'name_label': 'Async.VM.start',
+                                      'status': 'pending'})
+        eventlet.sleep(0)
+        self.fake_session.send_event('task', 'task1',
+                                     {'name_label': 'Async.VM.start',
+                                      'status': 'success',
+                                      'result': '<value>OpaqueRef:1</value>'})
+        self.assertEqual('OpaqueRef:1', waiter.wait())
+        self.assertEqual(1, self.fake_session.get_record_calls)
+
+    def test_wait_for_failed_task(self):
+        self.fake_session.tasks['task1'] = {'name_label': 'Async.VM.start',
+                                            'status': 'failure',
+                                            'error_info': ['VM_HVM_REQUIRED']}
+        self.assertRaises(xenapi_fake.Failure,
+                          self.session.wait_for_task, 'task1')
+
+    def test_wait_for_vdi_change(self):
+        waiter = eventlet.spawn(self.session.wait_for_vdi_change, 'vdi1', 5)
+        eventlet.sleep(0)
+        self.fake_session.send_event('VDI', 'vdi1', {})
+        self.assertTrue(waiter.wait())
+        self.assertFalse(self.session.wait_for_vdi_change('vdi1', 0.01))
+
+    def _stub_coalesce(self, parents):
+        """Stub the parent reads of wait_for_vhd_coalesce with parents,
+        each read sending a VDI event, and count the SR scans."""
+        self.scans = []
+        self.stubs.Set(vm_utils.VMHelper, 'scan_sr',
+                       staticmethod(lambda session, instance_id, sr_ref:
+                                        self.scans.append(sr_ref)))
+
+        def fake_get_vhd_parent_uuid(session, vdi_ref):
+            self.fake_session.send_event('VDI', vdi_ref, {})
+            return parents.pop(0)
+
+        self.stubs.Set(vm_utils, 'get_vhd_parent_uuid',
+                       fake_get_vhd_parent_uuid)
+
+    def test_vdi_events_do_not_use_up_coalesce_attempts(self):
+        self.flags(xenapi_vhd_coalesce_max_attempts=2,
+                   xenapi_vhd_coalesce_poll_interval=5)
+        self._stub_coalesce(['parent'] * 5 + ['original'])
+        self.assertEqual('original', vm_utils.wait_for_vhd_coalesce(
+                self.session, 1, 'sr1', 'vdi1', 'original'))
+        # NOTE: the events sent while reading the parent are not missed,
+        #       so no wait timed out into a scan
+        self.assertEqual(['sr1'], self.scans)
+
+    def test_vhd_coalesce_gives_up_after_max_attempts_polls(self):
+        self.flags(xenapi_vhd_coalesce_max_attempts=2,
+                   xenapi_vhd_coalesce_poll_interval=0.05)
+        self._stub_coalesce(['parent'] * 1000)
+        self.stubs.Set(self.session, '_get_watcher', lambda: None)
+        start = time.time()
+        self.assertRaises(exception.Error, vm_utils.wait_for_vhd_coalesce,
+                          self.session, 1, 'sr1', 'vdi1', 'original')
+        self.assertTrue(time.time() - start >= 0.1)
+        self.assertTrue(len(self.scans) >= 3)
+
+    def test_polls_tasks_without_events(self):
+        xenapi_fake.reset()
+        stubs.stubout_session(self.stubs, xenapi_fake.SessionBase)
+        session = xenapi_conn.XenAPISession('test_url', 'root', 'pw')
+        vm_ref = xenapi_fake.create_vm('vm', 'Running')
+        task = session.call_xenapi('Async.VM.add_to_xenstore_data', vm_ref,
+                                   'key', 'value')
+        self.assertEqual(None, session.wait_for_task(task))
+        self.assertEqual(None, session._get_watcher())
+
+
+class XenAPISessionPoolTestCase(test.TestCase):
+    """Unit tests for the pool of sessions of XenAPISession."""
+
+    def setUp(self):
+        super(XenAPISessionPoolTestCase, self).setUp()
+        xenapi_fake.reset()
+        self.flags(xenapi_connection_concurrent=3)
+        stubs.stubout_session(self.stubs, xenapi_fake.SessionBase)
+
+    def test_logs_in_pool_sessions(self):
+        session = xenapi_conn.XenAPISession('test_url', 'root', 'pw')
+        self.assertEqual(3, len(xenapi_fake.get_all('session')))
+
+    def test_concurrent_calls_use_different_sessions(self):
+        session = xenapi_conn.XenAPISession('test_url', 'root', 'pw')
+        handles = []
+        release = eventlet.event.Event()
+
+        def hold():
+            with session._get_session() as pooled:
+                handles.append(pooled.handle)
+                release.wait()
+
+        holders = [eventlet.spawn(hold) for _i in xrange(3)]
+        eventlet.sleep(0)
+        self.assertEqual(3, len(set(handles)))
+        release.send()
+        for holder in holders:
+            holder.wait()
+
+    def test_get_xenapi_calls_through_pool(self):
+        session = xenapi_conn.XenAPISession('test_url', 'root', 'pw')
+        calls = []
+        self.stubs.Set(session, 'call_xenapi',
+                       lambda method, *args: calls.append((method, args)))
+        session.get_xenapi().VM.get_record('vm_ref')
+        self.assertEqual([('VM.get_record', ('vm_ref',))], calls)
+
+    def test_logs_in_again_when_session_expired(self):
+        expired = []
+
+        class FakeExpiringSession(xenapi_fake.SessionBase):
+            def VM_get_record(self, session_ref, vm_ref):
+                if not expired:
+                    expired.append(session_ref)
+                    raise xenapi_fake.Failure(['SESSION_INVALID',
+                                               session_ref])
+                return xenapi_fake.get_record('VM', vm_ref)
+
+        stubs.stubout_session(self.stubs, FakeExpiringSession)
+        session = xenapi_conn.XenAPISession('test_url', 'root', 'pw')
+        vm_ref = xenapi_fake.create_vm('vm', 'Running')
+        record = session.call_xenapi('VM.get_record', vm_ref)
+        self.assertEqual('vm', record['name_label'])
+        self.assertEqual(1, len(expired))
+        self.assertEqual(4, len(xenapi_fake.get_all('session')))
+
+
+class FakeListingSession(xenapi_fake.SessionBase):
+    """Fake XenAPI session counting VM.get_all_records calls."""
+
+    get_all_records_calls = 0
+
+    def VM_get_all_records(self, _1):
+        FakeListingSession.get_all_records_calls += 1
+        return xenapi_fake.get_all_records('VM')
+
+
+class XenAPIVMRecordsTestCase(test.TestCase):
+    """Unit tests for the VM records and RRD updates of a host."""
+
+    def setUp(self):
+        super(XenAPIVMRecordsTestCase, self).setUp()
+        xenapi_fake.reset()
+        FakeListingSession.get_all_records_calls = 0
+        self.flags(xenapi_task_events=False)
+        stubs.stubout_session(self.stubs, FakeListingSession)
+        self.session = xenapi_conn.XenAPISession('test_url', 'root', 'pw')
+        self.vmops = vmops.VMOps(self.session, None)
+
+    def test_lists_and_looks_up_vms_with_one_call(self):
+        for name in ('instance-1', 'instance-2', 'instance-3'):
+            xenapi_fake.create_vm(name, 'Running')
+        infos = self.vmops.list_instances_detail()
+        self.assertEqual(3, len(infos))
+        for info in infos:
+            self.vmops.get_info(info.name)
+        self.assertEqual(1, FakeListingSession.get_all_records_calls)
+
+    def test_vm_changes_list_vms_again(self):
+        vm_ref = xenapi_fake.create_vm('instance-1', 'Running')
+        self.assertEqual(['instance-1'], self.vmops.list_instances())
+        self.session.call_xenapi('VM.destroy', vm_ref)
+        self.assertEqual([], self.vmops.list_instances())
+        self.assertEqual(2, FakeListingSession.get_all_records_calls)
+
+    def test_new_vm_found_after_listing(self):
+        self.assertEqual([], self.vmops.list_instances())
+        xenapi_fake.create_vm('instance-1', 'Running')
+        self.assertEqual(power_state.RUNNING,
+                         self.vmops.get_info('instance-1')['state'])
+        self.assertRaises(exception.NotFound, self.vmops.get_info,
+                          'instance-2')
+
+    def test_vm_events_update_records(self):
+        listeners = []
+        self.stubs.Set(self.session, 'listen_for_events',
+                       lambda cls, callback: listeners.append(callback) or
+                                             True)
+        vm_ref = xenapi_fake.create_vm('instance-1', 'Running')
+        records = self.session.vm_records
+        self.assertEqual('Running', records.get(vm_ref)['power_state'])
+        listeners[0]({'class': 'vm', 'operation': 'mod', 'ref': vm_ref,
+                      'snapshot': {'name_label': 'instance-1',
+                                   'power_state': 'Halted'}})
+        self.assertEqual('Halted', records.get(vm_ref)['power_state'])
+        listeners[0]({'class': 'vm', 'operation': 'del', 'ref': vm_ref})
+        self.assertEqual(None, records.all().get(vm_ref))
+        self.assertEqual(1, FakeListingSession.get_all_records_calls)
+
+    def test_parse_rrd_updates(self):
+        xml = ('<xport><meta><rows>2</rows><columns>3</columns><legend>'
+               '<entry>AVERAGE:vm:uuid1:cpu0</entry>'
+               '<entry>AVERAGE:vm:uuid2:cpu0</entry>'
+               '<entry>AVERAGE:host:host1:memory_total_kib</entry>'
+               '</legend></meta><data>'
+               '<row><t>10</t><v>0.5</v><v>0.25</v><v>1024</v></row>'
+               '<row><t>5</t><v>0.1</v><v>0.2</v><v>1024</v></row>'
+               '</data></xport>')
+        self.assertEqual({'uuid1': {'cpu0': '0.5'},
+                          'uuid2': {'cpu0': '0.25'}},
+                         vm_utils.parse_rrd_updates(xml))
+
+
+class XenAPIStreamImageTestCase(test.TestCase):
+    """Unit tests for streaming images into VDIs."""
+
+    def setUp(self):
+        super(XenAPIStreamImageTestCase, self).setUp()
+        self.flags(xenapi_stream_block_size=4096)
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+        super(XenAPIStreamImageTestCase, self).tearDown()
+
+    def _disk(self, content):
+        with open(self.path, 'wb') as f:
+            f.write(content)
+
+    def _read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_image_blocks(self):
+        chunks = ['ab', 'cde', 'f', 'ghij']
+        self.assertEqual(['abcd', 'efgh', 'ij'],
+                         list(vm_utils._image_blocks(chunks, 4)))
+        self.assertEqual(['abcd', 'efgh'],
+                         list(vm_utils._image_blocks(['abcdefgh'], 4)))
+
+    def test_sparse_stream_skips_zero_blocks(self):
+        self._disk('\0' * 16384)
+        image = ['a' * 1000, 'b' * 3096, '\0' * 4096, '\0' * 2048,
+                 'c' * 2048, 'd' * 100]
+        written, skipped = vm_utils._stream_image(self.path, iter(image),
+                                                  512, sparse=True)
+        self.assertEqual((4096 + 4096 + 100, 4096), (written, skipped))
+        self.assertEqual('\0' * 512 + ''.join(image) + '\0' * 3484,
+                         self._read())
+
+    def test_stream_writes_zero_blocks(self):
+        self._disk('x' * 8192)
+        written, skipped = vm_utils._stream_image(self.path,
+                                                  iter(['\0' * 8192]))
+        self.assertEqual((8192, 0), (written, skipped))
+        self.assertEqual('\0' * 8192, self._read())
+
+    def test_stream_without_direct_io(self):
+        self.flags(xenapi_stream_direct_io=False)
+        self._disk('\0' * 8192)
+        vm_utils._stream_image(self.path, iter(['a' * 5000]), sparse=True)
+        self.assertEqual('a' * 5000 + '\0' * 3192, self._read())
@@ -0,0 +1,230 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Per-request performance tracing.
+
+When --trace_requests is set, every API request and every rpc message a
+manager handles gets a Trace holding a span for each WSGI stage, rpc
+call/cast and, through utils.monkey_patch(), each decorated db or image
+service call. Traces are keyed by the request id of the context, which
+already travels with every rpc message, so the trace of an API request and
+the traces of the managers it called can be joined offline.
+
+A finished trace is written to the log, or appended as a line of JSON to
+--trace_file if set.
+
+To trace db and image service calls, add for example::
+
+    --monkey_patch
+    --monkey_patch_modules=nova.db.sqlalchemy.api:nova.trace.db_decorator,
+                           nova.image.glance:nova.trace.image_decorator
+
+"""
+
+import contextlib
+import functools
+import json
+import time
+
+from eventlet import corolocal
+
+from nova import flags
+from nova import log as logging
+
+
+LOG = logging.getLogger('nova.trace')
+
+FLAGS = flags.FLAGS
+flags.DEFINE_bool('trace_requests', False,
+                  'record per-request timings of wsgi stages, db, rpc '
+                  'and image service calls')
+flags.DEFINE_string('trace_file', None,
+                    'append finished traces as JSON lines to this file '
+                    'instead of logging them')
+
+_local = corolocal.local()
+
+
+class Trace(object):
+    """Timed spans of the work done for one request."""
+
+    def __init__(self, request_id, name):
+        self.request_id = request_id
+        self.name = name
+        self.start = time.time()
+        self.duration = None
+        self.spans = []
+        self.depth = 0
+
+    def to_dict(self):
+        return {'request_id': self.request_id,
+                'name': self.name,
+                'start': self.start,
+                'duration': self.duration,
+                'spans': self.spans}
+
+
+def current():
+    """Return the trace of the running greenthread, if any."""
+    return getattr(_local, 'trace', None)
+
+
+def start(request_id, name):
+    """Start tracing the running greenthread.
+
+    Returns None, and traces nothing, unless --trace_requests is set.
+
+    """
+    if not FLAGS.trace_requests:
+        return None
+    trace = Trace(request_id, name)
+    _local.trace = trace
+    return trace
+
+
+def finish(trace):
+    """Stop tracing the running greenthread and emit trace."""
+    if trace is None:
+        return
+    if current() is trace:
+        _local.trace = None
+    trace.duration = _ms(time.time() - trace.start)
+    if FLAGS.trace_file:
+        with open(FLAGS.trace_file, 'a') as trace_file:
+            trace_file.write(json.dumps(trace.to_dict()) + '\n')
+        return
+    LOG.info(_('trace %(request_id)s %(name)s took %(duration).1fms') %
+             trace.__dict__)
+    for span in trace.spans:
+        LOG.info('trace %s %s%s', trace.request_id,
+                 '  ' * span['depth'], _format_span(span))
+
+
+@contextlib.contextmanager
+def span(kind, name, **info):
+    """Record the block as a span of the current trace.
+
+    Yields the span dict, so the block can add to its info, or None when
+    nothing is being traced.
+
+    """
+    trace = current()
+    if trace is None:
+        yield None
+        return
+    started = time.time()
+    record = {'kind': kind,
+              'name': name,
+              'depth': trace.depth,
+              'offset': _ms(started - trace.start)}
+    record.update(info)
+    trace.spans.append(record)
+    trace.depth += 1
+    try:
+        yield record
+    finally:
+        trace.depth -= 1
+        record['duration'] = _ms(time.time() - started)
+
+
+def _decorator(kind, name, fn):
+    @functools.wraps(fn)
+    def wrapped_func(*args, **kwargs):
+        with span(kind, name) as record:
+            result = fn(*args, **kwargs)
+            if record is not None:
+                if isinstance(result, (list, tuple)):
+                    record['rows'] = len(result)
+                elif result is not None:
+                    record['rows'] = 1
+                else:
+                    record['rows'] = 0
+            return result
+    return wrapped_func
+
+
+def db_decorator(name, fn):
+    """Trace decorator for db backends, used from utils.monkey_patch()
+
+    :param name: name of the function
+    :param function: - object of the function
+    :returns: function -- decorated function
+
+    """
+    return _decorator('db', name.rpartition('.')[2], fn)
+
+
+def image_decorator(name, fn):
+    """Trace decorator for image services, used from utils.monkey_patch()
+
+    :param name: name of the function
+    :param function: - object of the function
+    :returns: function -- decorated function
+
+    """
+    return _decorator('image', name.rpartition('.')[2], fn)
+
+
+class TracedApplication(object):
+    """Records a WSGI stage as a span.
+
+    The outermost stage of a pipeline also starts and finishes the trace of
+    the request, taking the request id from the context the inner stages
+    put in the environ.
+
+    """
+
+    def __init__(self, name, application):
+        self.name = name
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        if current() is not None:
+            with span('wsgi', self.name):
+                return self.application(environ, start_response)
+
+        trace = start(None, '%s %s%s' % (environ.get('REQUEST_METHOD'),
+                                         environ.get('SCRIPT_NAME', ''),
+                                         environ.get('PATH_INFO', '')))
+        try:
+            with span('wsgi', self.name):
+                return self.application(environ, start_response)
+        finally:
+            ctxt = environ.get('nova.context')
+            if trace is not None and ctxt is not None:
+                trace.request_id = ctxt.request_id
+            finish(trace)
+
+
+def wrap_application(name, application):
+    """Wrap a WSGI application so it is traced if tracing is on."""
+    if not FLAGS.trace_requests:
+        return application
+    return TracedApplication(name, application)
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+def _format_span(span):
+    extra = ' '.join('%s=%s' % (key, value)
+                     for key, value in sorted(span.iteritems())
+                     if key not in ('kind', 'name', 'depth', 'offset',
+                                    'duration'))
+    return ('%(kind)s %(name)s +%(offset).1fms %(duration).1fms' % span +
+            (extra and ' ' + extra))
@@ -48,6 +48,7 @@ from eventlet.green import subprocess
 from nova import exception
 from nova import flags
 from nova import log as logging
+from nova import roothelper
 from nova import version
 
 
@@ -129,6 +130,39 @@ def fetchfile(url, target):
     execute('curl', '--fail', url, '-o', target)
 
 
+def _root_helper_cmd(cmd):
+    return shlex.split(FLAGS.root_helper) + list(cmd)
+
+
+def start_process(*cmd, **kwargs):
+    """
+    Start cmd with its standard output and error piped to the caller.
+
+    :run_as_root        True | False. Defaults to False. If set to True,
+                        the command is prefixed by the command specified
+                        in the root_helper FLAG. The root helper process
+                        is not used, as it only replies once the command
+                        has finished.
+
+    :returns the subprocess.Popen object of the command
+    :raises exception.Error on receiving unknown arguments
+    """
+
+    run_as_root = kwargs.pop('run_as_root', False)
+    if len(kwargs):
+        raise exception.Error(_('Got unknown keyword args '
+                                'to utils.start_process: %r') % kwargs)
+
+    if run_as_root:
+        cmd = _root_helper_cmd(cmd)
+    cmd = map(str, cmd)
+    LOG.debug(_('Running cmd (subprocess): %s'), ' '.join(cmd))
+    return subprocess.Popen(cmd,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            close_fds=True)
+
+
 def execute(*cmd, **kwargs):
     """
     Helper method to execute command with optional retry.
@@ -142,7 +176,8 @@ def execute(*cmd, **kwargs):
     :attempts           How many times to retry cmd.
     :run_as_root        True | False. Defaults to False. If set to True,
                         the command is prefixed by the command specified
-                        in the root_helper FLAG.
+                        in the root_helper FLAG, or is run by the root
+                        helper process if use_root_helper_daemon is set.
 
     :raises exception.Error on receiving unknown arguments
     :raises exception.ProcessExecutionError
@@ -157,27 +192,37 @@ def execute(*cmd, **kwargs):
         raise exception.Error(_('Got unknown keyword args '
                                 'to utils.execute: %r') % kwargs)
 
+    helper_cmd = None
+    if run_as_root and FLAGS.use_root_helper_daemon:
+        helper_cmd = map(str, cmd)
     if run_as_root:
-        cmd = shlex.split(FLAGS.root_helper) + list(cmd)
+        cmd = _root_helper_cmd(cmd)
     cmd = map(str, cmd)
 
     while attempts > 0:
         attempts -= 1
         try:
-            LOG.debug(_('Running cmd (subprocess): %s'), ' '.join(cmd))
-            _PIPE = subprocess.PIPE  # pylint: disable=E1101
-            obj = subprocess.Popen(cmd,
-                                   stdin=_PIPE,
-                                   stdout=_PIPE,
-                                   stderr=_PIPE,
-                                   close_fds=True)
-            result = None
-            if process_input is not None:
-                result = obj.communicate(process_input)
+            helper_result = None
+            if helper_cmd:
+                helper_result = roothelper.execute(helper_cmd, process_input)
+            if helper_result is not None:
+                _returncode, stdout, stderr = helper_result
+                result = (stdout, stderr)
             else:
-                result = obj.communicate()
-            obj.stdin.close()  # pylint: disable=E1101
-            _returncode = obj.returncode  # pylint: disable=E1101
+                LOG.debug(_('Running cmd (subprocess): %s'), ' '.join(cmd))
+                _PIPE = subprocess.PIPE  # pylint: disable=E1101
+                obj = subprocess.Popen(cmd,
+                                       stdin=_PIPE,
+                                       stdout=_PIPE,
+                                       stderr=_PIPE,
+                                       close_fds=True)
+                result = None
+                if process_input is not None:
+                    result = obj.communicate(process_input)
+                else:
+                    result = obj.communicate()
+                obj.stdin.close()  # pylint: disable=E1101
+                _returncode = obj.returncode  # pylint: disable=E1101
             if _returncode:
                 LOG.debug(_('Result was %s') % _returncode)
                 if type(check_exit_code) == types.IntType \
@@ -203,42 +248,6 @@ def execute(*cmd, **kwargs):
             greenthread.sleep(0)
 
 
-def ssh_execute(ssh, cmd, process_input=None,
-                addl_env=None, check_exit_code=True):
-    LOG.debug(_('Running cmd (SSH): %s'), ' '.join(cmd))
-    if addl_env:
-        raise exception.Error(_('Environment not supported over SSH'))
-
-    if process_input:
-        # This is (probably) fixable if we need it...
-        raise exception.Error(_('process_input not supported over SSH'))
-
-    stdin_stream, stdout_stream, stderr_stream = ssh.exec_command(cmd)
-    channel = stdout_stream.channel
-
-    #stdin.write('process_input would go here')
-    #stdin.flush()
-
-    # NOTE(justinsb): This seems suspicious...
-    # ...other SSH clients have buffering issues with this approach
-    stdout = stdout_stream.read()
-    stderr = stderr_stream.read()
-    stdin_stream.close()
-
-    exit_status = channel.recv_exit_status()
-
-    # exit_status == -1 if no exit code was returned
-    if exit_status != -1:
-        LOG.debug(_('Result was %s') % exit_status)
-        if check_exit_code and exit_status != 0:
-            raise exception.ProcessExecutionError(exit_code=exit_status,
-                                                  stdout=stdout,
-                                                  stderr=stderr,
-                                                  cmd=' '.join(cmd))
-
-    return (stdout, stderr)
-
-
 def abspath(s):
     return os.path.join(os.path.dirname(__file__), s)
 
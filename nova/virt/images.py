@@ -21,6 +21,7 @@
 Handling of VM disk images.
 """
 
+import gzip
 import os
 
 from nova import exception
@@ -59,14 +60,68 @@ def fetch(context, image_href, path, _user_id, _project_id):
     (image_service, image_id) = nova.image.get_image_service(context,
                                                              image_href)
     with open(path, "wb") as image_file:
-        metadata = image_service.get(context, image_id, image_file)
+        sparse_file = SparseFile(image_file)
+        metadata = image_service.get(context, image_id, sparse_file)
+        sparse_file.finish()
     return metadata
 
 
+class SparseFile(object):
+    """Writes a file, seeking over blocks of zeros instead of writing them.
+
+    Images fetched or unpacked this way only take the disk space of their
+    data, and a block device created from them can skip the holes.
+    """
+
+    def __init__(self, image_file):
+        self.image_file = image_file
+
+    def write(self, data):
+        if data.count('\0') == len(data):
+            self.image_file.seek(len(data), os.SEEK_CUR)
+        else:
+            self.image_file.write(data)
+
+    def finish(self):
+        """Sets the size of the file, in case it ends with a hole."""
+        self.image_file.truncate()
+
+
+def _decompress(path, target):
+    """Unpacks the gzip-compressed image at path into target."""
+    compressed = gzip.open(path, 'rb')
+    try:
+        with open(target, 'wb') as image_file:
+            sparse_file = SparseFile(image_file)
+            while True:
+                chunk = compressed.read(1024 * 1024)
+                if not chunk:
+                    break
+                sparse_file.write(chunk)
+            sparse_file.finish()
+    finally:
+        compressed.close()
+
+
 def fetch_to_raw(context, image_href, path, user_id, project_id):
     path_tmp = "%s.part" % path
     metadata = fetch(context, image_href, path_tmp, user_id, project_id)
 
+    # NOTE: snapshots uploaded with --snapshot_compression are gzipped
+    properties = metadata.get('properties') or {}
+    if properties.get('compression') == 'gzip':
+        LOG.debug(_("%s is gzip-compressed, unpacking") % image_href)
+        staged = "%s.unpacked" % path
+        try:
+            _decompress(path_tmp, staged)
+        except IOError:
+            os.unlink(path_tmp)
+            if os.path.exists(staged):
+                os.unlink(staged)
+            raise exception.ImageUnacceptable(image_id=image_href,
+                reason=_("Unable to unpack gzip-compressed image"))
+        os.rename(staged, path_tmp)
+
     def _qemu_img_info(path):
 
         out, err = utils.execute('env', 'LC_ALL=C', 'LANG=C',
@@ -39,12 +39,12 @@ Supports KVM, LXC, QEMU, UML, and XEN.
 
 import hashlib
 import functools
+import json
 import multiprocessing
 import os
 import random
 import shutil
 import sys
-import tempfile
 import time
 from timemodule import sleep
 import uuid
@@ -66,7 +66,11 @@ from nova.compute import power_state
 from nova.virt import disk
 from nova.virt import driver
 from nova.virt import images
+from nova.virt.libvirt import events
+from nova.virt.libvirt import incremental
+from nova.virt.libvirt import inventory
 from nova.virt.libvirt.image import select_driver
+from nova.volume import wipe
 
 
 libvirt = None
@@ -98,7 +102,7 @@ flags.DEFINE_bool('allow_same_net_traffic',
                     True,
                     'Whether to allow network traffic from same network')
 flags.DEFINE_enum('local_images_type', 'legacy',
-                    ['raw', 'qcow', 'lvm', 'legacy'],
+                    ['raw', 'qcow', 'lvm', 'lvm-thin', 'legacy'],
                     'Image type for VM')
 flags.DEFINE_bool('use_cow_images',
                   True,
@@ -106,6 +110,24 @@ flags.DEFINE_bool('use_cow_images',
 flags.DEFINE_string('lvm_volume_group',
                     'os_images',
                     'LVM virtual volume group for lvm images')
+flags.DEFINE_string('lvm_thin_pool',
+                    'thinpool',
+                    'Thin pool in lvm_volume_group for lvm-thin images')
+flags.DEFINE_bool('snapshot_compression',
+                  False,
+                  'gzip-compress snapshots while they are streamed to the '
+                  'image service')
+flags.DEFINE_bool('incremental_snapshots',
+                  False,
+                  'snapshot local volumes incrementally, uploading only the '
+                  'chunks that changed since the previous snapshot')
+flags.DEFINE_integer('incremental_snapshot_chunk_size',
+                     64 * 1024 * 1024,
+                     'size in bytes of the chunks of incremental snapshots')
+flags.DEFINE_integer('incremental_snapshot_max_chain',
+                     7,
+                     'take a full snapshot after this many snapshots of a '
+                     'chain of incremental snapshots')
 flags.DEFINE_string('ajaxterm_portrange',
                     '10000-12000',
                     'Range of ports that ajaxterm should randomly try to bind')
@@ -143,6 +165,14 @@ flags.DEFINE_string('default_local_format',
 flags.DEFINE_bool('libvirt_use_virtio_for_bridges',
                   False,
                   'Use virtio for bridge interfaces')
+flags.DEFINE_bool('libvirt_domain_events',
+                  True,
+                  'Track domain power states with libvirt lifecycle events '
+                  'instead of polling each domain')
+flags.DEFINE_integer('libvirt_wait_timeout',
+                     300,
+                     'Seconds to wait for a domain to reach the expected '
+                     'power state after boot, reboot or destroy')
 
 
 def get_connection(read_only):
@@ -168,6 +198,23 @@ def _late_load_cheetah():
         Template = t.Template
 
 
+_template_classes = {}
+
+
+def _render_template(source, search_list):
+    """Render a Cheetah template, compiling it only once per process.
+
+    Template(source, ...) parses and compiles the source on every call, so
+    the compiled template class is kept, keyed by the template source.
+
+    """
+    template_class = _template_classes.get(source)
+    if template_class is None:
+        template_class = Template.compile(source=source)
+        _template_classes[source] = template_class
+    return str(template_class(searchList=search_list))
+
+
 def _get_eph_disk(ephemeral):
     return 'disk.eph' + str(ephemeral['num'])
 
@@ -187,16 +234,25 @@ class LibvirtConnection(driver.ComputeDriver):
         self.firewall_driver = fw_class(get_connection=self._get_connection)
         self.vif_driver = utils.import_object(FLAGS.libvirt_vif_driver)
         self.image_driver = select_driver()
+        self.domain_states = events.DomainStateTable()
+        self.domain_inventory = inventory.DomainInventory()
 
     def init_host(self, host):
         # NOTE(nsokolov): moved instance restarting to ComputeManager
-        pass
+        if (FLAGS.background_volume_wipe and
+            FLAGS.local_images_type in ('lvm', 'lvm-thin')):
+            # NOTE: resumes wiping the volumes deleted before a restart
+            wipe.get_queue(FLAGS.lvm_volume_group)
 
     def _get_connection(self):
         if not self._wrapped_conn or not self._test_connection():
             LOG.debug(_('Connecting to libvirt: %s'), self.libvirt_uri)
+            use_events = (FLAGS.libvirt_domain_events and
+                          self.domain_states.start())
             self._wrapped_conn = self._connect(self.libvirt_uri,
                                                self.read_only)
+            if use_events:
+                self.domain_states.register(self._wrapped_conn)
         return self._wrapped_conn
     _conn = property(_get_connection)
 
@@ -253,6 +309,11 @@ class LibvirtConnection(driver.ComputeDriver):
         return driver.InstanceInfo(name, state)
 
     def list_instances_detail(self):
+        if self.domain_states.running:
+            # NOTE: like listDomainsID(), only report active domains
+            return [driver.InstanceInfo(name, state)
+                    for name, state in self.domain_states.states.iteritems()
+                    if state != power_state.SHUTOFF]
         infos = []
         for domain_id in self._conn.listDomainsID():
             domain = self._conn.lookupByID(domain_id)
@@ -328,19 +389,21 @@ class LibvirtConnection(driver.ComputeDriver):
             for (network, mapping) in network_info:
                 self.vif_driver.unplug(instance, network, mapping)
 
-        def _wait_for_destroy():
-            """Called at an interval until the VM is gone."""
-            instance_name = instance['name']
+            self.domain_inventory.invalidate(virt_dom)
 
-            try:
-                state = self.get_info(instance_name)['state']
-            except exception.NotFound:
+            # NOTE: the domain is gone now, don't wait for the events
+            if self.domain_states.running:
+                self.domain_states.update(instance_name, None)
+
+        def _wait_for_destroy(state):
+            """Called on power state changes until the VM is gone."""
+            if state is None:
                 msg = _("Instance %s destroyed successfully.") % instance_name
                 LOG.info(msg)
-                raise utils.LoopingCallDone
+                return True
+            return False
 
-        timer = utils.LoopingCall(_wait_for_destroy)
-        timer.start(interval=0.5, now=True)
+        self._watch_power_state(instance_name, _wait_for_destroy)
 
         self.firewall_driver.unfilter_instance(instance,
                                                network_info=network_info)
@@ -373,12 +436,30 @@ class LibvirtConnection(driver.ComputeDriver):
     def _local_volume_image_info(self, instance_name, volume_name):
         return self.image_driver.libvirt_image_info(instance_name, volume_name, '.localvolume')
 
+    def _snapshot_cache_name(self, context, snapshot_id):
+        """Name of the base file of a snapshot in the image cache.
+
+        The name is derived from the snapshot and its checksum, so all the
+        volumes restored from a snapshot share one base file, which the
+        volumes of image types with copy-on-write images (qcow, lvm-thin)
+        are created on top of.
+
+        """
+        (image_service, image_id) = nova.image.get_image_service(context,
+                                                                 snapshot_id)
+        fname = hashlib.sha1(str(image_id)).hexdigest()
+        checksum = image_service.show(context, image_id).get('checksum')
+        if checksum:
+            fname += '-' + checksum
+        return fname
+
     @exception.wrap_exception()
     def create_local_volume(self, context, instance, volume_name, size, snapshot_id=None):
         image = self._local_volume_image(instance['name'], volume_name)
 
         if snapshot_id:
-            base_path = self._cache_image(self._fetch_image, volume_name,
+            base_path = self._cache_image(self._fetch_snapshot,
+                self._snapshot_cache_name(context, snapshot_id),
                 context=context,
                 image_id=snapshot_id,
                 user_id=instance['user_id'],
@@ -401,6 +482,9 @@ class LibvirtConnection(driver.ComputeDriver):
     def delete_local_volume(self, instance, volume_name):
         image = self._local_volume_image(instance['name'], volume_name)
         image.delete()
+        state_path = self._snapshot_state_path(instance['name'], volume_name)
+        if os.path.exists(state_path):
+            os.unlink(state_path)
 
     @exception.wrap_exception()
     def resize_local_volume(self, instance, volume_name, new_size):
@@ -420,6 +504,7 @@ class LibvirtConnection(driver.ComputeDriver):
                     <target dev='%(target_device)s' bus='virtio'/>
                  </disk>""" % image_info
         virt_dom.attachDevice(xml)
+        self.domain_inventory.invalidate(virt_dom)
         LOG.debug(_("local volume %s: attached successfully to instance (instance name: %s)"),
             image.path(), instance_name)
 
@@ -442,35 +527,23 @@ class LibvirtConnection(driver.ComputeDriver):
                          <target dev='%s' bus='virtio'/>
                      </disk>""" % (protocol, name, mount_device)
         virt_dom.attachDevice(xml)
+        self.domain_inventory.invalidate(virt_dom)
 
-    def _get_disk_xml(self, xml, device):
+    def _get_disk_xml(self, virt_dom, device):
         """Returns the xml for the disk mounted at device"""
-        try:
-            doc = libxml2.parseDoc(xml)
-        except Exception:
-            return None
-        ctx = doc.xpathNewContext()
-        try:
-            ret = ctx.xpathEval('/domain/devices/disk')
-            for node in ret:
-                for child in node.children:
-                    if child.name == 'target':
-                        if child.prop('dev') == device:
-                            return str(node)
-        finally:
-            if ctx is not None:
-                ctx.xpathFreeContext()
-            if doc is not None:
-                doc.freeDoc()
+        for disk in self.domain_inventory.get(virt_dom)['disks']:
+            if disk['target'] == device:
+                return disk['xml']
 
     @exception.wrap_exception()
     def detach_volume(self, instance_name, mountpoint):
         virt_dom = self._lookup_by_name(instance_name)
         mount_device = mountpoint.rpartition("/")[2]
-        xml = self._get_disk_xml(virt_dom.XMLDesc(0), mount_device)
+        xml = self._get_disk_xml(virt_dom, mount_device)
         if not xml:
             raise exception.DiskNotFound(location=mount_device)
         virt_dom.detachDevice(xml)
+        self.domain_inventory.invalidate(virt_dom)
 
     def _create_snapshot_metadata(self, context, instance, snapshot_href, disk_href=None):
         base = {}
@@ -508,9 +581,13 @@ class LibvirtConnection(driver.ComputeDriver):
         if 'container_format' in base:
             metadata['container_format'] = base['container_format']
 
+        if FLAGS.snapshot_compression:
+            metadata['properties']['compression'] = 'gzip'
+
         return image_service, metadata
 
-    def _snapshot(self, image, instance, upload_snapshot, force_live_snapshot):
+    def _snapshot(self, image, instance, upload_snapshot, force_live_snapshot,
+                  compress=False):
         """
         Make snapshot of image and export it to glance
         """
@@ -519,15 +596,13 @@ class LibvirtConnection(driver.ComputeDriver):
 
         snapshot_name = uuid.uuid4().hex
 
-        temp_dir = tempfile.mkdtemp()
-        snapshot_path = os.path.join(temp_dir, snapshot_name)
-        try:
-            with image.make_snapshot(virt_dom, snapshot_name,
-                force_live_snapshot) as snapshot:
-                snapshot.convert_to_raw(snapshot_path)
-                upload_snapshot(snapshot_path=snapshot_path)
-        finally:
-            shutil.rmtree(temp_dir)
+        with image.make_snapshot(virt_dom, snapshot_name,
+            force_live_snapshot) as snapshot:
+            image_file = snapshot.open_raw(compress)
+            try:
+                upload_snapshot(image_file=image_file)
+            finally:
+                image_file.close()
 
     @exception.wrap_exception()
     def snapshot_local_volume(self, context, volume_name, instance, snapshot_href, force_live_snapshot):
@@ -536,13 +611,24 @@ class LibvirtConnection(driver.ComputeDriver):
         """
         image_service, metadata = self._create_snapshot_metadata(context,
             instance, snapshot_href)
+        image = self._local_volume_image(instance['name'], volume_name)
+
+        if FLAGS.incremental_snapshots:
+            upload_snapshot = functools.partial(
+                self._upload_incremental_snapshot, context=context,
+                image_service=image_service, metadata=metadata,
+                snapshot_href=snapshot_href, instance=instance,
+                volume_name=volume_name)
+            self._snapshot(image, instance, upload_snapshot,
+                           force_live_snapshot)
+            return
 
         upload_snapshot = functools.partial(self._upload_snapshot, context=context,
             image_service=image_service, metadata=metadata,
             snapshot_href=snapshot_href)
 
-        image = self._local_volume_image(instance['name'], volume_name)
-        self._snapshot(image, instance, upload_snapshot, force_live_snapshot)
+        self._snapshot(image, instance, upload_snapshot, force_live_snapshot,
+                       FLAGS.snapshot_compression)
 
     @exception.wrap_exception()
     def snapshot(self, context, instance, snapshot_href, force_live_snapshot):
@@ -558,15 +644,98 @@ class LibvirtConnection(driver.ComputeDriver):
         upload_snapshot = functools.partial(self._upload_snapshot, context=context,
             image_service=image_service, metadata=metadata, snapshot_href=snapshot_href)
 
-        self._snapshot(image, instance, upload_snapshot, force_live_snapshot)
+        self._snapshot(image, instance, upload_snapshot, force_live_snapshot,
+                       FLAGS.snapshot_compression)
 
-    def _upload_snapshot(self, context, image_service, metadata, snapshot_href, snapshot_path):
+    def _upload_snapshot(self, context, image_service, metadata, snapshot_href, image_file):
         # Upload this snapshot to the image service
-        with open(snapshot_path) as image_file:
-            image_service.update(context,
-                snapshot_href,
-                metadata,
-                image_file)
+        image_service.update(context,
+            snapshot_href,
+            metadata,
+            image_file)
+
+    def _snapshot_state_path(self, instance_name, volume_name):
+        return os.path.join(FLAGS.instances_path, instance_name,
+                            '%s.snapshot' % volume_name)
+
+    def _incremental_snapshot_parent(self, context, image_service,
+                                     state_path):
+        """Returns the id and properties of the snapshot to diff against.
+
+        That is the last snapshot of the volume, unless it is gone, was
+        taken with another chunk size or ends a chain that is long enough.
+
+        """
+        try:
+            with open(state_path) as state_file:
+                parent_id = json.load(state_file)['image_id']
+            parent = image_service.show(context, parent_id)
+        except (IOError, ValueError, KeyError, exception.ImageNotFound):
+            return None, None
+
+        properties = parent.get('properties') or {}
+        if (parent.get('status') != 'active' or parent.get('deleted') or
+            not incremental.is_incremental(parent) or
+            properties.get('image_state') != 'available' or
+            int(properties['chunk_size']) !=
+                FLAGS.incremental_snapshot_chunk_size or
+            int(properties['chain_length']) >=
+                FLAGS.incremental_snapshot_max_chain):
+            return None, None
+        return parent_id, properties
+
+    def _upload_incremental_snapshot(self, context, image_service, metadata,
+                                     snapshot_href, instance, volume_name,
+                                     image_file):
+        state_path = self._snapshot_state_path(instance['name'], volume_name)
+        parent_id, parent_properties = self._incremental_snapshot_parent(
+            context, image_service, state_path)
+        parent_hashes = None
+        chain_length = 1
+        if parent_id is not None:
+            parent_hashes = incremental.fetch_manifest(
+                context, image_service, parent_properties)
+            chain_length = int(parent_properties['chain_length']) + 1
+
+        chunk_size = FLAGS.incremental_snapshot_chunk_size
+        chunks = incremental.ChangedChunks(image_file, chunk_size,
+                                           parent_hashes)
+        properties = metadata['properties']
+        properties.pop('compression', None)
+        properties['snapshot_type'] = incremental.SNAPSHOT_TYPE
+        properties['image_state'] = 'uploading'
+        image_service.update(context, snapshot_href, metadata, chunks)
+
+        # NOTE: the manifest is only known once the whole volume was read,
+        #       so its id is added by a second, metadata only, update.
+        manifest_id = incremental.upload_manifest(context, image_service,
+                                                  metadata, chunks.hashes)
+        properties.update({'image_state': 'available',
+                           'chunk_size': chunks.chunk_size,
+                           'volume_size': chunks.size,
+                           'chain_length': chain_length,
+                           'manifest_id': manifest_id})
+        if parent_id is not None:
+            properties['parent_id'] = parent_id
+        image_service.update(context, snapshot_href, metadata)
+
+        with open(state_path, 'w') as state_file:
+            json.dump({'image_id': snapshot_href}, state_file)
+        LOG.info(_('local volume %(volume_name)s: uploaded %(changed)d of '
+                   '%(count)d chunks') % {'volume_name': volume_name,
+                                          'changed': chunks.changed,
+                                          'count': len(chunks.hashes)})
+
+    def _fetch_snapshot(self, context, target, image_id, user_id,
+                        project_id):
+        """Grab a local volume snapshot, reassembling incremental ones"""
+        (image_service, snapshot_id) = nova.image.get_image_service(
+            context, image_id)
+        if incremental.is_incremental(image_service.show(context,
+                                                         snapshot_id)):
+            incremental.restore(context, image_service, snapshot_id, target)
+        else:
+            self._fetch_image(context, target, image_id, user_id, project_id)
 
     @exception.wrap_exception()
     def reboot(self, instance, network_info, xml=None):
@@ -593,24 +762,16 @@ class LibvirtConnection(driver.ComputeDriver):
         self._create_new_domain(xml)
         self.firewall_driver.apply_instance_filter(instance, network_info)
 
-        def _wait_for_reboot():
-            """Called at an interval until the VM is running again."""
-            instance_name = instance['name']
-
-            try:
-                state = self.get_info(instance_name)['state']
-            except exception.NotFound:
-                msg = _("During reboot, %s disappeared.") % instance_name
-                LOG.error(msg)
-                raise utils.LoopingCallDone
-
+        def _wait_for_reboot(state):
+            """Called on power state changes until the VM is running again."""
             if state == power_state.RUNNING:
-                msg = _("Instance %s rebooted successfully.") % instance_name
+                msg = _("Instance %s rebooted successfully.") % \
+                      instance['name']
                 LOG.info(msg)
-                raise utils.LoopingCallDone
+                return True
+            return False
 
-        timer = utils.LoopingCall(_wait_for_reboot)
-        return timer.start(interval=0.5, now=True)
+        return self._watch_power_state(instance['name'], _wait_for_reboot)
 
     @exception.wrap_exception()
     def pause(self, instance, callback):
@@ -703,23 +864,47 @@ class LibvirtConnection(driver.ComputeDriver):
         LOG.debug(_("instance %s: is running"), instance['name'])
         self.firewall_driver.apply_instance_filter(instance, network_info)
 
-        def _wait_for_boot():
-            """Called at an interval until the VM is running."""
-            instance_name = instance['name']
+        def _wait_for_boot(state):
+            """Called on power state changes until the VM is running."""
+            if state == power_state.RUNNING:
+                msg = _("Instance %s spawned successfully.") % \
+                      instance['name']
+                LOG.info(msg)
+                return True
+            return False
+
+        return self._watch_power_state(instance['name'], _wait_for_boot)
 
+    def _watch_power_state(self, instance_name, callback):
+        """Call callback with the power state of instance_name as it changes.
+
+        callback gets None while the domain does not exist, and is called
+        until it returns True or libvirt_wait_timeout seconds have passed.
+        Returns an event sent True in the first case and False otherwise.
+
+        The states come from the domain event table, or from polling the
+        domain if libvirt can't deliver events.
+
+        """
+        if self.domain_states.running:
+            return self.domain_states.watch(instance_name, callback,
+                                            FLAGS.libvirt_wait_timeout)
+
+        deadline = time.time() + FLAGS.libvirt_wait_timeout
+
+        def _poll_power_state():
             try:
                 state = self.get_info(instance_name)['state']
             except exception.NotFound:
-                msg = _("During reboot, %s disappeared.") % instance_name
-                LOG.error(msg)
-                raise utils.LoopingCallDone
-
-            if state == power_state.RUNNING:
-                msg = _("Instance %s spawned successfully.") % instance_name
-                LOG.info(msg)
-                raise utils.LoopingCallDone
-
-        timer = utils.LoopingCall(_wait_for_boot)
+                state = None
+            if callback(state):
+                raise utils.LoopingCallDone(True)
+            if time.time() > deadline:
+                LOG.warn(_('Instance %s did not reach the expected state '
+                           'in time'), instance_name)
+                raise utils.LoopingCallDone(False)
+
+        timer = utils.LoopingCall(_poll_power_state)
         return timer.start(interval=0.5, now=True)
 
     def _flush_xen_console(self, virsh_output):
@@ -1278,11 +1463,10 @@ class LibvirtConnection(driver.ComputeDriver):
 
     def to_xml(self, instance, network_info, rescue=False,
                block_device_info=None):
-        # TODO(termie): cache?
         LOG.debug(_('instance %s: starting toXML method'), instance['name'])
         xml_info = self._prepare_xml_info(instance, network_info, rescue,
                                           block_device_info)
-        xml = str(Template(self.libvirt_xml, searchList=[xml_info]))
+        xml = _render_template(self.libvirt_xml, [xml_info])
         LOG.debug(_('instance %s: finished toXML method'), instance['name'])
         return xml
 
@@ -1336,52 +1520,35 @@ class LibvirtConnection(driver.ComputeDriver):
             # createXML call creates a transient domain
             domain = self._conn.createXML(xml, launch_flags)
 
+        self.domain_inventory.invalidate(domain)
         return domain
 
     def get_diagnostics(self, instance_name):
         raise exception.ApiError(_("diagnostics are not supported "
                                    "for libvirt"))
 
+    def _domain_info(self, instance_name):
+        """Return the parsed description of domain instance_name.
+
+        While domain events keep the inventory current, a cached
+        description is returned without asking libvirt at all.
+
+        """
+        if (self.domain_states.running and
+            instance_name in self.domain_states.states):
+            info = self.domain_inventory.get_cached(instance_name)
+            if info is not None:
+                return info
+        return self.domain_inventory.get(self._lookup_by_name(instance_name))
+
     def get_disks(self, instance_name):
         """
         Note that this function takes an instance name.
 
         Returns a list of all block devices for this domain.
         """
-        domain = self._lookup_by_name(instance_name)
-        # TODO(devcamcar): Replace libxml2 with etree.
-        xml = domain.XMLDesc(0)
-        doc = None
-
-        try:
-            doc = libxml2.parseDoc(xml)
-        except Exception:
-            return []
-
-        ctx = doc.xpathNewContext()
-        disks = []
-
-        try:
-            ret = ctx.xpathEval('/domain/devices/disk')
-
-            for node in ret:
-                devdst = None
-
-                for child in node.children:
-                    if child.name == 'target':
-                        devdst = child.prop('dev')
-
-                if devdst is None:
-                    continue
-
-                disks.append(devdst)
-        finally:
-            if ctx is not None:
-                ctx.xpathFreeContext()
-            if doc is not None:
-                doc.freeDoc()
-
-        return disks
+        return [disk['target']
+                for disk in self._domain_info(instance_name)['disks']]
 
     def get_interfaces(self, instance_name):
         """
@@ -1389,40 +1556,7 @@ class LibvirtConnection(driver.ComputeDriver):
 
         Returns a list of all network interfaces for this instance.
         """
-        domain = self._lookup_by_name(instance_name)
-        # TODO(devcamcar): Replace libxml2 with etree.
-        xml = domain.XMLDesc(0)
-        doc = None
-
-        try:
-            doc = libxml2.parseDoc(xml)
-        except Exception:
-            return []
-
-        ctx = doc.xpathNewContext()
-        interfaces = []
-
-        try:
-            ret = ctx.xpathEval('/domain/devices/interface')
-
-            for node in ret:
-                devdst = None
-
-                for child in node.children:
-                    if child.name == 'target':
-                        devdst = child.prop('dev')
-
-                if devdst is None:
-                    continue
-
-                interfaces.append(devdst)
-        finally:
-            if ctx is not None:
-                ctx.xpathFreeContext()
-            if doc is not None:
-                doc.freeDoc()
-
-        return interfaces
+        return list(self._domain_info(instance_name)['interfaces'])
 
     def get_vcpu_total(self):
         """Get vcpu number of physical computer.
@@ -1476,15 +1610,18 @@ class LibvirtConnection(driver.ComputeDriver):
         """
 
         total = 0
+        if self.domain_states.running:
+            for name, state in self.domain_states.states.items():
+                if state != power_state.SHUTOFF:
+                    try:
+                        total += self._domain_info(name)['vcpus']
+                    except exception.NotFound:
+                        pass
+            return total
+
         for dom_id in self._conn.listDomainsID():
             dom = self._conn.lookupByID(dom_id)
-            vcpus = dom.vcpus()
-            if vcpus is None:
-                # dom.vcpus is not implemented for lxc, but returning 0 for
-                # a used count is hardly useful for something measuring usage
-                total += 1
-            else:
-                total += len(vcpus[1])
+            total += self.domain_inventory.get(dom)['vcpus']
         return total
 
     def get_memory_mb_used(self):
@@ -1688,7 +1825,7 @@ class LibvirtConnection(driver.ComputeDriver):
 
         LOG.info(_('Instance launched has CPU info:\n%s') % cpu_info)
         dic = utils.loads(cpu_info)
-        xml = str(Template(self.cpuinfo_xml, searchList=dic))
+        xml = _render_template(self.cpuinfo_xml, dic)
         LOG.info(_('to xml...\n:%s ' % xml))
 
         u = "http://libvirt.org/html/libvirt-libvirt.html#virCPUCompareResult"
@@ -1914,6 +2051,7 @@ class LibvirtConnection(driver.ComputeDriver):
             # included in to_xml() result.
             dom = self._lookup_by_name(instance_ref.name)
             self._conn.defineXML(dom.XMLDesc(0))
+            self.domain_inventory.invalidate(dom)
 
     def get_instance_disk_info(self, ctxt, instance_ref):
         """Preparation block migration.
@@ -1930,27 +2068,18 @@ class LibvirtConnection(driver.ComputeDriver):
         disk_info = []
 
         virt_dom = self._lookup_by_name(instance_ref.name)
-        xml = virt_dom.XMLDesc(0)
-        doc = libxml2.parseDoc(xml)
-        disk_nodes = doc.xpathEval('//devices/disk')
-        path_nodes = doc.xpathEval('//devices/disk/source')
-        driver_nodes = doc.xpathEval('//devices/disk/driver')
 
-        for cnt, path_node in enumerate(path_nodes):
-            disk_type = disk_nodes[cnt].get_properties().getContent()
-            path = path_node.get_properties().getContent()
+        for disk in self.domain_inventory.get(virt_dom)['disks']:
+            path = disk['source']
+            if path is None:
+                continue
 
-            if disk_type != 'file':
+            if disk['type'] != 'file':
                 LOG.debug(_('skipping %(path)s since it looks like volume') %
                           locals())
                 continue
 
-            # In case of libvirt.xml, disk type can be obtained
-            # by the below statement.
-            # -> disk_type = driver_nodes[cnt].get_properties().getContent()
-            # but this xml is generated by kvm, format is slightly different.
-            disk_type = \
-                driver_nodes[cnt].get_properties().get_next().getContent()
+            disk_type = disk['driver_type']
             if disk_type == 'raw':
                 size = int(os.path.getsize(path))
                 backing_file = ""
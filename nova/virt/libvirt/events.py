@@ -0,0 +1,213 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Domain power state table fed by libvirt lifecycle events.
+
+Instead of polling every domain, the libvirt driver subscribes to domain
+lifecycle events and keeps the power state of each domain in a table.
+Waiting for a domain to boot, reboot or go away registers a watch that is
+woken by the events, and list_instances_detail() is served from the table.
+
+libvirt delivers events from its own event loop, which has to run in a
+native thread. The callbacks only queue the events; a greenthread applies
+them to the table, so watches always run in greenthreads.
+
+"""
+
+import os
+
+import eventlet
+from eventlet import event
+from eventlet import greenio
+from eventlet import patcher
+
+from nova import log as logging
+from nova.compute import power_state
+
+
+native_threading = patcher.original('threading')
+native_Queue = patcher.original('Queue')
+
+libvirt = None
+
+LOG = logging.getLogger('nova.virt.libvirt.events')
+
+# NOTE: a lifecycle event means the domain is now in this power state,
+#       None means it no longer exists.
+_EVENT_STATES = {'VIR_DOMAIN_EVENT_DEFINED': power_state.SHUTOFF,
+                 'VIR_DOMAIN_EVENT_UNDEFINED': None,
+                 'VIR_DOMAIN_EVENT_STARTED': power_state.RUNNING,
+                 'VIR_DOMAIN_EVENT_SUSPENDED': power_state.PAUSED,
+                 'VIR_DOMAIN_EVENT_RESUMED': power_state.RUNNING,
+                 'VIR_DOMAIN_EVENT_STOPPED': power_state.SHUTOFF}
+
+
+class _Watch(object):
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.done = event.Event()
+        self.timer = None
+
+
+class DomainStateTable(object):
+    """Power states of the domains of one host, kept current by events."""
+
+    def __init__(self):
+        self.states = {}
+        self.running = False
+        self._started = None
+        self._watches = {}
+        self._event_states = {}
+        self._queue = native_Queue.Queue()
+        self._notify_send = None
+        self._notify_recv = None
+
+    def start(self):
+        """Start libvirt's event loop, returns False if unsupported.
+
+        Has to be called before the connections to watch are opened.
+
+        """
+        if self._started is not None:
+            return self._started
+        self._started = False
+
+        global libvirt
+        if libvirt is None:
+            libvirt = __import__('libvirt')
+        if not hasattr(libvirt, 'virEventRegisterDefaultImpl'):
+            LOG.warn(_('libvirt does not support domain events, polling '
+                       'domain states instead'))
+            return False
+
+        for name, state in _EVENT_STATES.iteritems():
+            if hasattr(libvirt, name):
+                self._event_states[getattr(libvirt, name)] = state
+
+        notify_recv, notify_send = os.pipe()
+        self._notify_send = notify_send
+        self._notify_recv = greenio.GreenPipe(notify_recv, 'rb', 0)
+
+        libvirt.virEventRegisterDefaultImpl()
+        event_thread = native_threading.Thread(target=self._run_event_loop)
+        event_thread.setDaemon(True)
+        event_thread.start()
+        eventlet.spawn_n(self._dispatch_events)
+        self._started = True
+        return True
+
+    def register(self, conn):
+        """Subscribe to the lifecycle events of conn and load its states.
+
+        Called for every new connection, as the subscription is lost with
+        the connection it was made on.
+
+        """
+        try:
+            conn.domainEventRegisterAny(None,
+                                        libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                        self._queue_event, None)
+        except libvirt.libvirtError as ex:
+            LOG.warn(_('Unable to subscribe to domain events, polling '
+                       'domain states instead: %s'), ex)
+            self.running = False
+            return
+        states = {}
+        for domain_id in conn.listDomainsID():
+            domain = conn.lookupByID(domain_id)
+            states[domain.name()] = domain.info()[0]
+        for name in conn.listDefinedDomains():
+            states[name] = power_state.SHUTOFF
+        for name in set(self.states) - set(states):
+            self.update(name, None)
+        for name, state in states.iteritems():
+            self.update(name, state)
+        self.running = True
+
+    def update(self, name, state):
+        """Record the power state of domain name, None if it is gone."""
+        if state is None:
+            self.states.pop(name, None)
+        else:
+            self.states[name] = state
+        for watch in list(self._watches.get(name, [])):
+            self._check(name, watch, state)
+
+    def watch(self, name, callback, timeout=None):
+        """Call callback with each new power state of domain name.
+
+        callback is called right away with the current state, None if the
+        domain is unknown or gone, and then on every change until it
+        returns True or timeout seconds have passed. Returns an event that
+        is sent True in the first case and False in the second.
+
+        """
+        watch = _Watch(callback)
+        self._watches.setdefault(name, []).append(watch)
+        if timeout is not None:
+            watch.timer = eventlet.spawn_after(timeout, self._expire, name,
+                                               watch)
+        self._check(name, watch, self.states.get(name))
+        return watch.done
+
+    def _check(self, name, watch, state):
+        if watch.callback(state):
+            self._end(name, watch, True)
+
+    def _expire(self, name, watch):
+        LOG.warn(_('Domain %s did not reach the expected state in time'),
+                 name)
+        watch.timer = None
+        self._end(name, watch, False)
+
+    def _end(self, name, watch, result):
+        watches = self._watches.get(name, [])
+        if watch not in watches:
+            return
+        watches.remove(watch)
+        if not watches:
+            del self._watches[name]
+        if watch.timer is not None:
+            watch.timer.cancel()
+        watch.done.send(result)
+
+    def _run_event_loop(self):
+        while True:
+            libvirt.virEventRunDefaultImpl()
+
+    def _queue_event(self, conn, domain, event_id, detail, opaque):
+        # NOTE: runs in the native event loop thread, so must not touch
+        #       anything but the queue and the pipe.
+        try:
+            self._queue.put((domain.name(), event_id))
+            os.write(self._notify_send, ' ')
+        except Exception:
+            pass
+
+    def _dispatch_events(self):
+        while True:
+            self._notify_recv.read(1)
+            while not self._queue.empty():
+                name, event_id = self._queue.get_nowait()
+                if event_id not in self._event_states:
+                    continue
+                try:
+                    self.update(name, self._event_states[event_id])
+                except Exception:
+                    LOG.exception(_('Error handling event of domain %s'),
+                                  name)
@@ -19,14 +19,21 @@
 import abc
 import logging
 import os
+import shutil
+import tempfile
+import zlib
 from xml.etree import ElementTree
 from eventlet.green import time
 from nova import utils, exception
 from nova.flags import FLAGS
 from nova.virt import disk, images
+from nova.volume import lvm
+from nova.volume import wipe
 
 LOG = logging.getLogger('nova.virt.libvirt.image')
 
+CHUNK_SIZE = 1024 * 1024
+
 
 def select_driver():
     """selects image driver by current local_images_type flag value
@@ -39,6 +46,8 @@ def select_driver():
         driver = QcowImageDriver
     elif FLAGS.local_images_type == 'lvm':
         driver = LvmImageDriver
+    elif FLAGS.local_images_type == 'lvm-thin':
+        driver = LvmThinImageDriver
     elif FLAGS.local_images_type == 'legacy':
         if FLAGS.use_cow_images:
             driver = QcowImageDriver
@@ -145,7 +154,7 @@ class LvmImageDriver(ImageDriver):
         for lv_path in cls._list_disks(virt_domain):
             if lv_path is not None:
                 image_name = os.path.basename(lv_path)
-                image = cls.create_image(image_name)
+                image = cls.create_image(image_name, None)
                 images.append(image)
         return images
 
@@ -160,6 +169,15 @@ class LvmImageDriver(ImageDriver):
         }
 
 
+class LvmThinImageDriver(LvmImageDriver):
+
+    @classmethod
+    def create_image(cls, instance_name, image_name, suffix=None):
+        lv_name = cls._lv_name(instance_name, image_name, suffix)
+        return LvmThinImage(FLAGS.lvm_volume_group, lv_name,
+                            FLAGS.lvm_thin_pool)
+
+
 class _FileImageDriver(ImageDriver):
     __metaclass__ = abc.ABCMeta
 
@@ -409,9 +427,10 @@ class LvmImage(Image):
             (self.lv, size))
         self.__try_execute('lvcreate', '-L', '%db' % size, '-n',
             self.lv, self.vg, run_as_root=True)
+        lvm.get_inventory().invalidate(self.vg)
 
     def make_snapshot(self, virt_domain, snapshot_name, force_live_snapshot):
-        size = images.virtual_size(self._path)
+        size = lvm.get_inventory().size(self.vg, self.lv)
         return LvmSnapshot(virt_domain, self.vg,
                            snapshot_name, size,
                            self.path(), force_live_snapshot)
@@ -420,19 +439,19 @@ class LvmImage(Image):
         """Deletes a logical volume."""
         volume = self.path()
         LOG.info(_("lvm volume %s: deleting"), volume)
-        if self.__volume_not_present(volume):
+        inventory = lvm.get_inventory()
+        lv = inventory.get(self.vg, self.lv)
+        if lv is None:
             # If the volume isn't present, then don't attempt to delete
             return True
 
-        out, err = utils.execute('lvdisplay', '--noheading',
-            '-C', '-o', 'Attr',
-            volume,
-            run_as_root=True)
-        if out:
-            out = out.strip()
-            if ('o' in out) or ('O' in out):
-                utils.execute('dmsetup','remove','-c',volume)
-        self.__delete_image(volume)
+        if lv.is_open or lv.is_origin:
+            utils.execute('dmsetup','remove','-c',volume)
+        if FLAGS.background_volume_wipe:
+            wipe.get_queue(self.vg).delete(self.lv)
+        else:
+            self.__delete_image(volume)
+        inventory.forget(self.vg, self.lv)
 
     def path(self):
         return self._path
@@ -451,22 +470,93 @@ class LvmImage(Image):
                 time.sleep(tries ** 2)
 
     def resize(self, size):
-        if images.virtual_size(self.path())  != size:
+        inventory = lvm.get_inventory()
+        if inventory.size(self.vg, self.lv) != size:
             utils.execute('lvresize', '-f','-L', '%db' % size, self.path(), run_as_root=True)
+            inventory.invalidate(self.vg)
 
     @classmethod
     def __delete_image(cls, volume):
         """Deletes a logical volume."""
         cls.__try_execute('lvremove', '-f', volume, run_as_root=True)
 
-    @classmethod
-    def __volume_not_present(cls, volume):
-        try:
-            utils.execute('lvdisplay', volume, run_as_root=True)
-        except Exception:
-            # If the volume isn't present
-            return True
-        return False
+
+class LvmThinImage(LvmImage):
+    """Logical volume in the thin pool of the volume group.
+
+    Every base image is copied once into a thin volume of the pool, and
+    images are created as thin snapshots of it, so creating an image copies
+    nothing and an image only takes the space of the blocks written to it.
+    """
+
+    def __init__(self, vg, lv, pool):
+        super(LvmThinImage, self).__init__(vg, lv)
+        self.pool = pool
+
+    def create_from_raw(self, base, size=None):
+        """
+            Creating volume as a thin snapshot of the base image volume.
+        """
+        self._assert_image_not_larger(base, size)
+        base_lv = self._base_volume(base)
+
+        LOG.info(_("lvm volume %s: creating thin snapshot of %s"),
+                 self.lv, base_lv)
+        utils.execute('lvcreate', '-s', '-kn', '-n', self.lv,
+                      '%s/%s' % (self.vg, base_lv), run_as_root=True)
+        lvm.get_inventory().invalidate(self.vg)
+        if size and size > images.virtual_size(base):
+            target = self.path()
+            utils.execute('lvresize', '-f', '-L', '%db' % size, target,
+                          run_as_root=True)
+            lvm.get_inventory().invalidate(self.vg)
+            utils.execute('e2fsck', '-fp', target,
+                          run_as_root=True, check_exit_code=False)
+            utils.execute('resize2fs', target,
+                          run_as_root=True, check_exit_code=False)
+
+    def create_clean(self, size):
+        LOG.info(_("lvm thin volume %s with size %db: creating"),
+                 self.lv, size)
+        utils.execute('lvcreate', '-T', '%s/%s' % (self.vg, self.pool),
+                      '-V', '%db' % size, '-n', self.lv, run_as_root=True)
+        lvm.get_inventory().invalidate(self.vg)
+
+    def make_snapshot(self, virt_domain, snapshot_name, force_live_snapshot):
+        return LvmThinSnapshot(virt_domain, self.vg, snapshot_name,
+                               self.path(), force_live_snapshot)
+
+    def _base_volume(self, base):
+        """Returns the name of the thin volume holding base image.
+
+        The volume is named after the cached base image, and is created and
+        filled under a temporary name the first time it is needed, so an
+        interrupted copy is never used as a base.
+        """
+        base_lv = 'base-' + os.path.basename(base)
+
+        @utils.synchronized(base_lv)
+        def create_if_not_exists():
+            if os.path.exists(os.path.join('/dev', self.vg, base_lv)):
+                return
+            tmp_lv = base_lv + '-tmp'
+            tmp_path = os.path.join('/dev', self.vg, tmp_lv)
+            if os.path.exists(tmp_path):
+                utils.execute('lvremove', '-f', tmp_path, run_as_root=True)
+
+            LOG.info(_("lvm thin volume %s: copying base image %s"),
+                     base_lv, base)
+            utils.execute('lvcreate', '-T', '%s/%s' % (self.vg, self.pool),
+                          '-V', '%db' % images.virtual_size(base),
+                          '-n', tmp_lv, run_as_root=True)
+            utils.execute('qemu-img', 'convert', base, '-O', 'raw',
+                          tmp_path, run_as_root=True)
+            utils.execute('lvrename', self.vg, tmp_lv, base_lv,
+                          run_as_root=True)
+            lvm.get_inventory().invalidate(self.vg)
+
+        create_if_not_exists()
+        return base_lv
 
 
 class Snapshot(object):
@@ -495,6 +585,26 @@ class Snapshot(object):
                                   'be implemented '
                                   'in subclasses')
 
+    def open_raw(self, compress=False):
+        """Open the snapshot in raw format for reading
+        :type compress: bool
+        :param compress: gzip-compress the data while it is read
+        :rtype: :class:`nova.virt.libvirt.image.RawStream`
+        :return: stream to read the snapshot from and close
+
+        qemu-img can't write raw images to a pipe, so by default the
+        snapshot is converted to a scratch file that is removed on close.
+        Snapshots that are readable as they are stream them directly.
+        """
+        temp_dir = tempfile.mkdtemp()
+        path = os.path.join(temp_dir, self._snapshot_name)
+        try:
+            self.convert_to_raw(path)
+            return _FileStream(path, temp_dir, compress)
+        except Exception:
+            shutil.rmtree(temp_dir)
+            raise
+
     @abc.abstractmethod
     def create(self):
         """Create snapshot"""
@@ -567,6 +677,7 @@ class LvmSnapshot(Snapshot):
                  snapshot_name, snapshot_size,
                  source_path, force_live_snapshot):
         super(LvmSnapshot, self).__init__(snapshot_name)
+        self._volume_group = volume_group
         self._snapshot_path = os.path.join('/dev', volume_group, snapshot_name)
         self._snapshot_size = snapshot_size
         self._source_path = source_path
@@ -580,11 +691,118 @@ class LvmSnapshot(Snapshot):
         utils.execute('lvcreate','-L%db'%self._snapshot_size, '-s', '-n',
                       self._snapshot_name, self._source_path,
                       run_as_root=True)
+        lvm.get_inventory().invalidate(self._volume_group)
         return self
 
     def convert_to_raw(self, destination):
         utils.execute('dd', 'if=%s' % self._snapshot_path,
                       'of=%s' % destination, 'bs=1M', run_as_root=True)
 
+    def open_raw(self, compress=False):
+        return _ProcessStream(('dd', 'if=%s' % self._snapshot_path, 'bs=1M'),
+                              compress)
+
     def delete(self):
         utils.execute('lvremove', '-f', self._snapshot_path, run_as_root=True)
+        lvm.get_inventory().invalidate(self._volume_group)
+
+
+class LvmThinSnapshot(LvmSnapshot):
+
+    def __init__(self, virt_domain, volume_group, snapshot_name,
+                 source_path, force_live_snapshot):
+        super(LvmThinSnapshot, self).__init__(virt_domain, volume_group,
+                                              snapshot_name, None,
+                                              source_path,
+                                              force_live_snapshot)
+
+    def create(self):
+        if not self._force_live_snapshot and self._virt_domain.isActive():
+            raise RuntimeError("VM must be suspended before doing "
+                               "LVM snapshot")
+        utils.execute('lvcreate', '-s', '-kn', '-n', self._snapshot_name,
+                      self._source_path, run_as_root=True)
+        lvm.get_inventory().invalidate(self._volume_group)
+        return self
+
+
+class RawStream(object):
+    """File-like object reading a raw disk image in chunks.
+
+    With compress, the data is gzip-compressed as it is read, so runs of
+    zeros in the image cost next to nothing on the wire or in the image
+    service.
+    """
+
+    def __init__(self, source, compress=False):
+        self._source = source
+        self._compressor = None
+        if compress:
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                                16 + zlib.MAX_WBITS)
+        self._buffer = ''
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = self._source.read(CHUNK_SIZE)
+            if not chunk:
+                self._eof = True
+                if self._compressor:
+                    self._buffer += self._compressor.flush()
+                self._end()
+                break
+            if self._compressor:
+                chunk = self._compressor.compress(chunk)
+            self._buffer += chunk
+
+        if size < 0 or size >= len(self._buffer):
+            data, self._buffer = self._buffer, ''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def _end(self):
+        """Called when all the data has been read from the source"""
+        pass
+
+    def close(self):
+        self._source.close()
+
+
+class _FileStream(RawStream):
+
+    def __init__(self, path, temp_dir, compress=False):
+        super(_FileStream, self).__init__(open(path, 'rb'), compress)
+        self._temp_dir = temp_dir
+
+    def close(self):
+        try:
+            super(_FileStream, self).close()
+        finally:
+            shutil.rmtree(self._temp_dir)
+
+
+class _ProcessStream(RawStream):
+    """Stream of the standard output of a command run as root"""
+
+    def __init__(self, cmd, compress=False):
+        self._cmd = ' '.join(map(str, cmd))
+        self._process = utils.start_process(*cmd, run_as_root=True)
+        super(_ProcessStream, self).__init__(self._process.stdout, compress)
+
+    def _end(self):
+        # NOTE: fail the read, and so the upload, rather than let a
+        #       truncated image look complete.
+        stderr = self._process.stderr.read()
+        returncode = self._process.wait()
+        if returncode:
+            raise exception.ProcessExecutionError(exit_code=returncode,
+                                                  stderr=stderr,
+                                                  cmd=self._cmd)
+
+    def close(self):
+        # NOTE: if the stream was not read to the end, closing the pipe
+        #       makes the command exit with SIGPIPE.
+        super(_ProcessStream, self).close()
+        self._process.wait()
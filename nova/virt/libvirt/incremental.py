@@ -0,0 +1,257 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Incremental (changed-chunk) snapshots of local volumes.
+
+The raw volume is split into chunks of a fixed size and each chunk is
+hashed. An incremental snapshot image only holds the chunks whose hash
+differs from the previous snapshot of the volume, in volume order, and
+chunks of zeros are never stored. The hashes of all the chunks (the
+manifest) are kept in an image of their own, as a manifest is too large
+for an image property once the volume has more than a few hundred chunks:
+Glance sends properties as HTTP headers. The image properties of the
+snapshot hold the ids of the manifest and of the previous snapshot, so a
+full image can be reassembled from the chain of snapshots ending with the
+one restored.
+
+Every snapshot of a chain is needed to restore the later ones, so after
+--incremental_snapshot_max_chain snapshots a full one is taken again.
+
+"""
+
+import base64
+import hashlib
+import os
+import StringIO
+import zlib
+
+from nova import exception
+from nova import log as logging
+
+
+LOG = logging.getLogger('nova.virt.libvirt.incremental')
+
+SNAPSHOT_TYPE = 'incremental'
+MANIFEST_IMAGE_TYPE = 'snapshot_manifest'
+
+# NOTE: recorded instead of the hash of a chunk of zeros, which is not
+#       stored in any image.
+ZERO_CHUNK = '\0' * hashlib.sha1().digest_size
+
+
+def encode_manifest(hashes):
+    """Pack a list of chunk hashes into the data of a manifest image."""
+    return zlib.compress(''.join(hashes))
+
+
+def decode_manifest(data):
+    """Unpack the chunk hashes of the data of a manifest image."""
+    data = zlib.decompress(data)
+    size = len(ZERO_CHUNK)
+    return [data[i:i + size] for i in xrange(0, len(data), size)]
+
+
+def upload_manifest(context, image_service, snapshot_meta, hashes):
+    """Store the chunk hashes of a snapshot in a new image, returns its
+    id."""
+    metadata = {'name': '%s-manifest' % snapshot_meta.get('name'),
+                'is_public': snapshot_meta.get('is_public', False),
+                'disk_format': 'raw',
+                'container_format': 'bare',
+                'properties': {'image_type': MANIFEST_IMAGE_TYPE}}
+    image_meta = image_service.create(
+            context, metadata, StringIO.StringIO(encode_manifest(hashes)))
+    return image_meta['id']
+
+
+def fetch_manifest(context, image_service, properties):
+    """Returns the chunk hashes of the snapshot with properties."""
+    if 'manifest_id' not in properties:
+        # NOTE: snapshots taken before the manifest had an image of its
+        #       own kept it in a property.
+        return decode_manifest(base64.b64decode(properties['manifest']))
+    data = StringIO.StringIO()
+    image_service.get(context, properties['manifest_id'], data)
+    return decode_manifest(data.getvalue())
+
+
+def is_incremental(image_meta):
+    """Is image_meta the metadata of an incremental snapshot?"""
+    properties = image_meta.get('properties') or {}
+    return properties.get('snapshot_type') == SNAPSHOT_TYPE
+
+
+def changed_chunks(hashes, parent_hashes=None):
+    """Return the indexes of the chunks a snapshot stores, in order."""
+    parent_hashes = parent_hashes or []
+    return [index for index, digest in enumerate(hashes)
+            if digest != ZERO_CHUNK and
+               (index >= len(parent_hashes) or
+                parent_hashes[index] != digest)]
+
+
+class ChangedChunks(object):
+    """File-like object reading the changed chunks of a raw image.
+
+    Reads source chunk by chunk, hashes every chunk and returns only the
+    data of the chunks that are not zeros and differ from parent_hashes.
+    Once read to the end, hashes and size describe the whole image.
+
+    """
+
+    def __init__(self, source, chunk_size, parent_hashes=None):
+        self.chunk_size = chunk_size
+        self.hashes = []
+        self.size = 0
+        self.changed = 0
+        self._source = source
+        self._parent_hashes = parent_hashes or []
+        self._chunk = ''
+        self._pos = 0
+        self._eof = False
+
+    def read(self, size=-1):
+        while self._pos >= len(self._chunk) and not self._eof:
+            self._next_chunk()
+        if size < 0:
+            size = len(self._chunk) - self._pos
+        data = self._chunk[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def _next_chunk(self):
+        self._chunk = ''
+        self._pos = 0
+        chunk = self._source.read(self.chunk_size)
+        if not chunk:
+            self._eof = True
+            return
+        index = len(self.hashes)
+        self.size += len(chunk)
+        if chunk.count('\0') == len(chunk):
+            self.hashes.append(ZERO_CHUNK)
+            return
+        digest = hashlib.sha1(chunk).digest()
+        self.hashes.append(digest)
+        if (index >= len(self._parent_hashes) or
+            self._parent_hashes[index] != digest):
+            self.changed += 1
+            self._chunk = chunk
+
+    def close(self):
+        self._source.close()
+
+
+class _ChunkWriter(object):
+    """Writes the chunks stored in one snapshot image into the volume.
+
+    Only the chunks listed in wanted are written, each one is checked
+    against its hash in the manifest.
+
+    """
+
+    def __init__(self, target, chunk_size, image_size, indexes, wanted,
+                 hashes):
+        self._target = target
+        self._chunk_size = chunk_size
+        self._image_size = image_size
+        self._indexes = indexes
+        self._wanted = wanted
+        self._hashes = hashes
+        self._offset = 0
+        self._digest = None
+
+    def write(self, data):
+        while data:
+            number, pos = divmod(self._offset, self._chunk_size)
+            if number >= len(self._indexes):
+                raise exception.Error(_('Snapshot image holds more data '
+                                        'than its manifest lists'))
+            index = self._indexes[number]
+            chunk_length = min(self._chunk_size,
+                               self._image_size - index * self._chunk_size)
+            length = min(len(data), chunk_length - pos)
+            if index in self._wanted:
+                if pos == 0:
+                    self._digest = hashlib.sha1()
+                self._digest.update(data[:length])
+                self._target.seek(index * self._chunk_size + pos)
+                self._target.write(data[:length])
+                if (pos + length == chunk_length and
+                    self._digest.digest() != self._hashes[index]):
+                    raise exception.Error(_('Chunk %d of the snapshot is '
+                                            'corrupt') % index)
+            data = data[length:]
+            # NOTE: only the last chunk of the volume may be short, and
+            #       it is always the last one stored.
+            self._offset += length
+            if pos + length == chunk_length:
+                self._offset = (number + 1) * self._chunk_size
+
+
+def _snapshot_chain(context, image_service, image_id):
+    """Returns [(image_id, properties, hashes)] from the full snapshot on."""
+    chain = []
+    while image_id is not None:
+        image_meta = image_service.show(context, image_id)
+        if not is_incremental(image_meta):
+            raise exception.Error(_('Image %s is not an incremental '
+                                    'snapshot') % image_id)
+        properties = image_meta['properties']
+        chain.append((image_id, properties,
+                      fetch_manifest(context, image_service, properties)))
+        image_id = properties.get('parent_id')
+    chain.reverse()
+    return chain
+
+
+def restore(context, image_service, image_id, target):
+    """Reassemble the full raw image of snapshot image_id into target."""
+    chain = _snapshot_chain(context, image_service, image_id)
+    _image_id, properties, hashes = chain[-1]
+    chunk_size = int(properties['chunk_size'])
+    volume_size = int(properties['volume_size'])
+
+    # NOTE: every chunk is taken from the last snapshot that stored it.
+    owners = {}
+    parent_hashes = None
+    for number, (_image_id, _properties, image_hashes) in enumerate(chain):
+        for index in changed_chunks(image_hashes, parent_hashes):
+            owners[index] = number
+        parent_hashes = image_hashes
+
+    LOG.info(_('Restoring snapshot %(image_id)s from a chain of %(count)d '
+               'snapshots') % {'image_id': image_id, 'count': len(chain)})
+    target_tmp = '%s.part' % target
+    with open(target_tmp, 'wb') as target_file:
+        parent_hashes = None
+        for number, (chain_id, image_properties, image_hashes) in \
+                enumerate(chain):
+            indexes = changed_chunks(image_hashes, parent_hashes)
+            parent_hashes = image_hashes
+            wanted = set(index for index in indexes
+                         if index < len(hashes) and
+                            hashes[index] != ZERO_CHUNK and
+                            owners[index] == number)
+            if not wanted:
+                continue
+            writer = _ChunkWriter(target_file, chunk_size,
+                                  int(image_properties['volume_size']),
+                                  indexes, wanted, image_hashes)
+            image_service.get(context, chain_id, writer)
+        target_file.truncate(volume_size)
+    os.rename(target_tmp, target)
@@ -0,0 +1,128 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Cache of the parsed XML description of libvirt domains.
+
+Fetching and parsing XMLDesc() of every domain whenever the driver needs
+its disks, interfaces or vcpus is what made host resource reporting slow.
+The inventory parses the description of a domain once and keeps the result
+keyed by the domain UUID until the driver changes the domain (define,
+attach, detach, destroy) and invalidates it.
+
+"""
+
+from xml.etree import ElementTree
+from xml.parsers import expat
+
+from nova import log as logging
+
+
+LOG = logging.getLogger('nova.virt.libvirt.inventory')
+
+
+class DomainInventory(object):
+    """Parsed devices, vcpus and memory of the domains of one host."""
+
+    def __init__(self):
+        self._domains = {}
+        self._uuids = {}
+
+    def get(self, domain):
+        """Return the parsed description of a libvirt domain."""
+        uuid = domain.UUIDString()
+        info = self._domains.get(uuid)
+        if info is None:
+            info = parse_domain_xml(domain.XMLDesc(0))
+            if info['name'] is None:
+                # NOTE: don't cache descriptions that could not be parsed
+                return info
+            self._domains[uuid] = info
+            self._uuids[info['name']] = uuid
+        return info
+
+    def get_cached(self, name):
+        """Return the parsed description of domain name if it is cached."""
+        uuid = self._uuids.get(name)
+        if uuid is None:
+            return None
+        return self._domains.get(uuid)
+
+    def invalidate(self, domain):
+        """Forget the description of a domain that was changed."""
+        self._forget(domain.UUIDString())
+
+    def invalidate_name(self, name):
+        """Forget the description of the domain called name."""
+        uuid = self._uuids.get(name)
+        if uuid is not None:
+            self._forget(uuid)
+
+    def _forget(self, uuid):
+        info = self._domains.pop(uuid, None)
+        if info is not None and self._uuids.get(info['name']) == uuid:
+            del self._uuids[info['name']]
+
+
+def parse_domain_xml(xml):
+    """Parse the XML description of a domain into a dict.
+
+    Returns the name, uuid, vcpus and memory (in KiB) of the domain, with a
+    list of its disks and the target devices of its interfaces. Each disk
+    is a dict of its type, device, target, source, driver type and XML.
+
+    """
+    info = {'name': None,
+            'uuid': None,
+            'vcpus': 1,
+            'memory': 0,
+            'disks': [],
+            'interfaces': []}
+    try:
+        root = ElementTree.fromstring(xml)
+    except (expat.ExpatError, SyntaxError):
+        LOG.warn(_('Unable to parse domain XML: %s'), xml)
+        return info
+
+    info['name'] = root.findtext('name')
+    info['uuid'] = root.findtext('uuid')
+    info['vcpus'] = int(root.findtext('vcpu') or 1)
+    info['memory'] = int(root.findtext('memory') or 0)
+
+    for node in root.findall('devices/disk'):
+        target = node.find('target')
+        if target is None or target.get('dev') is None:
+            continue
+        disk = {'type': node.get('type'),
+                'device': node.get('device'),
+                'target': target.get('dev'),
+                'source': None,
+                'driver_type': None,
+                'xml': ElementTree.tostring(node)}
+        source = node.find('source')
+        if source is not None:
+            disk['source'] = (source.get('file') or source.get('dev') or
+                              source.get('name'))
+        driver = node.find('driver')
+        if driver is not None:
+            disk['driver_type'] = driver.get('type')
+        info['disks'].append(disk)
+
+    for node in root.findall('devices/interface'):
+        target = node.find('target')
+        if target is not None and target.get('dev') is not None:
+            info['interfaces'].append(target.get('dev'))
+    return info
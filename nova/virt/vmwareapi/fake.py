@@ -81,6 +81,16 @@ def _get_objects(obj_type):
     return lst_objs
 
 
+class ManagedObjectReference(str):
+    """Reference to a managed object, which knows the type of the object
+    like the references of the suds client."""
+
+    def __new__(cls, value, type):
+        ref = str.__new__(cls, value)
+        ref._type = type
+        return ref
+
+
 class Prop(object):
     """Property Object base class."""
 
@@ -232,6 +242,7 @@ class Datastore(ManagedObject):
         super(Datastore, self).__init__("Datastore")
         self.set("summary.type", "VMFS")
         self.set("summary.name", "fake-ds")
+        self.set("summary.freeSpace", 1024 * 1024 * 1024 * 1024)
 
 
 class HostNetworkSystem(ManagedObject):
@@ -459,6 +470,8 @@ class FakeVim(object):
         contents and the cookies for the session.
         """
         self._session = None
+        self._filters = {}
+        self._version = 0
         self.client = DataObject()
         self.client.factory = FakeFactory()
 
@@ -651,6 +664,77 @@ class FakeVim(object):
                 continue
         return lst_ret_objs
 
+    def _create_filter(self, method, *args, **kwargs):
+        """Creates a property filter reporting the objects of the types
+        in its spec."""
+        filter_ref = str(uuid.uuid4())
+        self._filters[filter_ref] = (kwargs.get("spec"), {})
+        return filter_ref
+
+    def _destroy_filter(self, method, *args, **kwargs):
+        """Destroys a property filter."""
+        self._filters.pop(args[0], None)
+
+    def _check_for_updates(self, method, *args, **kwargs):
+        """
+        Returns what changed since the last call in the objects reported
+        by the property filters, None if nothing did.
+        """
+        filter_updates = []
+        for filter_ref, (spec, reported) in self._filters.items():
+            if not kwargs.get("version"):
+                reported.clear()
+            current = {}
+            for prop_spec in spec.propSet:
+                for mdo in _db_content.get(prop_spec.type, {}).values():
+                    props = {}
+                    for prop in mdo.propSet:
+                        if prop.name in prop_spec.pathSet:
+                            props[prop.name] = prop.val
+                    current[mdo.obj] = (prop_spec.type, props)
+            object_updates = []
+            for obj_ref, (type, props) in current.iteritems():
+                old_props = reported.get(obj_ref, (None, None))[1]
+                if old_props is None:
+                    kind = "enter"
+                    changed = props.keys()
+                else:
+                    kind = "modify"
+                    changed = [name for name in props
+                               if props[name] != old_props.get(name)]
+                    if not changed:
+                        continue
+                object_update = DataObject()
+                object_update.kind = kind
+                object_update.obj = ManagedObjectReference(obj_ref, type)
+                object_update.changeSet = []
+                for name in changed:
+                    change = DataObject()
+                    change.name = name
+                    change.op = "assign"
+                    change.val = props[name]
+                    object_update.changeSet.append(change)
+                object_updates.append(object_update)
+            for obj_ref, (type, props) in reported.iteritems():
+                if obj_ref not in current:
+                    object_update = DataObject()
+                    object_update.kind = "leave"
+                    object_update.obj = ManagedObjectReference(obj_ref, type)
+                    object_updates.append(object_update)
+            self._filters[filter_ref] = (spec, current)
+            if object_updates:
+                filter_update = DataObject()
+                filter_update.filter = filter_ref
+                filter_update.objectSet = object_updates
+                filter_updates.append(filter_update)
+        if not filter_updates:
+            return None
+        self._version += 1
+        update_set = DataObject()
+        update_set.version = str(self._version)
+        update_set.filterSet = filter_updates
+        return update_set
+
     def _add_port_group(self, method, *args, **kwargs):
         """Adds a port group to the host system."""
         host_mdo = \
@@ -713,6 +797,15 @@ class FakeVim(object):
         elif attr_name == "RetrieveProperties":
             return lambda *args, **kwargs: self._retrieve_properties(
                                                 attr_name, *args, **kwargs)
+        elif attr_name == "CreateFilter":
+            return lambda *args, **kwargs: self._create_filter(attr_name,
+                                                *args, **kwargs)
+        elif attr_name == "DestroyPropertyFilter":
+            return lambda *args, **kwargs: self._destroy_filter(attr_name,
+                                                *args, **kwargs)
+        elif attr_name == "CheckForUpdates":
+            return lambda *args, **kwargs: self._check_for_updates(
+                                                attr_name, *args, **kwargs)
         elif attr_name == "AcquireCloneTicket":
             return lambda *args, **kwargs: self._just_return()
         elif attr_name == "AddPortGroup":
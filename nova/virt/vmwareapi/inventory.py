@@ -0,0 +1,166 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Inventory of the ESX host, kept current with property collector updates.
+
+Looking objects up with get_objects traverses the whole inventory of the
+host for every lookup, several times per spawn and once per VM for
+get_info. The inventory instead creates one property filter on the
+property collector for the VMs, datastores, datacenters and resource
+pools of the host. The first CheckForUpdates call (the non-blocking form
+of WaitForUpdates) returns all of them; later calls return only what
+changed since, usually nothing.
+"""
+
+from nova import log as logging
+from nova.virt.vmwareapi import error_util
+from nova.virt.vmwareapi import vim_util
+
+
+LOG = logging.getLogger("nova.virt.vmwareapi.inventory")
+
+PROPERTIES = {
+    'VirtualMachine': ['name', 'runtime.connectionState',
+                       'runtime.powerState', 'summary.config.numCpu',
+                       'summary.config.memorySizeMB'],
+    'Datastore': ['summary.type', 'summary.name', 'summary.freeSpace'],
+    'Datacenter': ['name', 'vmFolder'],
+    'ResourcePool': ['name'],
+}
+
+
+def _mor_key(mor):
+    """Returns a hashable key of a managed object reference."""
+    return getattr(mor, 'value', mor)
+
+
+def _mor_type(mor):
+    return getattr(mor, '_type', None)
+
+
+class Inventory(object):
+    """Managed objects of the ESX host of a session and their properties."""
+
+    def __init__(self, session):
+        self._session = session
+        self._objects = {}
+        self._version = ''
+        self._filter = None
+        self._session_id = None
+
+    def objects(self, type):
+        """Returns [(mor, {property: value})] of the objects of type."""
+        self._update()
+        return self._objects.get(type, {}).values()
+
+    def find(self, type, property_name, value):
+        """Returns (mor, properties) of the first object of type whose
+        property_name is value, None if there is none."""
+        for mor, props in self.objects(type):
+            if props.get(property_name) == value:
+                return mor, props
+        return None
+
+    def _update(self):
+        if self._filter_lost():
+            self._create_filter()
+        try:
+            update_set = self._check_for_updates()
+        except error_util.VimFaultException, excep:
+            LOG.warn(_("Unable to check for inventory updates, loading "
+                       "the inventory again: %s") % excep)
+            self._destroy_filter()
+            self._create_filter()
+            update_set = self._check_for_updates()
+        if self._filter_lost():
+            # NOTE: the session was created again during the call, and its
+            #       filter went with the old one.
+            self._create_filter()
+            update_set = self._check_for_updates()
+        if update_set:
+            self._apply(update_set)
+
+    def _filter_lost(self):
+        return (self._filter is None or
+                self._session_id != self._session._session_id)
+
+    def _collector(self):
+        return self._session._get_vim().get_service_content().\
+                propertyCollector
+
+    def _create_filter(self):
+        vim = self._session._get_vim()
+        client_factory = vim.client.factory
+        object_spec = vim_util.build_object_spec(client_factory,
+                            vim.get_service_content().rootFolder,
+                            [vim_util.build_recursive_traversal_spec(
+                                    client_factory)])
+        property_specs = [vim_util.build_property_spec(client_factory,
+                                type=type, properties_to_collect=properties)
+                          for type, properties in PROPERTIES.iteritems()]
+        filter_spec = vim_util.build_property_filter_spec(client_factory,
+                                property_specs, [object_spec])
+        LOG.debug(_("Creating the inventory property filter"))
+        self._objects = {}
+        self._version = ''
+        self._session_id = self._session._session_id
+        self._filter = self._session._call_method(vim, "CreateFilter",
+                                self._collector(), spec=filter_spec,
+                                partialUpdates=False)
+
+    def _destroy_filter(self):
+        """Destroys the filter of a still live session, if it can."""
+        if self._filter_lost():
+            return
+        try:
+            self._session._call_method(self._session._get_vim(),
+                                       "DestroyPropertyFilter", self._filter)
+        except Exception, excep:
+            LOG.debug(_("Unable to destroy the inventory property filter: "
+                        "%s") % excep)
+        self._filter = None
+
+    def _check_for_updates(self):
+        return self._session._call_method(self._session._get_vim(),
+                                "CheckForUpdates", self._collector(),
+                                version=self._version)
+
+    def _apply(self, update_set):
+        self._version = update_set.version
+        for filter_update in update_set.filterSet or []:
+            for object_update in filter_update.objectSet or []:
+                self._apply_object_update(object_update)
+
+    def _apply_object_update(self, object_update):
+        mor = object_update.obj
+        key = _mor_key(mor)
+        if object_update.kind == 'leave':
+            for objects in self._objects.values():
+                objects.pop(key, None)
+            return
+
+        type = _mor_type(mor)
+        objects = self._objects.setdefault(type, {})
+        if object_update.kind == 'enter' or key not in objects:
+            objects[key] = (mor, {})
+        props = objects[key][1]
+        for change in getattr(object_update, 'changeSet', None) or []:
+            if change.op in ('remove', 'indirectRemove'):
+                props.pop(change.name, None)
+            else:
+                props[change.name] = getattr(change, 'val', None)
@@ -31,7 +31,6 @@ from nova import log as logging
 
 LOG = logging.getLogger("nova.virt.vmwareapi.io_util")
 
-IO_THREAD_SLEEP_TIME = .01
 GLANCE_POLL_INTERVAL = 5
 
 
@@ -155,7 +154,8 @@ class IOThread(object):
                         self.stop()
                         self.done.send(True)
                     self.output.write(data)
-                    greenthread.sleep(IO_THREAD_SLEEP_TIME)
+                    # NOTE: only yields, the pipe blocks the faster side
+                    greenthread.sleep(0)
                 except Exception, exc:
                     self.stop()
                     LOG.exception(exc)
@@ -22,7 +22,9 @@ Collection of classes to handle image upload/download to/from Image service
 
 """
 
+import hashlib
 import httplib
+import tempfile
 import urllib
 import urllib2
 import urlparse
@@ -38,8 +40,18 @@ from nova import log as logging
 LOG = logging.getLogger("nova.virt.vmwareapi.read_write_util")
 
 FLAGS = flags.FLAGS
+flags.DEFINE_integer('vmwareapi_transfer_connections', 4,
+                     'HTTP connections downloading ranges of a file from '
+                     'the ESX datastore in parallel')
+flags.DEFINE_integer('vmwareapi_transfer_range_size', 64 * 1024 * 1024,
+                     'bytes of a file downloaded from the ESX datastore '
+                     'by one range request')
+flags.DEFINE_integer('vmwareapi_transfer_retries', 3,
+                     'times a range of a file downloaded from the ESX '
+                     'datastore is resumed after failing')
 
 USER_AGENT = "OpenStack-ESX-Adapter"
+RANGE_RETRY_INTERVAL = 2
 
 try:
     READ_CHUNKSIZE = client.BaseClient.CHUNKSIZE
@@ -53,14 +65,17 @@ class GlanceFileRead(object):
     def __init__(self, glance_read_iter):
         self.glance_read_iter = glance_read_iter
         self.iter = self.get_next()
+        self.checksum = hashlib.md5()
 
     def read(self, chunk_size):
         """Read an item from the queue. The chunk size is ignored for the
         Client ImageBodyIterator uses its own CHUNKSIZE."""
         try:
-            return self.iter.next()
+            data = self.iter.next()
         except StopIteration:
             return ""
+        self.checksum.update(data)
+        return data
 
     def get_next(self):
         """Get the next item from the image iterator."""
@@ -180,3 +195,185 @@ class VmWareHTTPReadFile(VMwareHTTPFile):
     def get_size(self):
         """Get size of the file to be read."""
         return self.file_handle.headers.get("Content-Length", -1)
+
+
+class _RangeSpool(object):
+    """One range of a file, spooled to a temporary file as it is downloaded
+    so that the download never waits for the reader."""
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self._written = 0
+        self._read = 0
+        self._done = False
+        self._error = None
+        self._changed = event.Event()
+
+    def write(self, data):
+        self._file.seek(self._written)
+        self._file.write(data)
+        self._written += len(data)
+        self._notify()
+
+    def finish(self, error=None):
+        """Mark the range complete, or failed with error."""
+        self._done = True
+        self._error = error
+        self._notify()
+
+    def read(self, size):
+        """Read at most size bytes, waiting for them to be downloaded.
+        Returns "" at the end of the range."""
+        while self._read == self._written:
+            if self._error is not None:
+                raise self._error
+            if self._done:
+                return ""
+            self._changed.wait()
+        self._file.seek(self._read)
+        data = self._file.read(min(size, self._written - self._read))
+        self._read += len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+    def _notify(self):
+        changed, self._changed = self._changed, event.Event()
+        changed.send()
+
+
+class VMWareHTTPRangeReadFile(VMwareHTTPFile):
+    """VMWare file read handler class downloading ranges of the file over
+    several connections in parallel.
+
+    The ranges are returned in order by read. Each connection spools its
+    range to a temporary file, and a range is only started once the ranges
+    being read and spooled leave it a connection, so at most
+    vmwareapi_transfer_connections ranges are on disk. A range whose
+    download fails is resumed where it stopped, the other ones going on.
+    If the server ignores ranges, the file is downloaded over one
+    connection.
+    """
+
+    def __init__(self, host, data_center_name, datastore_name, cookies,
+                 file_path, scheme="https"):
+        base_url = "%s://%s/folder/%s" % (scheme, host,
+                                          urllib.pathname2url(file_path))
+        param_list = {"dcPath": data_center_name, "dsName": datastore_name}
+        self.url = base_url + "?" + urllib.urlencode(param_list)
+        self.headers = {'User-Agent': USER_AGENT,
+                        'Cookie': self._build_vim_cookie_headers(cookies)}
+        self.checksum = hashlib.md5()
+
+        range_size = FLAGS.vmwareapi_transfer_range_size
+        conn = self._open_range(0, range_size)
+        content_range = conn.headers.get("Content-Range")
+        if conn.code == 206 and content_range:
+            self.size = int(content_range.rsplit("/", 1)[1])
+            self.resumable = True
+            self.ranges = [(start, min(start + range_size, self.size))
+                           for start in xrange(0, self.size, range_size)]
+        else:
+            # NOTE: the server ignored the range and sends the whole file
+            self.size = int(conn.headers.get("Content-Length", -1))
+            self.resumable = False
+            self.ranges = [(0, self.size)]
+        VMwareHTTPFile.__init__(self, conn)
+
+        self._spools = [_RangeSpool() for r in self.ranges]
+        self._pending = range(1, len(self.ranges))
+        self._index = 0
+        self._advanced = event.Event()
+        self._workers = [greenthread.spawn(self._fetch, 0, conn)]
+        for _i in xrange(min(FLAGS.vmwareapi_transfer_connections,
+                            len(self.ranges)) - 1):
+            self._workers.append(greenthread.spawn(self._work))
+
+    def _open_range(self, start, end):
+        """Open a connection reading bytes start to end - 1 of the file."""
+        headers = dict(self.headers,
+                       Range="bytes=%d-%d" % (start, end - 1))
+        request = urllib2.Request(self.url, None, headers)
+        return urllib2.urlopen(request)
+
+    def _work(self):
+        while self._pending:
+            index = self._pending.pop(0)
+            while (index >= self._index +
+                   FLAGS.vmwareapi_transfer_connections):
+                self._advanced.wait()
+            self._fetch(index)
+
+    def _fetch(self, index, conn=None):
+        """Download range index of the file into its spool."""
+        start, end = self.ranges[index]
+        spool = self._spools[index]
+        offset = start
+        failures = 0
+        while offset < end or end < 0:
+            try:
+                if conn is None:
+                    conn = self._open_range(offset, end)
+                    if not conn.headers.get("Content-Range", "").startswith(
+                            "bytes %d-" % offset):
+                        raise IOError(_("Server did not send the range "
+                                        "starting at byte %d") % offset)
+                size = READ_CHUNKSIZE
+                if end >= 0:
+                    size = min(size, end - offset)
+                data = conn.read(size)
+                if not data:
+                    if end < 0:
+                        break
+                    raise IOError(_("Connection closed at byte %d") %
+                                  offset)
+                offset += len(data)
+                spool.write(data)
+            except (IOError, httplib.HTTPException), exc:
+                self._close(conn)
+                conn = None
+                failures += 1
+                if (not self.resumable or
+                    failures > FLAGS.vmwareapi_transfer_retries):
+                    spool.finish(exc)
+                    return
+                LOG.warn(_("Resuming range %(start)d-%(end)d of %(url)s at "
+                           "byte %(offset)d: %(exc)s") %
+                         dict(locals(), url=self.url))
+                greenthread.sleep(RANGE_RETRY_INTERVAL)
+        self._close(conn)
+        spool.finish()
+
+    def _close(self, conn):
+        if conn is not None and conn is not self.file_handle:
+            try:
+                conn.close()
+            except Exception, exc:
+                LOG.debug(exc)
+
+    def read(self, chunk_size):
+        """Read the next chunk of data, in the order of the file."""
+        while self._index < len(self._spools):
+            data = self._spools[self._index].read(READ_CHUNKSIZE)
+            if data:
+                self.checksum.update(data)
+                return data
+            self._spools[self._index].close()
+            self._index += 1
+            advanced, self._advanced = self._advanced, event.Event()
+            advanced.send()
+        return ""
+
+    def get_size(self):
+        """Get size of the file to be read."""
+        return self.size
+
+    def close(self):
+        """Stop the downloads and close the connections."""
+        for worker in getattr(self, "_workers", []):
+            worker.kill()
+        self._workers = []
+        for spool in getattr(self, "_spools", []):
+            spool.close()
+        super(VMWareHTTPRangeReadFile, self).close()
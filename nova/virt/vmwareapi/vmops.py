@@ -70,21 +70,13 @@ class VMWareVMOps(object):
     def list_instances(self):
         """Lists the VM instances that are registered with the ESX host."""
         LOG.debug(_("Getting list of instances"))
-        vms = self._session._call_method(vim_util, "get_objects",
-                     "VirtualMachine",
-                     ["name", "runtime.connectionState"])
         lst_vm_names = []
-        for vm in vms:
-            vm_name = None
-            conn_state = None
-            for prop in vm.propSet:
-                if prop.name == "name":
-                    vm_name = prop.val
-                elif prop.name == "runtime.connectionState":
-                    conn_state = prop.val
+        for vm_ref, props in self._session.inventory.objects(
+                                                    "VirtualMachine"):
+            conn_state = props.get("runtime.connectionState")
             # Ignoring the oprhaned or inaccessible VMs
             if conn_state not in ["orphaned", "inaccessible"]:
-                lst_vm_names.append(vm_name)
+                lst_vm_names.append(props.get("name"))
         LOG.debug(_("Got total of %s instances") % str(len(lst_vm_names)))
         return lst_vm_names
 
@@ -111,26 +103,25 @@ class VMWareVMOps(object):
         service_content = self._session._get_vim().get_service_content()
 
         def _get_datastore_ref():
-            """Get the datastore list and choose the first local storage."""
-            data_stores = self._session._call_method(vim_util, "get_objects",
-                        "Datastore", ["summary.type", "summary.name"])
-            for elem in data_stores:
-                ds_name = None
-                ds_type = None
-                for prop in elem.propSet:
-                    if prop.name == "summary.type":
-                        ds_type = prop.val
-                    elif prop.name == "summary.name":
-                        ds_name = prop.val
+            """Get the datastore list and choose the local storage with the
+            most free space."""
+            data_store_name = None
+            free_space = None
+            for ds_ref, props in self._session.inventory.objects(
+                                                        "Datastore"):
                 # Local storage identifier
-                if ds_type == "VMFS":
-                    data_store_name = ds_name
-                    return data_store_name
+                if props.get("summary.type") != "VMFS":
+                    continue
+                ds_free_space = props.get("summary.freeSpace", 0)
+                if free_space is None or ds_free_space > free_space:
+                    data_store_name = props.get("summary.name")
+                    free_space = ds_free_space
 
             if data_store_name is None:
                 msg = _("Couldn't get a local Datastore reference")
                 LOG.exception(msg)
                 raise exception.Error(msg)
+            return data_store_name
 
         data_store_name = _get_datastore_ref()
 
@@ -152,15 +143,14 @@ class VMWareVMOps(object):
 
         def _get_vmfolder_and_res_pool_mors():
             """Get the Vm folder ref from the datacenter."""
-            dc_objs = self._session._call_method(vim_util, "get_objects",
-                                    "Datacenter", ["vmFolder"])
+            dc_objs = self._session.inventory.objects("Datacenter")
             # There is only one default datacenter in a standalone ESX host
-            vm_folder_mor = dc_objs[0].propSet[0].val
+            vm_folder_mor = dc_objs[0][1]["vmFolder"]
 
             # Get the resource pool. Taking the first resource pool coming our
             # way. Assuming that is the default resource pool.
-            res_pool_mor = self._session._call_method(vim_util, "get_objects",
-                                    "ResourcePool")[0].obj
+            res_pool_mor = self._session.inventory.objects(
+                                    "ResourcePool")[0][0]
             return vm_folder_mor, res_pool_mor
 
         vm_folder_mor, res_pool_mor = _get_vmfolder_and_res_pool_mors()
@@ -625,13 +615,12 @@ class VMWareVMOps(object):
 
     def suspend(self, instance, callback):
         """Suspend the specified instance."""
-        vm_ref = self._get_vm_ref_from_the_name(instance.name)
-        if vm_ref is None:
+        vm = self._session.inventory.find("VirtualMachine", "name",
+                                          instance.name)
+        if vm is None:
             raise exception.InstanceNotFound(instance_id=instance.id)
-
-        pwr_state = self._session._call_method(vim_util,
-                    "get_dynamic_property", vm_ref,
-                    "VirtualMachine", "runtime.powerState")
+        vm_ref, props = vm
+        pwr_state = props["runtime.powerState"]
         # Only PoweredOn VMs can be suspended.
         if pwr_state == "poweredOn":
             LOG.debug(_("Suspending the VM %s ") % instance.name)
@@ -649,13 +638,12 @@ class VMWareVMOps(object):
 
     def resume(self, instance, callback):
         """Resume the specified instance."""
-        vm_ref = self._get_vm_ref_from_the_name(instance.name)
-        if vm_ref is None:
+        vm = self._session.inventory.find("VirtualMachine", "name",
+                                          instance.name)
+        if vm is None:
             raise exception.InstanceNotFound(instance_id=instance.id)
-
-        pwr_state = self._session._call_method(vim_util,
-                                     "get_dynamic_property", vm_ref,
-                                     "VirtualMachine", "runtime.powerState")
+        vm_ref, props = vm
+        pwr_state = props["runtime.powerState"]
         if pwr_state.lower() == "suspended":
             LOG.debug(_("Resuming the VM %s") % instance.name)
             suspend_task = self._session._call_method(
@@ -669,28 +657,15 @@ class VMWareVMOps(object):
 
     def get_info(self, instance_name):
         """Return data about the VM instance."""
-        vm_ref = self._get_vm_ref_from_the_name(instance_name)
-        if vm_ref is None:
+        vm = self._session.inventory.find("VirtualMachine", "name",
+                                          instance_name)
+        if vm is None:
             raise exception.InstanceNotFound(instance_id=instance_name)
-
-        lst_properties = ["summary.config.numCpu",
-                    "summary.config.memorySizeMB",
-                    "runtime.powerState"]
-        vm_props = self._session._call_method(vim_util,
-                    "get_object_properties", None, vm_ref, "VirtualMachine",
-                    lst_properties)
-        max_mem = None
-        pwr_state = None
-        num_cpu = None
-        for elem in vm_props:
-            for prop in elem.propSet:
-                if prop.name == "summary.config.numCpu":
-                    num_cpu = int(prop.val)
-                elif prop.name == "summary.config.memorySizeMB":
-                    # In MB, but we want in KB
-                    max_mem = int(prop.val) * 1024
-                elif prop.name == "runtime.powerState":
-                    pwr_state = VMWARE_POWER_STATES[prop.val]
+        props = vm[1]
+        num_cpu = int(props["summary.config.numCpu"])
+        # In MB, but we want in KB
+        max_mem = int(props["summary.config.memorySizeMB"]) * 1024
+        pwr_state = VMWARE_POWER_STATES[props["runtime.powerState"]]
 
         return {'state': pwr_state,
                 'max_mem': max_mem,
@@ -778,9 +753,8 @@ class VMWareVMOps(object):
 
     def _get_datacenter_name_and_ref(self):
         """Get the datacenter name and the reference."""
-        dc_obj = self._session._call_method(vim_util, "get_objects",
-                "Datacenter", ["name"])
-        return dc_obj[0].obj, dc_obj[0].propSet[0].val
+        dc_ref, props = self._session.inventory.objects("Datacenter")[0]
+        return dc_ref, props["name"]
 
     def _path_exists(self, ds_browser, ds_path):
         """Check if the path exists on the datastore."""
@@ -816,12 +790,10 @@ class VMWareVMOps(object):
 
     def _get_vm_ref_from_the_name(self, vm_name):
         """Get reference to the VM with the name specified."""
-        vms = self._session._call_method(vim_util, "get_objects",
-                    "VirtualMachine", ["name"])
-        for vm in vms:
-            if vm.propSet[0].val == vm_name:
-                return vm.obj
-        return None
+        vm = self._session.inventory.find("VirtualMachine", "name", vm_name)
+        if vm is None:
+            return None
+        return vm[0]
 
     def plug_vifs(self, instance, network_info):
         """Plug VIFs into networks."""
@@ -18,6 +18,8 @@
 Utility functions for Image transfer.
 """
 
+import time
+
 from nova import exception
 from nova import flags
 from nova.image import glance
@@ -61,6 +63,7 @@ def start_transfer(read_file_handle, data_size, write_file_handle=None,
         write_thread = io_util.GlanceWriteThread(thread_safe_pipe,
                                          glance_client, image_id, image_meta)
     # Start the read and write threads.
+    started = time.time()
     read_event = read_thread.start()
     write_event = write_thread.start()
     try:
@@ -77,6 +80,8 @@ def start_transfer(read_file_handle, data_size, write_file_handle=None,
         # Log and raise the exception.
         LOG.exception(exc)
         raise exception.Error(exc)
+    else:
+        _log_throughput(data_size, time.time() - started)
     finally:
         # No matter what, try closing the read and write handles, if it so
         # applies.
@@ -85,6 +90,24 @@ def start_transfer(read_file_handle, data_size, write_file_handle=None,
             write_file_handle.close()
 
 
+def _log_throughput(data_size, elapsed):
+    size_mb = float(data_size) / (1024 * 1024)
+    LOG.info(_("Transferred %(size_mb).1f MB in %(elapsed).1f seconds "
+               "(%(rate).1f MB/s)") %
+             dict(locals(), rate=size_mb / max(elapsed, 0.001)))
+
+
+def _check_checksum(image, expected, checksum):
+    """Raise if the md5 of the data transferred is not the one of the
+    image."""
+    if expected and expected != checksum.hexdigest():
+        msg = (_("Checksum %(actual)s of the data transferred for image "
+                 "%(image)s does not match its checksum %(expected)s") %
+               dict(locals(), actual=checksum.hexdigest()))
+        LOG.error(msg)
+        raise exception.Error(msg)
+
+
 def fetch_image(context, image, instance, **kwargs):
     """Download image from the glance image server."""
     LOG.debug(_("Downloading image %s from glance image server") % image)
@@ -101,13 +124,15 @@ def fetch_image(context, image, instance, **kwargs):
                                 file_size)
     start_transfer(read_file_handle, file_size,
                    write_file_handle=write_file_handle)
+    _check_checksum(image, metadata.get('checksum'),
+                    read_file_handle.checksum)
     LOG.debug(_("Downloaded image %s from glance image server") % image)
 
 
 def upload_image(context, image, instance, **kwargs):
     """Upload the snapshotted vm disk file to Glance image server."""
     LOG.debug(_("Uploading image %s to the Glance image server") % image)
-    read_file_handle = read_write_util.VmWareHTTPReadFile(
+    read_file_handle = read_write_util.VMWareHTTPRangeReadFile(
                                 kwargs.get("host"),
                                 kwargs.get("data_center_name"),
                                 kwargs.get("datastore_name"),
@@ -127,6 +152,9 @@ def upload_image(context, image, instance, **kwargs):
                                             kwargs.get("image_version")}}
     start_transfer(read_file_handle, file_size, glance_client=glance_client,
                         image_id=image_id, image_meta=image_metadata)
+    _check_checksum(image,
+                    glance_client.get_image_meta(image_id).get('checksum'),
+                    read_file_handle.checksum)
     LOG.debug(_("Uploaded image %s to the Glance image server") % image)
 
 
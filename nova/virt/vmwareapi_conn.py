@@ -44,6 +44,7 @@ from nova import log as logging
 from nova import utils
 from nova.virt import driver
 from nova.virt.vmwareapi import error_util
+from nova.virt.vmwareapi import inventory
 from nova.virt.vmwareapi import vim
 from nova.virt.vmwareapi import vim_util
 from nova.virt.vmwareapi.vmops import VMWareVMOps
@@ -220,6 +221,7 @@ class VMWareAPISession(object):
         self._session_id = None
         self.vim = None
         self._create_session()
+        self.inventory = inventory.Inventory(self)
 
     def _get_vim_object(self):
         """Create the VIM Object instance."""
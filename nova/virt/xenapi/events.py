@@ -0,0 +1,185 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Watcher of the XenAPI task, VDI and VM events of a session.
+
+Instead of polling every task until it completes, one greenthread per
+session waits for task, VDI and VM events with event.from (or event.next
+on hosts without it) on a session of its own, and wakes the greenthreads
+waiting for the objects the events are about. Listeners are also given
+every event of the classes they listen to.
+"""
+
+import eventlet
+from eventlet import event
+from eventlet import greenthread
+from eventlet import tpool
+
+from nova import log as logging
+
+
+LOG = logging.getLogger("nova.virt.xenapi.events")
+
+CLASSES = ['task', 'VDI', 'VM']
+
+# NOTE: seconds event.from waits for events before returning none
+EVENT_FROM_TIMEOUT = 30.0
+RETRY_INTERVAL = 5
+
+
+class EventWatcher(object):
+    """Wakes the waiters for tasks and VDIs with their events."""
+
+    def __init__(self, XenAPI, create_session):
+        self.XenAPI = XenAPI
+        self._create_session = create_session
+        self._session = None
+        self._next_events = None
+        self._token = ''
+        self._waiters = {}
+        self._listeners = {}
+        self._thread = None
+
+    def start(self):
+        """Start watching, returns False if the host has no events."""
+        try:
+            self._connect()
+        except (self.XenAPI.Failure, NotImplementedError), exc:
+            LOG.warn(_("Unable to watch XenAPI events, polling tasks "
+                       "instead: %s"), exc)
+            self.stop()
+            return False
+        self._thread = eventlet.spawn(self._run)
+        return True
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.kill()
+            self._thread = None
+        if self._session is not None:
+            try:
+                self._session.xenapi.session.logout()
+            except Exception:
+                pass
+            self._session = None
+
+    def watch(self, ref):
+        """Returns an event sent the snapshot of ref at its next change.
+
+        The snapshot is None if the event didn't carry one.
+        """
+        waiter = event.Event()
+        self._waiters.setdefault(ref, []).append(waiter)
+        return waiter
+
+    def unwatch(self, ref, waiter):
+        waiters = self._waiters.get(ref, [])
+        if waiter in waiters:
+            waiters.remove(waiter)
+        if not waiters:
+            self._waiters.pop(ref, None)
+
+    def listen(self, cls, callback):
+        """Call callback with every event of objects of class cls.
+
+        callback is called with None when events may have been lost.
+        """
+        self._listeners.setdefault(cls.lower(), []).append(callback)
+
+    def _connect(self):
+        self._session = self._create_session()
+        xenapi_event = self._session.xenapi.event
+        try:
+            result = tpool.execute(getattr(xenapi_event, 'from'), CLASSES,
+                                   '', 0.0)
+            self._token = result['token']
+            self._next_events = self._event_from
+        except self.XenAPI.Failure, exc:
+            if exc.details[:1] != ['MESSAGE_METHOD_UNKNOWN']:
+                raise
+            tpool.execute(xenapi_event.register, CLASSES)
+            self._next_events = self._event_next
+
+    def _event_from(self):
+        result = getattr(self._session.xenapi.event, 'from')(
+                CLASSES, self._token, EVENT_FROM_TIMEOUT)
+        self._token = result['token']
+        return result['events']
+
+    def _event_next(self):
+        try:
+            return self._session.xenapi.event.next()
+        except self.XenAPI.Failure, exc:
+            if exc.details[:1] != ['EVENTS_LOST']:
+                raise
+            # NOTE: the events that were lost may have been what some
+            #       waiter waited for, so all of them check again.
+            LOG.warn(_("XenAPI events lost, waking all waiters"))
+            self._lost()
+            tpool.execute(self._session.xenapi.event.unregister, CLASSES)
+            tpool.execute(self._session.xenapi.event.register, CLASSES)
+            return [{'ref': ref, 'operation': 'mod'}
+                    for ref in self._waiters.keys()]
+
+    def _run(self):
+        while True:
+            try:
+                events = tpool.execute(self._next_events)
+            except Exception:
+                LOG.exception(_("Error watching XenAPI events, "
+                                "reconnecting"))
+                self._reconnect()
+                continue
+            for xenapi_event in events:
+                self._dispatch(xenapi_event)
+
+    def _reconnect(self):
+        # NOTE: changes may have been missed, so every waiter checks again
+        for ref in self._waiters.keys():
+            self._dispatch({'ref': ref, 'operation': 'mod'})
+        self._lost()
+        while True:
+            greenthread.sleep(RETRY_INTERVAL)
+            try:
+                self._session.xenapi.session.logout()
+            except Exception:
+                pass
+            try:
+                self._connect()
+                return
+            except Exception:
+                LOG.exception(_("Unable to reconnect to XenAPI events"))
+
+    def _dispatch(self, xenapi_event):
+        waiters = self._waiters.pop(xenapi_event.get('ref'), [])
+        for waiter in waiters:
+            waiter.send(xenapi_event.get('snapshot'))
+        cls = xenapi_event.get('class', '').lower()
+        for callback in self._listeners.get(cls, []):
+            self._call_listener(callback, xenapi_event)
+
+    def _lost(self):
+        for callbacks in self._listeners.values():
+            for callback in callbacks:
+                self._call_listener(callback, None)
+
+    def _call_listener(self, callback, xenapi_event):
+        try:
+            callback(xenapi_event)
+        except Exception:
+            LOG.exception(_("Error in XenAPI event listener"))
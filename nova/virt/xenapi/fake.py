@@ -108,7 +108,10 @@ def create_vm(name_label, status,
     return _create_object('VM',
                           {'name_label': name_label,
                            'domid': domid,
-                           'power-state': status,
+                           'power_state': status,
+                           'memory_static_max': str(1 << 30),
+                           'memory_dynamic_max': str(1 << 30),
+                           'VCPUs_max': '1',
                            'is_a_template': is_a_template,
                            'is_control_domain': is_control_domain})
 
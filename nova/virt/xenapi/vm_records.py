@@ -0,0 +1,172 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Snapshots of the VM records and RRD updates of a XenServer host.
+
+Looking VMs up one at a time takes a VM.get_by_name_label and a
+VM.get_record call per VM, hundreds of calls for each power state sync of
+a busy host. The VM records of the host are loaded with a single
+VM.get_all_records call instead, and kept current with VM events, or
+loaded again once older than --xenapi_vm_records_max_age seconds on hosts
+without events. Changes made through the session drop the snapshot.
+
+Likewise, the diagnostics of all VMs of the host are loaded with one
+rrd_updates request, at most every --xenapi_rrd_updates_max_age seconds.
+"""
+
+import time
+
+from nova import exception
+from nova import flags
+from nova import log as logging
+from nova.virt.xenapi import vm_utils
+
+
+LOG = logging.getLogger("nova.virt.xenapi.vm_records")
+
+FLAGS = flags.FLAGS
+flags.DEFINE_float('xenapi_vm_records_max_age',
+                   5.0,
+                   'Seconds the VM records listed with VM.get_all_records'
+                   ' are used before they are listed again, on hosts'
+                   ' without XenAPI events.')
+flags.DEFINE_float('xenapi_rrd_updates_max_age',
+                   5.0,
+                   'Seconds the RRD updates of the VMs of a host are used'
+                   ' for diagnostics before they are loaded again.')
+
+
+def changes_vms(method):
+    """Returns whether XenAPI method may change the records of VMs."""
+    if method.startswith('Async.'):
+        method = method[len('Async.'):]
+    cls, _sep, name = method.partition('.')
+    return cls == 'VM' and not name.startswith('get_')
+
+
+class VMRecords(object):
+    """Records of the VMs of the host of a session."""
+
+    def __init__(self, session):
+        self._session = session
+        self._records = None
+        self._loaded_at = None
+        self._events = None
+        self._refreshing = False
+        self._stale = False
+
+    def all(self):
+        """Returns {vm_ref: vm_rec} of all VMs of the host."""
+        if self._events is None:
+            self._events = self._session.listen_for_events('VM',
+                                                           self._changed)
+        if self._records is None or (not self._events and
+                time.time() - self._loaded_at >=
+                FLAGS.xenapi_vm_records_max_age):
+            return self.refresh()
+        return self._records
+
+    def get(self, vm_ref):
+        """Returns the record of VM vm_ref, None if there is none.
+
+        A VM missing from a snapshot loaded earlier is looked up again,
+        as it may have been created since.
+        """
+        cached = self._records
+        records = self.all()
+        vm_rec = records.get(vm_ref)
+        if vm_rec is None and records is cached:
+            vm_rec = self.refresh().get(vm_ref)
+        return vm_rec
+
+    def lookup(self, name_label):
+        """Returns (vm_ref, vm_rec) of the VM named name_label, None if
+        there is none."""
+        cached = self._records
+        records = self.all()
+        vms = self._find(records, name_label)
+        if not vms and records is cached:
+            vms = self._find(self.refresh(), name_label)
+        if not vms:
+            return None
+        elif len(vms) > 1:
+            raise exception.InstanceExists(name=name_label)
+        return vms[0]
+
+    def _find(self, records, name_label):
+        return [(vm_ref, vm_rec) for vm_ref, vm_rec in records.iteritems()
+                if vm_rec['name_label'] == name_label]
+
+    def refresh(self):
+        """Lists the records of the VMs of the host again."""
+        self._refreshing = True
+        self._stale = False
+        try:
+            records = dict(self._session.call_xenapi('VM.get_all_records'))
+        finally:
+            self._refreshing = False
+        # NOTE: an event that came during the call may or may not be in
+        #       the records, so they are listed again when next asked.
+        if self._stale:
+            self._records = None
+        else:
+            self._records = records
+            self._loaded_at = time.time()
+        return records
+
+    def invalidate(self):
+        """Lists the records of the VMs again when next asked."""
+        self._records = None
+        if self._refreshing:
+            self._stale = True
+
+    def _changed(self, xenapi_event):
+        if self._refreshing or xenapi_event is None:
+            self.invalidate()
+            return
+        if self._records is None:
+            return
+        vm_ref = xenapi_event.get('ref')
+        snapshot = xenapi_event.get('snapshot')
+        if xenapi_event.get('operation') == 'del':
+            self._records.pop(vm_ref, None)
+        elif snapshot:
+            self._records[vm_ref] = snapshot
+        else:
+            self.invalidate()
+
+
+class RRDUpdates(object):
+    """Latest RRD values of the VMs of a host."""
+
+    def __init__(self):
+        self._values = {}
+        self._loaded_at = {}
+
+    def get(self, host, vm_uuid):
+        """Returns {data source: value} of VM vm_uuid on host."""
+        loaded_at = self._loaded_at.get(host)
+        if (loaded_at is None or
+            time.time() - loaded_at >= FLAGS.xenapi_rrd_updates_max_age):
+            self.refresh(host)
+        return self._values.get(host, {}).get(vm_uuid, {})
+
+    def refresh(self, host):
+        xml = vm_utils.get_rrd_updates(host)
+        self._values[host] = xml and vm_utils.parse_rrd_updates(xml) or {}
+        self._loaded_at[host] = time.time()
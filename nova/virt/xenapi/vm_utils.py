@@ -20,7 +20,10 @@ Helper methods for operations related to the management of VM records and
 their attributes like VDIs, VIFs, as well as their lookup functions.
 """
 
+import errno
+import fcntl
 import json
+import mmap
 import os
 import pickle
 import re
@@ -30,6 +33,9 @@ import time
 import urllib
 import uuid
 from xml.dom import minidom
+from xml.parsers.expat import ExpatError
+
+from eventlet import tpool
 
 from nova import db
 from nova import exception
@@ -53,6 +59,16 @@ flags.DEFINE_integer('block_device_creation_timeout', 10,
                      'time to wait for a block device to be created')
 flags.DEFINE_integer('max_kernel_ramdisk_size', 16 * 1024 * 1024,
                      'maximum size in bytes of kernel or ramdisk images')
+flags.DEFINE_integer('xenapi_stream_block_size', 1024 * 1024,
+                     'bytes written to a VDI at a time when streaming an'
+                     ' image into it, a multiple of 4096')
+flags.DEFINE_bool('xenapi_stream_direct_io', True,
+                  'write images streamed into VDIs with O_DIRECT, bypassing'
+                  ' the page cache of the compute domU')
+flags.DEFINE_bool('xenapi_stream_sparse', True,
+                  'skip the all-zero blocks of images streamed into new'
+                  ' VDIs; turn off for SRs whose new VDIs may not read as'
+                  ' zeros')
 
 XENAPI_POWER_STATE = {
     'Halted': power_state.SHUTDOWN,
@@ -66,6 +82,11 @@ SECTOR_SIZE = 512
 MBR_SIZE_SECTORS = 63
 MBR_SIZE_BYTES = MBR_SIZE_SECTORS * SECTOR_SIZE
 KERNEL_DIR = '/boot/guest'
+# NOTE: seconds between progress reports of images streamed into VDIs
+STREAM_PROGRESS_INTERVAL = 10
+# NOTE: seconds of RRD updates requested and seconds between their rows
+RRD_UPDATES_WINDOW = 60
+RRD_UPDATES_INTERVAL = 5
 
 
 class ImageType:
@@ -778,20 +799,8 @@ class VMHelper(HelperBase):
             return {"Unable to retrieve diagnostics": e}
 
         try:
-            diags = {}
-            xml = get_rrd(host_ip, record["uuid"])
-            if xml:
-                rrd = minidom.parseString(xml)
-                for i, node in enumerate(rrd.firstChild.childNodes):
-                    # We don't want all of the extra garbage
-                    if i >= 3 and i <= 11:
-                        ref = node.childNodes
-                        # Name and Value
-                        if len(ref) > 6:
-                            diags[ref[0].firstChild.data] = \
-                                ref[6].firstChild.data
-            return diags
-        except cls.XenAPI.Failure as e:
+            return session.rrd_updates.get(host_ip, record["uuid"])
+        except (cls.XenAPI.Failure, ExpatError) as e:
             return {"Unable to retrieve diagnostics": e}
 
     @classmethod
@@ -809,19 +818,41 @@ class VMHelper(HelperBase):
         session.call_xenapi('SR.scan', sr_ref)
 
 
-def get_rrd(host, vm_uuid):
-    """Return the VM RRD XML as a string"""
+def get_rrd_updates(host):
+    """Return the latest RRD updates of all VMs of the host as an XML
+    string"""
     try:
-        xml = urllib.urlopen("http://%s:%s@%s/vm_rrd?uuid=%s" % (
+        xml = urllib.urlopen("http://%s:%s@%s/rrd_updates?start=%d"
+                             "&cf=AVERAGE&interval=%d" % (
             FLAGS.xenapi_connection_username,
             FLAGS.xenapi_connection_password,
             host,
-            vm_uuid))
+            int(time.time()) - RRD_UPDATES_WINDOW,
+            RRD_UPDATES_INTERVAL))
         return xml.read()
     except IOError:
         return None
 
 
+def parse_rrd_updates(xml):
+    """Return {vm_uuid: {data source: value}} of the newest row of RRD
+    updates"""
+    rrd = minidom.parseString(xml)
+    legend = [entry.firstChild.data
+              for entry in rrd.getElementsByTagName('entry')]
+    rows = rrd.getElementsByTagName('row')
+    if not rows:
+        return {}
+    values = [v.firstChild.data for v in rows[0].getElementsByTagName('v')]
+    diags = {}
+    for entry, value in zip(legend, values):
+        # NOTE: entries are named CF:vm:uuid:data source
+        parts = entry.split(':', 3)
+        if len(parts) == 4 and parts[1] == 'vm':
+            diags.setdefault(parts[2], {})[parts[3]] = value
+    return diags
+
+
 #TODO(sirp): This code comes from XS5.6 pluginlib.py, we should refactor to
 # use that implmenetation
 def get_vhd_parent(session, vdi_rec):
@@ -879,30 +910,38 @@ def wait_for_vhd_coalesce(session, instance_id, sr_ref, vdi_ref,
             snapshot
     """
     max_attempts = FLAGS.xenapi_vhd_coalesce_max_attempts
-    attempts = {'counter': 0}
-
-    def _poll_vhds():
-        attempts['counter'] += 1
-        if attempts['counter'] > max_attempts:
-            counter = attempts['counter']
-            msg = (_("VHD coalesce attempts exceeded (%(counter)d >"
-                    " %(max_attempts)d), giving up...") % locals())
-            raise exception.Error(msg)
-
-        VMHelper.scan_sr(session, instance_id, sr_ref)
-        parent_uuid = get_vhd_parent_uuid(session, vdi_ref)
-        if original_parent_uuid and (parent_uuid != original_parent_uuid):
-            LOG.debug(_("Parent %(parent_uuid)s doesn't match original parent"
-                    " %(original_parent_uuid)s, waiting for coalesce...")
-                    % locals())
-        else:
-            # Breakout of the loop (normally) and return the parent_uuid
-            raise utils.LoopingCallDone(parent_uuid)
-
-    loop = utils.LoopingCall(_poll_vhds)
-    loop.start(FLAGS.xenapi_vhd_coalesce_poll_interval, now=True)
-    parent_uuid = loop.wait()
-    return parent_uuid
+    poll_interval = FLAGS.xenapi_vhd_coalesce_poll_interval
+    # NOTE: VDI events don't mean the VHD was coalesced, so the time to
+    #       give up is what max_attempts polls took, not a number of events
+    deadline = time.time() + max_attempts * poll_interval
+    VMHelper.scan_sr(session, instance_id, sr_ref)
+    while True:
+        # NOTE: watch before reading the parent, a coalesce between the
+        #       read and the wait would be missed otherwise
+        waiter = session.watch_vdi(vdi_ref)
+        try:
+            parent_uuid = get_vhd_parent_uuid(session, vdi_ref)
+            if not original_parent_uuid or \
+               parent_uuid == original_parent_uuid:
+                return parent_uuid
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            LOG.debug(_("Parent %(parent_uuid)s doesn't match original "
+                    "parent %(original_parent_uuid)s, waiting for "
+                    "coalesce...") % locals())
+            # NOTE: the garbage collector records the new parent of the
+            #       VDI once it has coalesced it, which is a VDI event.
+            #       Scanning the SR is only needed when no event comes.
+            if not session.wait_for_vdi_change(
+                    vdi_ref, min(poll_interval, remaining), waiter):
+                VMHelper.scan_sr(session, instance_id, sr_ref)
+        finally:
+            session.unwatch_vdi(vdi_ref, waiter)
+
+    msg = (_("VHD coalesce attempts exceeded (%(max_attempts)d), "
+             "giving up...") % locals())
+    raise exception.Error(msg)
 
 
 def get_vdi_for_vm_safely(session, vm_ref):
@@ -1119,17 +1158,142 @@ def _is_vdi_pv(dev):
 
 
 def _stream_disk(dev, image_type, virtual_size, image_file):
+    """Write image_file into the newly created VDI attached as dev."""
     offset = 0
     if image_type == ImageType.DISK:
         offset = MBR_SIZE_BYTES
         _write_partition(virtual_size, dev)
 
-    utils.execute('chown', os.getuid(), '/dev/%s' % dev, run_as_root=True)
+    dev_path = '/dev/%s' % dev
+    utils.execute('chown', os.getuid(), dev_path, run_as_root=True)
+    _stream_image(dev_path, image_file, offset, virtual_size,
+                  sparse=FLAGS.xenapi_stream_sparse)
+
+
+def _image_blocks(image_file, block_size):
+    """Yields the data of image_file in blocks of block_size bytes, the
+    last one possibly shorter."""
+    pending = []
+    pending_size = 0
+    for chunk in image_file:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size < block_size:
+            continue
+        data = ''.join(pending)
+        end = len(data) - len(data) % block_size
+        for start in xrange(0, end, block_size):
+            yield data[start:start + block_size]
+        pending = [data[end:]]
+        pending_size = len(pending[0])
+    if pending_size:
+        yield ''.join(pending)
+
+
+def _stream_image(path, image_file, offset=0, image_size=None, sparse=False):
+    """Write the chunks of image_file to path from offset on.
+
+    The chunks are written in --xenapi_stream_block_size blocks, with
+    O_DIRECT where path supports it. With sparse, path must read as zeros
+    already, as newly created VDIs do, and all-zero blocks are skipped.
+    Returns (bytes written, bytes skipped).
+    """
+    writer = _DiskWriter(path, FLAGS.xenapi_stream_block_size)
+    zeros = '\0' * writer.block_size
+    position = offset
+    written = skipped = 0
+    started = last_report = time.time()
+    try:
+        for block in _image_blocks(image_file, writer.block_size):
+            if sparse and block == zeros[:len(block)]:
+                skipped += len(block)
+            else:
+                writer.write(position, block)
+                written += len(block)
+            position += len(block)
+
+            now = time.time()
+            if now - last_report >= STREAM_PROGRESS_INTERVAL:
+                last_report = now
+                LOG.debug(_('Streamed %(done)d of %(total)s bytes into '
+                            '%(path)s, %(skipped)d bytes of zeros skipped')
+                          % {'done': written + skipped,
+                             'total': image_size or _('unknown'),
+                             'path': path, 'skipped': skipped})
+        writer.flush()
+    finally:
+        writer.close()
+
+    seconds = max(time.time() - started, 0.001)
+    LOG.debug(_('Streamed %(total)d bytes into %(path)s in %(seconds).1f '
+                'seconds (%(rate).1f MB/s), %(skipped)d bytes of zeros '
+                'skipped') %
+              {'total': written + skipped, 'path': path, 'seconds': seconds,
+               'rate': (written + skipped) / seconds / (1024 * 1024),
+               'skipped': skipped})
+    return written, skipped
+
 
-    with open('/dev/%s' % dev, 'wb') as f:
-        f.seek(offset)
-        for chunk in image_file:
-            f.write(chunk)
+class _DiskWriter(object):
+    """Writes blocks at given offsets of a device, with O_DIRECT if it can.
+
+    Direct writes have to come from aligned memory in multiples of the
+    sector size, so they are copied into a page aligned mmap buffer; a
+    shorter last block is written without O_DIRECT.
+    """
+
+    def __init__(self, path, block_size):
+        self.path = path
+        self.block_size = block_size
+        self.direct = False
+        self._position = None
+        self._buffer = None
+        self._fd = self._open()
+        if self.direct:
+            self._buffer = mmap.mmap(-1, block_size)
+
+    def _open(self):
+        o_direct = getattr(os, 'O_DIRECT', 0)
+        if FLAGS.xenapi_stream_direct_io and o_direct:
+            try:
+                fd = os.open(self.path, os.O_WRONLY | o_direct)
+                self.direct = True
+                return fd
+            except OSError, e:
+                if e.errno != errno.EINVAL:
+                    raise
+                LOG.debug(_('%s does not support O_DIRECT, writing it '
+                            'through the page cache'), self.path)
+        return os.open(self.path, os.O_WRONLY)
+
+    def write(self, position, data):
+        if position != self._position:
+            os.lseek(self._fd, position, os.SEEK_SET)
+        if self.direct and len(data) % SECTOR_SIZE:
+            self._disable_direct()
+        if self.direct:
+            self._buffer.seek(0)
+            self._buffer.write(data)
+            data = buffer(self._buffer, 0, len(data))
+        # NOTE: direct writes wait for the disk, so they are made from a
+        #       native thread to keep the other greenthreads running.
+        done = tpool.execute(os.write, self._fd, data)
+        while done < len(data):
+            done += tpool.execute(os.write, self._fd, buffer(data, done))
+        self._position = position + done
+
+    def _disable_direct(self):
+        flags = fcntl.fcntl(self._fd, fcntl.F_GETFL)
+        fcntl.fcntl(self._fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+        self.direct = False
+
+    def flush(self):
+        tpool.execute(os.fsync, self._fd)
+
+    def close(self):
+        os.close(self._fd)
+        if self._buffer is not None:
+            self._buffer.close()
 
 
 def _write_partition(virtual_size, dev):
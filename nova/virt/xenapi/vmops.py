@@ -83,31 +83,28 @@ class VMOps(object):
         self.vif_driver = utils.import_object(FLAGS.xenapi_vif_driver)
         self._product_version = product_version
 
+    def _list_vm_recs(self):
+        """Return the records of the instance VMs of the host."""
+        return [vm_rec for vm_rec in self._session.vm_records.all().values()
+                if not vm_rec["is_a_template"] and
+                   not vm_rec["is_control_domain"]]
+
     def list_instances(self):
         """List VM instances."""
-        # TODO(justinsb): Should we just always use the details method?
-        #  Seems to be the same number of API calls..
-        vm_refs = []
-        for vm_ref in self._session.get_xenapi().VM.get_all():
-            vm_rec = self._session.get_xenapi().VM.get_record(vm_ref)
-            if not vm_rec["is_a_template"] and not vm_rec["is_control_domain"]:
-                vm_refs.append(vm_rec["name_label"])
-        return vm_refs
+        return [vm_rec["name_label"] for vm_rec in self._list_vm_recs()]
 
     def list_instances_detail(self):
         """List VM instances, returning InstanceInfo objects."""
         instance_infos = []
-        for vm_ref in self._session.get_xenapi().VM.get_all():
-            vm_rec = self._session.get_xenapi().VM.get_record(vm_ref)
-            if not vm_rec["is_a_template"] and not vm_rec["is_control_domain"]:
-                name = vm_rec["name_label"]
+        for vm_rec in self._list_vm_recs():
+            name = vm_rec["name_label"]
 
-                # TODO(justinsb): This a roundabout way to map the state
-                openstack_format = VMHelper.compile_info(vm_rec)
-                state = openstack_format['state']
+            # TODO(justinsb): This a roundabout way to map the state
+            openstack_format = VMHelper.compile_info(vm_rec)
+            state = openstack_format['state']
 
-                instance_info = driver.InstanceInfo(name, state)
-                instance_infos.append(instance_info)
+            instance_info = driver.InstanceInfo(name, state)
+            instance_infos.append(instance_info)
         return instance_infos
 
     def revert_migration(self, instance):
@@ -1041,17 +1038,33 @@ class VMOps(object):
             self._session.call_xenapi("VM.start", original_vm_ref, False,
                                       False)
 
+    def _get_vm_rec(self, instance_or_vm):
+        """Return the record of a VM, given like to _get_vm_opaque_ref,
+        from the VM records of the host."""
+        vm_records = self._session.vm_records
+        if isinstance(instance_or_vm, basestring):
+            vm_rec = vm_records.all().get(instance_or_vm)
+            if vm_rec is not None:
+                return vm_rec
+            found = vm_records.lookup(instance_or_vm)
+        elif isinstance(instance_or_vm, (int, long)):
+            vm_ref = self._get_vm_opaque_ref(instance_or_vm)
+            found = vm_ref, vm_records.get(vm_ref)
+        else:
+            found = vm_records.lookup(instance_or_vm.name)
+        if found is None or found[1] is None:
+            raise exception.NotFound(_("No opaque_ref could be determined "
+                    "for '%s'.") % instance_or_vm)
+        return found[1]
+
     def get_info(self, instance):
         """Return data about VM instance."""
-        vm_ref = self._get_vm_opaque_ref(instance)
-        vm_rec = self._session.get_xenapi().VM.get_record(vm_ref)
-        return VMHelper.compile_info(vm_rec)
+        return VMHelper.compile_info(self._get_vm_rec(instance))
 
     def get_diagnostics(self, instance):
         """Return data about VM diagnostics."""
-        vm_ref = self._get_vm_opaque_ref(instance)
-        vm_rec = self._session.get_xenapi().VM.get_record(vm_ref)
-        return VMHelper.compile_diagnostics(self._session, vm_rec)
+        return VMHelper.compile_diagnostics(self._session,
+                                            self._get_vm_rec(instance))
 
     def get_console_output(self, instance):
         """Return snapshot of console."""
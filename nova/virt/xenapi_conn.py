@@ -21,20 +21,20 @@ A connection to XenServer or Xen Cloud Platform.
 The concurrency model for this class is as follows:
 
 All XenAPI calls are on a green thread (using eventlet's "tpool"
-thread pool). They are remote calls, and so may hang for the usual
-reasons.
+thread pool), each on one of a pool of sessions logged in to the host, so
+that as many calls as there are sessions run at once. They are remote
+calls, and so may hang for the usual reasons. A session that expired is
+logged in again.
 
 All long-running XenAPI calls (VM.start, VM.reboot, etc) are called async
-(using XenAPI.VM.async_start etc). These return a task, which can then be
-polled for completion.
+(using XenAPI.VM.async_start etc). These return a task, whose completion is
+announced by a task event, or which is polled for completion on hosts
+without events.
 
 This combination of techniques means that we don't block the main thread at
 all, and at the same time we don't hold lots of threads waiting for
 long-running operations.
 
-FIXME: get_info currently doesn't conform to these rules, and will block the
-reactor thread if the VM.get_by_name_label or VM.get_record calls block.
-
 **Related Flags**
 
 :xenapi_connection_url:  URL for connection to XenServer/Xen Cloud Platform.
@@ -42,9 +42,13 @@ reactor thread if the VM.get_by_name_label or VM.get_record calls block.
                               Platform (default: root).
 :xenapi_connection_password:  Password for connection to XenServer/Xen Cloud
                               Platform.
+:xenapi_connection_concurrent:  Number of sessions logged in to XenServer/Xen
+                                Cloud Platform (default: 5).
 :xenapi_task_poll_interval:  The interval (seconds) used for polling of
                              remote tasks (Async.VM.start, etc)
                              (default: 0.5).
+:xenapi_task_events:         Wait for task events instead of polling tasks
+                             (default: True).
 :target_host:                the iSCSI Target Host IP address, i.e. the IP
                              address for the nova-volume host
 :target_port:                iSCSI Target Port, 3260 Default
@@ -57,23 +61,25 @@ reactor thread if the VM.get_by_name_label or VM.get_record calls block.
 - suffix "_rec" for record objects
 """
 
+import contextlib
 import json
 import random
-import sys
 import urlparse
 import xmlrpclib
 
-from eventlet import event
+from eventlet import greenthread
+from eventlet import queue
 from eventlet import tpool
 from eventlet import timeout
 
 from nova import context
 from nova import db
 from nova import exception
-from nova import utils
 from nova import flags
 from nova import log as logging
 from nova.virt import driver
+from nova.virt.xenapi import events
+from nova.virt.xenapi import vm_records
 from nova.virt.xenapi import vm_utils
 from nova.virt.xenapi.vmops import VMOps
 from nova.virt.xenapi.volumeops import VolumeOps
@@ -96,11 +102,24 @@ flags.DEFINE_string('xenapi_connection_password',
                     None,
                     'Password for connection to XenServer/Xen Cloud Platform.'
                     ' Used only if connection_type=xenapi.')
+flags.DEFINE_integer('xenapi_connection_concurrent',
+                     5,
+                     'Maximum number of concurrent XenAPI connections.'
+                     ' Used only if connection_type=xenapi.')
 flags.DEFINE_float('xenapi_task_poll_interval',
                    0.5,
                    'The interval used for polling of remote tasks '
                    '(Async.VM.start, etc). Used only if '
                    'connection_type=xenapi.')
+flags.DEFINE_bool('xenapi_task_events',
+                  True,
+                  'Wait for XenAPI events to learn that tasks completed, '
+                  'instead of polling each task. Used only if '
+                  'connection_type=xenapi.')
+flags.DEFINE_float('xenapi_task_recheck_interval',
+                   30.0,
+                   'The interval used for checking tasks no event was '
+                   'received for. Used only if connection_type=xenapi.')
 flags.DEFINE_float('xenapi_vhd_coalesce_poll_interval',
                    5.0,
                    'The interval used for polling of coalescing vhds.'
@@ -356,11 +375,21 @@ class XenAPISession(object):
 
     def __init__(self, url, user, pw):
         self.XenAPI = self.get_imported_xenapi()
-        self._session = self._create_session(url)
-        exception = self.XenAPI.Failure(_("Unable to log in to XenAPI "
-                            "(is the Dom0 disk full?)"))
-        with timeout.Timeout(FLAGS.xenapi_login_timeout, exception):
-            self._session.login_with_password(user, pw)
+        self._url = url
+        self._user = user
+        self._pw = pw
+        self._sessions = queue.Queue()
+        for _i in xrange(FLAGS.xenapi_connection_concurrent):
+            self._sessions.put(self._login())
+        self._host_ref = None
+        self._watcher = None
+        self.vm_records = vm_records.VMRecords(self)
+        self.rrd_updates = vm_records.RRDUpdates()
+
+    def _login(self):
+        session = self._create_session(self._url)
+        self._relogin(session)
+        return session
 
     def get_product_version(self):
         """Return a tuple of (major, minor, rev) for the host version"""
@@ -375,76 +404,191 @@ class XenAPISession(object):
         return __import__('XenAPI')
 
     def get_xenapi(self):
-        """Return the xenapi object"""
-        return self._session.xenapi
+        """Return the xenapi object, whose methods are called on a
+        background thread with a session of the pool"""
+        return _XenAPIMethod(self, None)
 
     def get_xenapi_host(self):
         """Return the xenapi host"""
-        return self._session.xenapi.session.get_this_host(self._session.handle)
+        if self._host_ref is None:
+            self._host_ref = self._call_with_session(
+                    lambda session: session.xenapi.session.get_this_host(
+                            session.handle))
+        return self._host_ref
+
+    @contextlib.contextmanager
+    def _get_session(self):
+        """Take a session from the pool, waiting for one to be free."""
+        session = self._sessions.get()
+        try:
+            yield session
+        finally:
+            self._sessions.put(session)
+
+    def _call_with_session(self, f, *args):
+        """Call f(session, *args) on a background thread with a session of
+        the pool, logging it in again if it expired."""
+        with self._get_session() as session:
+            try:
+                return tpool.execute(f, session, *args)
+            except self.XenAPI.Failure, exc:
+                if exc.details[:1] != ['SESSION_INVALID']:
+                    raise
+            LOG.info(_("XenAPI session expired, logging in again"))
+            self._relogin(session)
+            return tpool.execute(f, session, *args)
+
+    def _relogin(self, session):
+        exception = self.XenAPI.Failure(_("Unable to log in to XenAPI "
+                            "(is the Dom0 disk full?)"))
+        with timeout.Timeout(FLAGS.xenapi_login_timeout, exception):
+            session.login_with_password(self._user, self._pw)
 
     def call_xenapi(self, method, *args):
         """Call the specified XenAPI method on a background thread."""
-        f = self._session.xenapi
-        for m in method.split('.'):
-            f = f.__getattr__(m)
-        return tpool.execute(f, *args)
+        def call(session, *args):
+            f = session.xenapi
+            for m in method.split('.'):
+                f = f.__getattr__(m)
+            return f(*args)
+        try:
+            return self._call_with_session(call, *args)
+        finally:
+            if vm_records.changes_vms(method):
+                self.vm_records.invalidate()
 
     def call_xenapi_request(self, method, *args):
         """Some interactions with dom0, such as interacting with xenstore's
         param record, require using the xenapi_request method of the session
         object. This wraps that call on a background thread.
         """
-        f = self._session.xenapi_request
-        return tpool.execute(f, method, *args)
+        try:
+            return self._call_with_session(
+                    lambda session: session.xenapi_request(method, *args))
+        finally:
+            if vm_records.changes_vms(method):
+                self.vm_records.invalidate()
 
     def async_call_plugin(self, plugin, fn, args):
         """Call Async.host.call_plugin on a background thread."""
-        return tpool.execute(self._unwrap_plugin_exceptions,
-                             self._session.xenapi.Async.host.call_plugin,
-                             self.get_xenapi_host(), plugin, fn, args)
+        host_ref = self.get_xenapi_host()
+        return self._call_with_session(
+                lambda session: self._unwrap_plugin_exceptions(
+                        session.xenapi.Async.host.call_plugin,
+                        host_ref, plugin, fn, args))
+
+    def _get_watcher(self):
+        """Return the event watcher of the session, None if the host has
+        no events."""
+        if self._watcher is None:
+            self._watcher = False
+            if FLAGS.xenapi_task_events:
+                watcher = events.EventWatcher(self.XenAPI, self._login)
+                if watcher.start():
+                    self._watcher = watcher
+        return self._watcher or None
+
+    def listen_for_events(self, cls, callback):
+        """Call callback with every event of objects of class cls, returns
+        False if the host has no events."""
+        watcher = self._get_watcher()
+        if not watcher:
+            return False
+        watcher.listen(cls, callback)
+        return True
 
     def wait_for_task(self, task, id=None):
-        """Return the result of the given task. The task is polled
-        until it completes."""
-        done = event.Event()
-        loop = utils.LoopingCall(f=None)
-
-        def _poll_task():
-            """Poll the given XenAPI task, and return the result if the
-            action was completed successfully or not.
-            """
+        """Return the result of the given task. The task is waited for
+        with task events, or polled if the host has none, until it
+        completes."""
+        watcher = self._get_watcher()
+        task_rec = None
+        while True:
+            if watcher:
+                waiter = watcher.watch(task)
             try:
-                name = self._session.xenapi.task.get_name_label(task)
-                status = self._session.xenapi.task.get_status(task)
-                # Ensure action is never > 255
-                action = dict(action=name[:255], error=None)
-                if id:
-                    action["instance_id"] = int(id)
-                if status == "pending":
-                    return
-                elif status == "success":
-                    result = self._session.xenapi.task.get_result(task)
-                    LOG.info(_("Task [%(name)s] %(task)s status:"
-                            " success    %(result)s") % locals())
-                    done.send(_parse_xmlrpc_value(result))
-                else:
-                    error_info = self._session.xenapi.task.get_error_info(task)
-                    action["error"] = str(error_info)
-                    LOG.warn(_("Task [%(name)s] %(task)s status:"
-                            " %(status)s    %(error_info)s") % locals())
-                    done.send_exception(self.XenAPI.Failure(error_info))
-
-                if id:
-                    db.instance_action_create(context.get_admin_context(),
-                            action)
+                if task_rec is None:
+                    task_rec = self.call_xenapi('task.get_record', task)
+                if task_rec['status'] != 'pending':
+                    break
+                task_rec = None
+                if not watcher:
+                    greenthread.sleep(FLAGS.xenapi_task_poll_interval)
+                    continue
+                # NOTE: the task is checked again if no event comes, in
+                #       case it was lost.
+                with timeout.Timeout(FLAGS.xenapi_task_recheck_interval,
+                                     False):
+                    task_rec = waiter.wait()
             except self.XenAPI.Failure, exc:
                 LOG.warn(exc)
-                done.send_exception(*sys.exc_info())
-            loop.stop()
-
-        loop.f = _poll_task
-        loop.start(FLAGS.xenapi_task_poll_interval, now=True)
-        return done.wait()
+                raise
+            finally:
+                if watcher:
+                    watcher.unwatch(task, waiter)
+        # NOTE: the task may have changed VMs
+        self.vm_records.invalidate()
+        return self._task_result(task, task_rec, id)
+
+    def _task_result(self, task, task_rec, id=None):
+        """Log the completion of a task and return its parsed result."""
+        name = task_rec['name_label']
+        status = task_rec['status']
+        # Ensure action is never > 255
+        action = dict(action=name[:255], error=None)
+        if id:
+            action["instance_id"] = int(id)
+        try:
+            if status == "success":
+                result = task_rec['result']
+                LOG.info(_("Task [%(name)s] %(task)s status:"
+                        " success    %(result)s") % locals())
+                return _parse_xmlrpc_value(result)
+            else:
+                error_info = task_rec['error_info']
+                action["error"] = str(error_info)
+                LOG.warn(_("Task [%(name)s] %(task)s status:"
+                        " %(status)s    %(error_info)s") % locals())
+                raise self.XenAPI.Failure(error_info)
+        finally:
+            if id:
+                db.instance_action_create(context.get_admin_context(),
+                        action)
+
+    def watch_vdi(self, vdi_ref):
+        """Start watching VDI vdi_ref for changes, returns the waiter to
+        give wait_for_vdi_change, None if the host has no events."""
+        watcher = self._get_watcher()
+        if not watcher:
+            return None
+        return watcher.watch(vdi_ref)
+
+    def unwatch_vdi(self, vdi_ref, waiter):
+        """Stop watching VDI vdi_ref with the waiter of watch_vdi."""
+        if waiter is not None:
+            self._get_watcher().unwatch(vdi_ref, waiter)
+
+    def wait_for_vdi_change(self, vdi_ref, seconds, waiter=None):
+        """Wait at most seconds for VDI vdi_ref to change, returns whether
+        it did. Without events, just sleeps.
+
+        Changes since watch_vdi returned waiter count too when it is
+        given; it is left for the caller to unwatch."""
+        watcher = self._get_watcher()
+        if not watcher:
+            greenthread.sleep(seconds)
+            return False
+        own_waiter = waiter is None
+        if own_waiter:
+            waiter = watcher.watch(vdi_ref)
+        try:
+            with timeout.Timeout(seconds, False):
+                waiter.wait()
+                return True
+            return False
+        finally:
+            if own_waiter:
+                watcher.unwatch(vdi_ref, waiter)
 
     def _create_session(self, url):
         """Stubout point. This can be replaced with a mock session."""
@@ -472,6 +616,24 @@ class XenAPISession(object):
             raise
 
 
+class _XenAPIMethod(object):
+    """XenAPI object or method whose calls go through call_xenapi."""
+
+    def __init__(self, session, name):
+        self._session = session
+        self._name = name
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._name is not None:
+            name = '%s.%s' % (self._name, name)
+        return _XenAPIMethod(self._session, name)
+
+    def __call__(self, *args):
+        return self._session.call_xenapi(self._name, *args)
+
+
 class HostState(object):
     """Manages information about the XenServer host this compute
     node is running on.
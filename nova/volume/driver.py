@@ -22,13 +22,18 @@ Drivers for volumes.
 
 import time
 import os
+import shlex
 from xml.etree import ElementTree
 
+from eventlet import greenpool
+
 from nova import exception
 from nova import flags
 from nova import log as logging
 from nova import utils
+from nova.volume import lvm
 from nova.volume import volume_types
+from nova.volume import wipe
 
 
 LOG = logging.getLogger("nova.volume.driver")
@@ -52,10 +57,28 @@ flags.DEFINE_integer('iscsi_num_targets',
                     'Number of iscsi target ids per host')
 flags.DEFINE_string('iscsi_target_prefix', 'iqn.2010-10.org.openstack:',
                     'prefix for iscsi volumes')
+flags.DEFINE_integer('iscsi_export_concurrency', 8,
+                     'number of volumes re-exported at a time when the '
+                     'volume service starts')
 flags.DEFINE_string('iscsi_ip_prefix', '$my_ip',
                     'discover volumes on the ip that starts with this prefix')
 flags.DEFINE_string('rbd_pool', 'rbd',
                     'the rbd pool in which volumes are stored')
+flags.DEFINE_integer('rbd_image_format', 1,
+                     'format of new rbd images; snapshots of format 2 '
+                     'images are cloned, those of format 1 are copied. '
+                     'Format 2 needs an rbd command with --image-format '
+                     'and kernel rbd and qemu clients that support it')
+flags.DEFINE_string('volume_thin_pool', '',
+                    'thin pool of volume_group to create volumes in; '
+                    'volumes created from their snapshots are thin '
+                    'snapshots too, which copy no data')
+flags.DEFINE_integer('volume_copy_block_size', 4,
+                     'MB copied at a time when copying a volume, a '
+                     'divisor of 1024')
+flags.DEFINE_string('volume_copy_ionice', '',
+                    'ionice options of volume copies, -c3 to copy only '
+                    'when the disks are idle')
 
 
 class VolumeDriver(object):
@@ -66,6 +89,12 @@ class VolumeDriver(object):
         self.db = None
         self._execute = execute
         self._sync_exec = sync_exec
+        self._lvm = lvm.LvmInventory(self._lvm_execute)
+
+    def _lvm_execute(self, *command, **kwargs):
+        # NOTE: _execute is looked up on every call, as it is replaced
+        #       after the driver is made.
+        return self._execute(*command, **kwargs)
 
     def _try_execute(self, *command, **kwargs):
         # NOTE(vish): Volume commands can partially fail due to timing, but
@@ -84,6 +113,15 @@ class VolumeDriver(object):
                                 "Try number %s"), tries)
                 time.sleep(tries ** 2)
 
+    def do_setup(self, context):
+        """Any initialization the volume driver does while starting"""
+        pass
+
+    def _resume_volume_wipe(self):
+        """Resumes wiping the logical volumes deleted before a restart."""
+        if FLAGS.background_volume_wipe:
+            wipe.get_queue(FLAGS.volume_group, self._execute)
+
     def check_for_setup_error(self):
         """Returns an error if prerequisites aren't met"""
         out, err = self._execute('vgs', '--noheadings', '-o', 'name',
@@ -94,32 +132,56 @@ class VolumeDriver(object):
                                   % FLAGS.volume_group)
 
     def _create_volume(self, volume_name, sizestr):
-        self._try_execute('lvcreate', '-L', sizestr, '-n',
-                          volume_name, FLAGS.volume_group, run_as_root=True)
+        if FLAGS.volume_thin_pool:
+            self._try_execute('lvcreate', '-T', '%s/%s' %
+                              (FLAGS.volume_group, FLAGS.volume_thin_pool),
+                              '-V', sizestr, '-n', volume_name,
+                              run_as_root=True)
+        else:
+            self._try_execute('lvcreate', '-L', sizestr, '-n', volume_name,
+                              FLAGS.volume_group, run_as_root=True)
+        self._lvm.invalidate(FLAGS.volume_group)
 
-    def _copy_volume(self, srcstr, deststr, size_in_g):
-        self._execute('dd', 'if=%s' % srcstr, 'of=%s' % deststr,
-                      'count=%d' % (size_in_g * 1024), 'bs=1M',
-                      run_as_root=True)
+    def _copy_volume(self, srcstr, deststr, size_in_g, sparse=False):
+        """Copies size_in_g GB of srcstr to deststr.
+
+        With sparse, deststr must read as zeros already, and the zero
+        blocks of srcstr are skipped.
+        """
+        block_size = FLAGS.volume_copy_block_size
+        if block_size < 1 or 1024 % block_size:
+            block_size = 1
+        cmd = ['dd', 'if=%s' % srcstr, 'of=%s' % deststr,
+               'count=%d' % (size_in_g * 1024 / block_size),
+               'bs=%dM' % block_size]
+        if sparse:
+            cmd.append('conv=sparse')
+        if FLAGS.volume_copy_ionice:
+            cmd = ['ionice'] + shlex.split(FLAGS.volume_copy_ionice) + cmd
+        self._execute(*cmd, run_as_root=True)
+
+    def _is_thin(self, lv_name):
+        lv = self._lvm.get(FLAGS.volume_group, lv_name)
+        return lv is not None and lv.is_thin
 
     def _volume_not_present(self, volume_name):
-        path_name = '%s/%s' % (FLAGS.volume_group, volume_name)
-        try:
-            self._try_execute('lvdisplay', path_name, run_as_root=True)
-        except Exception as e:
-            # If the volume isn't present
-            return True
-        return False
+        return not self._lvm.exists(FLAGS.volume_group, volume_name)
 
     def _delete_volume(self, volume, size_in_g):
         """Deletes a logical volume."""
         # zero out old volumes to prevent data leaking between users
-        # TODO(ja): reclaiming space should be done lazy and low priority
-        self._copy_volume('/dev/zero', self.local_path(volume), size_in_g)
-        self._try_execute('lvremove', '-f', "%s/%s" %
-                          (FLAGS.volume_group,
-                           self._escape_snapshot(volume['name'])),
-                          run_as_root=True)
+        lv_name = self._escape_snapshot(volume['name'])
+        if FLAGS.background_volume_wipe:
+            wipe_queue = wipe.get_queue(FLAGS.volume_group, self._execute)
+            wipe_queue.delete(lv_name)
+        else:
+            if not (FLAGS.volume_wipe_skip_thin and self._is_thin(lv_name)):
+                self._copy_volume('/dev/zero', self.local_path(volume),
+                                  size_in_g)
+            self._try_execute('lvremove', '-f', "%s/%s" %
+                              (FLAGS.volume_group, lv_name),
+                              run_as_root=True)
+        self._lvm.forget(FLAGS.volume_group, lv_name)
 
     def _sizestr(self, size_in_g):
         if int(size_in_g) == 0:
@@ -139,10 +201,40 @@ class VolumeDriver(object):
         self._create_volume(volume['name'], self._sizestr(volume['size']))
 
     def create_volume_from_snapshot(self, volume, snapshot):
-        """Creates a volume from a snapshot."""
+        """Creates a volume from a snapshot, as a copy-on-write clone of
+        it if the driver can clone it, by copying it otherwise."""
+        if not self.clone_snapshot(volume, snapshot):
+            self._copy_snapshot(volume, snapshot)
+
+    def clone_snapshot(self, volume, snapshot):
+        """Creates volume as a copy-on-write clone of snapshot.
+
+        Returns False, having done nothing, if snapshot can't be cloned.
+        Snapshots of thin volumes are cloned with a thin snapshot.
+        """
+        snapshot_lv = self._escape_snapshot(snapshot['name'])
+        if not self._is_thin(snapshot_lv):
+            return False
+        LOG.debug(_("volume %(volume)s: cloning thin snapshot %(snapshot)s")
+                  % {'volume': volume['name'], 'snapshot': snapshot_lv})
+        self._try_execute('lvcreate', '-s', '-kn', '-n', volume['name'],
+                          '%s/%s' % (FLAGS.volume_group, snapshot_lv),
+                          run_as_root=True)
+        self._lvm.invalidate(FLAGS.volume_group)
+        if int(volume['size']) > int(snapshot['volume_size']):
+            self._try_execute('lvresize', '-f',
+                              '-L', self._sizestr(volume['size']),
+                              '%s/%s' % (FLAGS.volume_group, volume['name']),
+                              run_as_root=True)
+            self._lvm.invalidate(FLAGS.volume_group)
+        return True
+
+    def _copy_snapshot(self, volume, snapshot):
         self._create_volume(volume['name'], self._sizestr(volume['size']))
+        # NOTE: new thin volumes read as zeros, so zeros need no copying
         self._copy_volume(self.local_path(snapshot), self.local_path(volume),
-                          snapshot['volume_size'])
+                          snapshot['volume_size'],
+                          sparse=self._is_thin(volume['name']))
 
     def delete_volume(self, volume):
         """Deletes a logical volume."""
@@ -152,26 +244,26 @@ class VolumeDriver(object):
 
         # TODO(yamahata): lvm can't delete origin volume only without
         # deleting derived snapshots. Can we do something fancy?
-        out, err = self._execute('lvdisplay', '--noheading',
-                                 '-C', '-o', 'Attr',
-                                 '%s/%s' % (FLAGS.volume_group,
-                                            volume['name']),
-                                 run_as_root=True)
-        # fake_execute returns None resulting unit test error
-        if out:
-            out = out.strip()
-            if (out[0] == 'o') or (out[0] == 'O'):
-                raise exception.VolumeIsBusy(volume_name=volume['name'])
+        lv = self._lvm.get(FLAGS.volume_group, volume['name'])
+        if lv is not None and lv.is_origin:
+            raise exception.VolumeIsBusy(volume_name=volume['name'])
 
         self._delete_volume(volume, volume['size'])
 
     def create_snapshot(self, snapshot):
-        """Creates a snapshot."""
+        """Creates a snapshot, a thin one of thin volumes."""
         orig_lv_name = "%s/%s" % (FLAGS.volume_group, snapshot['volume_name'])
-        self._try_execute('lvcreate', '-L',
-                          self._sizestr(snapshot['volume_size']),
-                          '--name', self._escape_snapshot(snapshot['name']),
-                          '--snapshot', orig_lv_name, run_as_root=True)
+        if self._is_thin(snapshot['volume_name']):
+            self._try_execute('lvcreate', '-s', '-kn',
+                              '-n', self._escape_snapshot(snapshot['name']),
+                              orig_lv_name, run_as_root=True)
+        else:
+            self._try_execute('lvcreate', '-L',
+                              self._sizestr(snapshot['volume_size']),
+                              '--name',
+                              self._escape_snapshot(snapshot['name']),
+                              '--snapshot', orig_lv_name, run_as_root=True)
+        self._lvm.invalidate(FLAGS.volume_group)
 
     def delete_snapshot(self, snapshot):
         """Deletes a snapshot."""
@@ -193,6 +285,11 @@ class VolumeDriver(object):
         """Synchronously recreates an export for a logical volume."""
         raise NotImplementedError()
 
+    def ensure_exports(self, context, volumes):
+        """Recreates the exports of volumes when the service starts."""
+        for volume in volumes:
+            self.ensure_export(context, volume)
+
     def create_export(self, context, volume):
         """Exports the volume. Can optionally return a Dictionary of changes
         to the volume object to be persisted."""
@@ -230,6 +327,10 @@ class AOEDriver(VolumeDriver):
         LOG.warn(_("AOEDriver is deprecated and will be removed in Essex"))
         super(AOEDriver, self).__init__(*args, **kwargs)
 
+    def do_setup(self, context):
+        """Resumes wiping the volumes deleted before a restart."""
+        self._resume_volume_wipe()
+
     def ensure_export(self, context, volume):
         # NOTE(vish): we depend on vblade-persist for recreating exports
         pass
@@ -342,6 +443,34 @@ class FakeAOEDriver(AOEDriver):
         return (None, None)
 
 
+def _parse_iscsi_targets(out):
+    """Parses the output of tgtadm --op show --mode target."""
+    targets = {}
+    target = None
+    section = None
+    for line in out.splitlines():
+        stripped = line.strip()
+        if line.startswith('Target '):
+            tid, _sep, name = line[len('Target '):].partition(':')
+            if not tid.isdigit():
+                target = None
+                continue
+            target = {'name': name.strip(), 'luns': set(), 'acls': set()}
+            targets[int(tid)] = target
+            section = None
+        elif target is None or not stripped:
+            continue
+        elif stripped.endswith('information:'):
+            section = stripped
+        elif section == 'LUN information:' and stripped.startswith('LUN:'):
+            lun = stripped[len('LUN:'):].strip()
+            if lun.isdigit():
+                target['luns'].add(int(lun))
+        elif section == 'ACL information:':
+            target['acls'].add(stripped)
+    return targets
+
+
 class ISCSIDriver(VolumeDriver):
     """Executes commands relating to ISCSI volumes.
 
@@ -356,8 +485,39 @@ class ISCSIDriver(VolumeDriver):
                        `CHAP` is the only auth_method in use at the moment.
     """
 
+    def do_setup(self, context):
+        """Resumes wiping the volumes deleted before a restart."""
+        self._resume_volume_wipe()
+
     def ensure_export(self, context, volume):
         """Synchronously recreates an export for a logical volume."""
+        self._ensure_export(context, volume)
+
+    def ensure_exports(self, context, volumes):
+        """Recreates the exports of volumes missing from tgtd.
+
+        The targets tgtd has are listed once, and the volumes whose target
+        is complete are skipped, as they are after a restart of the volume
+        service alone. The others are exported --iscsi_export_concurrency
+        at a time.
+        """
+        targets = self._get_iscsi_targets()
+        pool = greenpool.GreenPool(FLAGS.iscsi_export_concurrency)
+        for volume in volumes:
+            pool.spawn_n(self._ensure_export_safely, context, volume, targets)
+        pool.waitall()
+
+    def _ensure_export_safely(self, context, volume, targets):
+        try:
+            self._ensure_export(context, volume, targets)
+        except Exception:
+            LOG.exception(_("volume %s: unable to recreate export"),
+                          volume['name'])
+
+    def _ensure_export(self, context, volume, targets=None):
+        """Recreates the parts of the export of volume that are not in
+        targets, the targets listed by _get_iscsi_targets, or all of them
+        if targets is None."""
         try:
             iscsi_target = self.db.volume_get_iscsi_target_num(context,
                                                            volume['id'])
@@ -368,24 +528,54 @@ class ISCSIDriver(VolumeDriver):
 
         iscsi_name = "%s%s" % (FLAGS.iscsi_target_prefix, volume['name'])
         volume_path = "/dev/%s/%s" % (FLAGS.volume_group, volume['name'])
-        self._sync_exec('tgtadm', '--op', 'new',
-                        '--lld=iscsi', '--mode=target',
-                        "--tid=%s" % iscsi_target,
-                        "--targetname=%s" % iscsi_name,
-                        run_as_root=True,
-                        check_exit_code=False)
-        self._sync_exec('tgtadm', '--op', 'bind',
-                        '--lld=iscsi', '--mode=target', '--initiator-address=ALL',
-                        "--tid=%s" % iscsi_target,
-                        run_as_root=True,
-                        check_exit_code=False)
-        self._sync_exec('tgtadm', '--op', 'new',
-                        '--lld=iscsi', '--mode=logicalunit',
-                        "--tid=%s" % iscsi_target,
-                        '--lun=1',
-                        "--backing-store=%s,Type=fileio" % volume_path,
-                        run_as_root=True,
-                        check_exit_code=False)
+        target = None
+        if targets is not None:
+            target = targets.get(iscsi_target)
+        if target is not None and target['name'] != iscsi_name:
+            LOG.warn(_("volume %(name)s: target %(iscsi_target)s is "
+                       "%(target_name)s") %
+                     {'name': volume['name'], 'iscsi_target': iscsi_target,
+                      'target_name': target['name']})
+            target = None
+        if target is not None and 1 in target['luns'] and \
+           'ALL' in target['acls']:
+            LOG.debug(_("volume %s: already exported"), volume['name'])
+            return
+
+        if target is None:
+            self._sync_exec('tgtadm', '--op', 'new',
+                            '--lld=iscsi', '--mode=target',
+                            "--tid=%s" % iscsi_target,
+                            "--targetname=%s" % iscsi_name,
+                            run_as_root=True,
+                            check_exit_code=False)
+        if target is None or 'ALL' not in target['acls']:
+            self._sync_exec('tgtadm', '--op', 'bind',
+                            '--lld=iscsi', '--mode=target',
+                            '--initiator-address=ALL',
+                            "--tid=%s" % iscsi_target,
+                            run_as_root=True,
+                            check_exit_code=False)
+        if target is None or 1 not in target['luns']:
+            self._sync_exec('tgtadm', '--op', 'new',
+                            '--lld=iscsi', '--mode=logicalunit',
+                            "--tid=%s" % iscsi_target,
+                            '--lun=1',
+                            "--backing-store=%s,Type=fileio" % volume_path,
+                            run_as_root=True,
+                            check_exit_code=False)
+
+    def _get_iscsi_targets(self):
+        """Returns {tid: {'name': name, 'luns': set, 'acls': set}} of the
+        targets of tgtd, or {} if they can't be listed."""
+        try:
+            out, _err = self._execute('tgtadm', '--op', 'show',
+                                      '--lld=iscsi', '--mode=target',
+                                      run_as_root=True)
+        except exception.ProcessExecutionError, e:
+            LOG.warn(_("Unable to list iSCSI targets: %s"), e)
+            return {}
+        return _parse_iscsi_targets(out or '')
 
     def _ensure_iscsi_targets(self, context, host):
         """Ensure that target ids have been created in datastore."""
@@ -648,20 +838,73 @@ class RBDDriver(VolumeDriver):
             raise exception.Error(_("rbd has no pool %s") %
                                   FLAGS.rbd_pool)
 
+    def _size_mb(self, size_in_g):
+        if int(size_in_g) == 0:
+            return 100
+        return int(size_in_g) * 1024
+
     def create_volume(self, volume):
         """Creates a logical volume."""
-        if int(volume['size']) == 0:
-            size = 100
+        size = self._size_mb(volume['size'])
+        if FLAGS.rbd_image_format != 1:
+            self._try_execute('rbd', '--pool', FLAGS.rbd_pool,
+                              '--image-format', FLAGS.rbd_image_format,
+                              '--size', size, 'create', volume['name'])
         else:
-            size = int(volume['size']) * 1024
-        self._try_execute('rbd', '--pool', FLAGS.rbd_pool,
-                          '--size', size, 'create', volume['name'])
+            self._try_execute('rbd', '--pool', FLAGS.rbd_pool,
+                              '--size', size, 'create', volume['name'])
 
     def delete_volume(self, volume):
         """Deletes a logical volume."""
         self._try_execute('rbd', '--pool', FLAGS.rbd_pool,
                           'rm', volume['name'])
 
+    def _info(self, image, snap=None):
+        """Returns {field: value} of rbd info of image, or of its
+        snapshot snap."""
+        cmd = ['rbd', '--pool', FLAGS.rbd_pool, 'info', image]
+        if snap:
+            cmd[3:3] = ['--snap', snap]
+        out, _err = self._execute(*cmd)
+        info = {}
+        for line in (out or '').splitlines():
+            key, sep, value = line.partition(':')
+            if sep:
+                info[key.strip()] = value.strip()
+        return info
+
+    def _snap_spec(self, snapshot):
+        return '%s/%s@%s' % (FLAGS.rbd_pool, snapshot['volume_name'],
+                             snapshot['name'])
+
+    def clone_snapshot(self, volume, snapshot):
+        """Creates volume as a layered clone of snapshot, if it is a
+        snapshot of a format 2 image."""
+        info = self._info(snapshot['volume_name'], snapshot['name'])
+        if info.get('format') != '2':
+            return False
+        # NOTE: protected snapshots can't be removed while they have
+        #       clones, see delete_snapshot.
+        if info.get('protected') != 'True':
+            self._try_execute('rbd', '--pool', FLAGS.rbd_pool,
+                              'snap', 'protect', '--snap', snapshot['name'],
+                              snapshot['volume_name'])
+        self._try_execute('rbd', 'clone', self._snap_spec(snapshot),
+                          '%s/%s' % (FLAGS.rbd_pool, volume['name']))
+        self._resize(volume, snapshot)
+        return True
+
+    def _copy_snapshot(self, volume, snapshot):
+        self._try_execute('rbd', 'cp', self._snap_spec(snapshot),
+                          '%s/%s' % (FLAGS.rbd_pool, volume['name']))
+        self._resize(volume, snapshot)
+
+    def _resize(self, volume, snapshot):
+        if int(volume['size']) > int(snapshot['volume_size']):
+            self._try_execute('rbd', '--pool', FLAGS.rbd_pool,
+                              '--size', self._size_mb(volume['size']),
+                              'resize', volume['name'])
+
     def create_snapshot(self, snapshot):
         """Creates an rbd snapshot"""
         self._try_execute('rbd', '--pool', FLAGS.rbd_pool,
@@ -669,7 +912,20 @@ class RBDDriver(VolumeDriver):
                           snapshot['volume_name'])
 
     def delete_snapshot(self, snapshot):
-        """Deletes an rbd snapshot"""
+        """Deletes an rbd snapshot, copying the data its clones share
+        with it into them first."""
+        info = self._info(snapshot['volume_name'], snapshot['name'])
+        if info.get('protected') == 'True':
+            out, _err = self._execute('rbd', 'children',
+                                      self._snap_spec(snapshot))
+            for child in (out or '').split():
+                LOG.info(_("snapshot %(snapshot)s: flattening clone "
+                           "%(child)s") %
+                         {'snapshot': snapshot['name'], 'child': child})
+                self._try_execute('rbd', 'flatten', child)
+            self._try_execute('rbd', '--pool', FLAGS.rbd_pool,
+                              'snap', 'unprotect', '--snap', snapshot['name'],
+                              snapshot['volume_name'])
         self._try_execute('rbd', '--pool', FLAGS.rbd_pool,
                           'snap', 'rm', '--snap', snapshot['name'],
                           snapshot['volume_name'])
@@ -722,12 +978,15 @@ class SheepdogDriver(VolumeDriver):
                           "sheepdog:%s" % volume['name'],
                           self._sizestr(volume['size']))
 
-    def create_volume_from_snapshot(self, volume, snapshot):
-        """Creates a sheepdog volume from a snapshot."""
-        self._try_execute('qemu-img', 'create', '-b',
-                          "sheepdog:%s:%s" % (snapshot['volume_name'],
-                                              snapshot['name']),
-                          "sheepdog:%s" % volume['name'])
+    def clone_snapshot(self, volume, snapshot):
+        """Creates a sheepdog volume backed by a snapshot."""
+        cmd = ['qemu-img', 'create', '-b',
+               "sheepdog:%s:%s" % (snapshot['volume_name'], snapshot['name']),
+               "sheepdog:%s" % volume['name']]
+        if int(volume['size']) > int(snapshot['volume_size']):
+            cmd.append(self._sizestr(volume['size']))
+        self._try_execute(*cmd)
+        return True
 
     def delete_volume(self, volume):
         """Deletes a logical volume"""
@@ -937,6 +1196,12 @@ class ZadaraBEDriver(ISCSIDriver):
 
         raise exception.Error(_("local_path not supported"))
 
+    def ensure_exports(self, context, volumes):
+        """ensure BE exports for volumes, one at a time"""
+        # NOTE: VSA volumes and drives are exported their own way
+        for volume in volumes:
+            self.ensure_export(context, volume)
+
     def ensure_export(self, context, volume):
         """ensure BE export for a volume"""
         if self._not_vsa_volume_or_drive(volume):
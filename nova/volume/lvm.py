@@ -0,0 +1,155 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Inventory of the logical volumes of LVM volume groups.
+
+Checking volumes one at a time with lvdisplay forks a root process per
+volume, which adds up when a service starts or deletes volumes in bulk.
+The inventory loads every logical volume of a volume group with a single
+lvs report and answers from it until the report is older than
+--lvm_inventory_max_age seconds, or until the caller changes the volume
+group and invalidates it.
+
+"""
+
+import time
+
+from nova import exception
+from nova import flags
+from nova import log as logging
+from nova import utils
+
+
+LOG = logging.getLogger('nova.volume.lvm')
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('lvm_inventory_max_age', 60,
+                     'seconds the logical volumes listed by lvs are trusted '
+                     'before they are listed again')
+
+_FIELDS = ('lv_name', 'lv_attr', 'lv_size', 'segtype', 'origin')
+_SEPARATOR = '|'
+
+_inventory = None
+
+
+def get_inventory():
+    """Returns the inventory shared by the users of utils.execute."""
+    global _inventory
+    if _inventory is None:
+        _inventory = LvmInventory()
+    return _inventory
+
+
+class LogicalVolume(object):
+    """One line of the lvs report of a volume group."""
+
+    def __init__(self, name, attr, size, segtype, origin=None):
+        self.name = name
+        self.attr = attr
+        self.size = size
+        self.segtype = segtype
+        self.origin = origin or None
+
+    @property
+    def is_origin(self):
+        """Does the volume have snapshots?"""
+        return self.attr[:1] in ('o', 'O')
+
+    @property
+    def is_open(self):
+        """Is the device of the volume open?"""
+        return self.attr[5:6] == 'o'
+
+    @property
+    def is_thin(self):
+        return self.segtype == 'thin'
+
+
+class LvmInventory(object):
+    """Logical volumes of the volume groups on this host."""
+
+    def __init__(self, execute=None):
+        # NOTE: utils.execute is looked up on every call when no execute
+        #       is given, so it can be replaced after the inventory is made.
+        self._execute = execute
+        self._volume_groups = {}
+
+    def volumes(self, volume_group):
+        """Returns {name: LogicalVolume} of all volumes of volume_group."""
+        volumes, loaded_at = self._volume_groups.get(volume_group,
+                                                     (None, None))
+        if volumes is None or \
+           time.time() - loaded_at >= FLAGS.lvm_inventory_max_age:
+            volumes = self.refresh(volume_group)
+        return volumes
+
+    def get(self, volume_group, lv_name):
+        """Returns the LogicalVolume lv_name, None if there is none.
+
+        A volume missing from a report loaded earlier is looked up again,
+        as it may have been created since.
+
+        """
+        cached = self._volume_groups.get(volume_group, (None, None))[0]
+        volumes = self.volumes(volume_group)
+        volume = volumes.get(lv_name)
+        if volume is None and volumes is cached:
+            volume = self.refresh(volume_group).get(lv_name)
+        return volume
+
+    def exists(self, volume_group, lv_name):
+        return self.get(volume_group, lv_name) is not None
+
+    def size(self, volume_group, lv_name):
+        """Returns the size in bytes of volume lv_name."""
+        volume = self.get(volume_group, lv_name)
+        if volume is None:
+            raise exception.Error(_('volume %(lv_name)s not found in volume '
+                                    'group %(volume_group)s') % locals())
+        return volume.size
+
+    def refresh(self, volume_group):
+        """Lists the volumes of volume_group again."""
+        execute = self._execute or utils.execute
+        out, _err = execute('lvs', '--noheadings', '--nosuffix',
+                            '--units', 'b', '--separator', _SEPARATOR,
+                            '-o', ','.join(_FIELDS), volume_group,
+                            run_as_root=True)
+        volumes = {}
+        for line in (out or '').splitlines():
+            fields = [field.strip() for field in line.split(_SEPARATOR)]
+            if len(fields) != len(_FIELDS) or not fields[2].isdigit():
+                if line.strip():
+                    LOG.warn(_('Unable to parse lvs output: %r'), line)
+                continue
+            name, attr, size, segtype, origin = fields
+            volumes[name] = LogicalVolume(name, attr, int(size), segtype,
+                                          origin)
+        self._volume_groups[volume_group] = (volumes, time.time())
+        return volumes
+
+    def invalidate(self, volume_group):
+        """Lists the volumes of volume_group again when next asked."""
+        self._volume_groups.pop(volume_group, None)
+
+    def forget(self, volume_group, lv_name):
+        """Drops volume lv_name, which was removed or renamed."""
+        volumes, _loaded_at = self._volume_groups.get(volume_group,
+                                                      (None, None))
+        if volumes is not None:
+            volumes.pop(lv_name, None)
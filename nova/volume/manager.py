@@ -83,15 +83,18 @@ class VolumeManager(manager.SchedulerDependentManager):
     def init_host(self):
         """Do any initialization that needs to be run if this is a
            standalone service."""
-        self.driver.check_for_setup_error()
         ctxt = context.get_admin_context()
+        self.driver.do_setup(ctxt)
+        self.driver.check_for_setup_error()
         volumes = self.db.volume_get_all_by_host(ctxt, self.host)
         LOG.debug(_("Re-exporting %s volumes"), len(volumes))
+        exports = []
         for volume in volumes:
             if volume['status'] in ['available', 'in-use']:
-                self.driver.ensure_export(ctxt, volume)
+                exports.append(volume)
             else:
                 LOG.info(_("volume %s: skipping export"), volume['name'])
+        self.driver.ensure_exports(ctxt, exports)
 
     def create_volume(self, context, volume_id, snapshot_id=None):
         """Creates and exports the volume."""
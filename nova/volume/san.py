@@ -23,13 +23,16 @@ controller on the SAN hardware.  We expect to access it over SSH or some API.
 
 import os
 import paramiko
+import socket
+import time
 
 from xml.etree import ElementTree
 
+from eventlet import semaphore
+
 from nova import exception
 from nova import flags
 from nova import log as logging
-from nova.utils import ssh_execute
 from nova.volume.driver import ISCSIDriver
 
 LOG = logging.getLogger("nova.volume.driver")
@@ -48,6 +51,134 @@ flags.DEFINE_string('san_clustername', '',
                     'Cluster name to use for creating volumes')
 flags.DEFINE_integer('san_ssh_port', 22,
                     'SSH port to use with SAN')
+flags.DEFINE_integer('san_ssh_pool_size', 4,
+                     'Maximum number of SSH connections open to the SAN')
+flags.DEFINE_integer('san_ssh_idle_timeout', 300,
+                     'Seconds an unused SSH connection to the SAN is kept')
+flags.DEFINE_integer('san_ssh_retries', 2,
+                     'Times a command is retried on a new SSH connection '
+                     'when the one it was given turns out to be broken')
+
+# NOTE: errors of connections that are broken, rather than of commands
+_SSH_CONNECTION_ERRORS = (paramiko.SSHException, socket.error, EOFError)
+
+
+def _start_ssh_command(ssh, command):
+    """Starts command on a new channel of ssh, returns the channel."""
+    LOG.debug(_('Running cmd (SSH): %s'), command)
+    transport = ssh.get_transport()
+    if transport is None:
+        raise paramiko.SSHException(_('SSH connection closed'))
+    channel = transport.open_session()
+    channel.exec_command(command)
+    return channel
+
+
+def _finish_ssh_command(channel, command, check_exit_code):
+    """Returns (stdout, stderr) of the command started on channel."""
+    stdout = channel.makefile('rb').read()
+    stderr = channel.makefile_stderr('rb').read()
+    exit_status = channel.recv_exit_status()
+
+    # exit_status == -1 if no exit code was returned
+    if exit_status != -1:
+        LOG.debug(_('Result was %s') % exit_status)
+        if check_exit_code and exit_status != 0:
+            raise exception.ProcessExecutionError(exit_code=exit_status,
+                                                  stdout=stdout,
+                                                  stderr=stderr,
+                                                  cmd=command)
+    return (stdout, stderr)
+
+
+class SSHPool(object):
+    """SSH connections to the SAN, kept open for the commands to come.
+
+    At most max_size connections are in use at a time. Connections are
+    checked before they are reused, and closed once unused for
+    --san_ssh_idle_timeout seconds.
+    """
+
+    def __init__(self, connect, max_size):
+        self._connect = connect
+        self._semaphore = semaphore.Semaphore(max_size)
+        self._idle = []
+
+    def execute(self, commands, check_exit_code=True):
+        """Runs commands on one connection, returns [(stdout, stderr)].
+
+        All the commands are started before the output of the first one
+        is read, so they must not depend on each other. check_exit_code
+        is either for all of them or a list of one per command. A
+        connection that turns out to be broken before the first command
+        started is replaced, up to --san_ssh_retries times.
+        """
+        if not isinstance(check_exit_code, list):
+            check_exit_code = [check_exit_code] * len(commands)
+        with self._semaphore:
+            ssh = self._get()
+            channels = []
+            try:
+                ssh, channel = self._start_first(ssh, commands[0])
+                channels.append(channel)
+                for command in commands[1:]:
+                    channels.append(_start_ssh_command(ssh, command))
+                results = [_finish_ssh_command(channel, command, check)
+                           for channel, command, check in
+                           zip(channels, commands, check_exit_code)]
+            except _SSH_CONNECTION_ERRORS:
+                ssh.close()
+                raise
+            except Exception:
+                self._put(ssh)
+                raise
+            finally:
+                for channel in channels:
+                    channel.close()
+            self._put(ssh)
+            return results
+
+    def _start_first(self, ssh, command):
+        tries = 0
+        while True:
+            try:
+                return ssh, _start_ssh_command(ssh, command)
+            except _SSH_CONNECTION_ERRORS, e:
+                ssh.close()
+                tries += 1
+                if tries > FLAGS.san_ssh_retries:
+                    raise
+                LOG.warn(_('SSH connection to the SAN is broken, '
+                           'reconnecting: %s'), e)
+                ssh = self._connect()
+
+    def _get(self):
+        """Returns the most recently used live connection, or a new one."""
+        deadline = time.time() - FLAGS.san_ssh_idle_timeout
+        while self._idle:
+            last_used, ssh = self._idle.pop()
+            if last_used > deadline and self._is_alive(ssh):
+                self._close_expired(deadline)
+                return ssh
+            ssh.close()
+        return self._connect()
+
+    def _put(self, ssh):
+        self._idle.append((time.time(), ssh))
+
+    def _close_expired(self, deadline):
+        while self._idle and self._idle[0][0] <= deadline:
+            self._idle.pop(0)[1].close()
+
+    @staticmethod
+    def _is_alive(ssh):
+        transport = ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def close(self):
+        """Closes the unused connections."""
+        while self._idle:
+            self._idle.pop()[1].close()
 
 
 class SanISCSIDriver(ISCSIDriver):
@@ -58,12 +189,22 @@ class SanISCSIDriver(ISCSIDriver):
     remote protocol.
     """
 
+    def __init__(self, *args, **kwargs):
+        super(SanISCSIDriver, self).__init__(*args, **kwargs)
+        self._ssh_pool = SSHPool(self._connect_to_ssh,
+                                 FLAGS.san_ssh_pool_size)
+
     def _build_iscsi_target_name(self, volume):
         return "%s%s" % (FLAGS.iscsi_target_prefix, volume['name'])
 
     # discover_volume is still OK
     # undiscover_volume is still OK
 
+    def do_setup(self, context):
+        """The volumes are on the SAN, there is no local volume group
+        to wipe."""
+        pass
+
     def _connect_to_ssh(self):
         ssh = paramiko.SSHClient()
         #TODO(justinsb): We need a better SSH key policy
@@ -86,20 +227,23 @@ class SanISCSIDriver(ISCSIDriver):
         return ssh
 
     def _run_ssh(self, command, check_exit_code=True):
-        #TODO(justinsb): SSH connection caching (?)
-        ssh = self._connect_to_ssh()
-
-        #TODO(justinsb): Reintroduce the retry hack
-        ret = ssh_execute(ssh, command, check_exit_code=check_exit_code)
+        return self._run_ssh_commands([command], check_exit_code)[0]
 
-        ssh.close()
-
-        return ret
+    def _run_ssh_commands(self, commands, check_exit_code=True):
+        """Runs independent commands at once on one SSH connection,
+        returns [(stdout, stderr)] of each."""
+        return self._ssh_pool.execute(commands, check_exit_code)
 
     def ensure_export(self, context, volume):
         """Synchronously recreates an export for a logical volume."""
         pass
 
+    def ensure_exports(self, context, volumes):
+        """Recreates the exports of volumes on the SAN, one at a time."""
+        # NOTE: the targets are on the SAN, not in the tgtd of this host
+        for volume in volumes:
+            self.ensure_export(context, volume)
+
     def create_export(self, context, volume):
         """Exports the volume."""
         pass
@@ -140,6 +284,40 @@ def _get_prefixed_values(data, prefix):
     return matches
 
 
+_LIST_TARGET_GROUPS_CMD = "pfexec /usr/sbin/stmfadm list-tg"
+_LIST_TARGETS_CMD = ("pfexec /usr/sbin/itadm list-target | "
+                     "awk '{print $1}' | grep -v ^TARGET")
+
+
+def _list_view_cmd(luid):
+    return "pfexec /usr/sbin/stmfadm list-view -l %s" % (luid)
+
+
+def _parse_view_exists(out):
+    """Returns if the output of list-view shows a view"""
+    if "no views found" in out:
+        return False
+
+    if "View Entry:" in out:
+        return True
+
+    raise exception.Error("Cannot parse list-view output: %s" % (out))
+
+
+def _parse_target_groups(out):
+    """Returns the target groups listed by list-tg"""
+    matches = _get_prefixed_values(out, 'Target group: ')
+    LOG.debug("target_groups=%s" % matches)
+    return matches
+
+
+def _parse_iscsi_targets(out):
+    """Returns the targets listed by list-target"""
+    matches = _collect_lines(out)
+    LOG.debug("_get_iscsi_targets=%s" % (matches))
+    return matches
+
+
 class SolarisISCSIDriver(SanISCSIDriver):
     """Executes commands relating to Solaris-hosted ISCSI volumes.
 
@@ -169,23 +347,14 @@ class SolarisISCSIDriver(SanISCSIDriver):
     """
 
     def _view_exists(self, luid):
-        cmd = "pfexec /usr/sbin/stmfadm list-view -l %s" % (luid)
-        (out, _err) = self._run_ssh(cmd,
+        (out, _err) = self._run_ssh(_list_view_cmd(luid),
                                     check_exit_code=False)
-        if "no views found" in out:
-            return False
-
-        if "View Entry:" in out:
-            return True
-
-        raise exception.Error("Cannot parse list-view output: %s" % (out))
+        return _parse_view_exists(out)
 
     def _get_target_groups(self):
         """Gets list of target groups from host."""
-        (out, _err) = self._run_ssh("pfexec /usr/sbin/stmfadm list-tg")
-        matches = _get_prefixed_values(out, 'Target group: ')
-        LOG.debug("target_groups=%s" % matches)
-        return matches
+        (out, _err) = self._run_ssh(_LIST_TARGET_GROUPS_CMD)
+        return _parse_target_groups(out)
 
     def _target_group_exists(self, target_group_name):
         return target_group_name not in self._get_target_groups()
@@ -202,12 +371,8 @@ class SolarisISCSIDriver(SanISCSIDriver):
             self._get_target_group_members(target_group_name))
 
     def _get_iscsi_targets(self):
-        cmd = ("pfexec /usr/sbin/itadm list-target | "
-               "awk '{print $1}' | grep -v ^TARGET")
-        (out, _err) = self._run_ssh(cmd)
-        matches = _collect_lines(out)
-        LOG.debug("_get_iscsi_targets=%s" % (matches))
-        return matches
+        (out, _err) = self._run_ssh(_LIST_TARGETS_CMD)
+        return _parse_iscsi_targets(out)
 
     def _iscsi_target_exists(self, iscsi_target_name):
         return iscsi_target_name in self._get_iscsi_targets()
@@ -322,11 +487,19 @@ class SolarisISCSIDriver(SanISCSIDriver):
         iscsi_name = self._build_iscsi_target_name(volume)
         target_group_name = 'tg-%s' % volume['name']
 
-        if self._view_exists(luid):
+        # NOTE: the checks don't depend on each other, so they are run
+        #       together on one SSH connection
+        ((view_out, _err), (targets_out, _err), (groups_out, _err)) = \
+                self._run_ssh_commands([_list_view_cmd(luid),
+                                        _LIST_TARGETS_CMD,
+                                        _LIST_TARGET_GROUPS_CMD],
+                                       check_exit_code=[False, True, True])
+
+        if _parse_view_exists(view_out):
             self._run_ssh("pfexec /usr/sbin/stmfadm remove-view -l %s -a" %
                           (luid))
 
-        if self._iscsi_target_exists(iscsi_name):
+        if iscsi_name in _parse_iscsi_targets(targets_out):
             self._run_ssh("pfexec /usr/sbin/stmfadm offline-target %s" %
                           (iscsi_name))
             self._run_ssh("pfexec /usr/sbin/itadm delete-target %s" %
@@ -334,11 +507,12 @@ class SolarisISCSIDriver(SanISCSIDriver):
 
         # We don't delete the tg-member; we delete the whole tg!
 
-        if self._target_group_exists(target_group_name):
+        # NOTE: the same test as _target_group_exists
+        if target_group_name not in _parse_target_groups(groups_out):
             self._run_ssh("pfexec /usr/sbin/stmfadm delete-tg %s" %
                           (target_group_name))
 
-        if self._is_lu_created(volume):
+        if luid:
             self._run_ssh("pfexec /usr/sbin/sbdadm delete-lu %s" %
                           (luid))
 
@@ -0,0 +1,226 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Background wiping and removal of deleted logical volumes.
+
+Zeroing a deleted volume keeps the data of one tenant from leaking to the
+next, but doing it inline blocks the caller for as long as it takes to
+write the whole volume. With --background_volume_wipe, a deleted volume is
+renamed (parked) under a unique name and queued instead, so its name can be
+reused before the wipe is done. A greenthread wipes the parked volumes
+one at a time, at most --volume_wipe_rate MB/s, and removes them.
+
+The queue and the progress of every wipe are kept in
+--volume_wipe_state_path, so wiping resumes where it stopped after a
+restart.
+
+"""
+
+import json
+import os
+import time
+
+import eventlet
+from eventlet import greenthread
+from eventlet import queue
+
+from nova import exception
+from nova import flags
+from nova import log as logging
+from nova import utils
+from nova.volume import lvm
+
+
+LOG = logging.getLogger('nova.volume.wipe')
+
+FLAGS = flags.FLAGS
+flags.DEFINE_bool('background_volume_wipe', False,
+                  'wipe and remove deleted logical volumes in the '
+                  'background instead of before returning')
+flags.DEFINE_string('volume_wipe_state_path', '$state_path/volume_wipe',
+                    'where the queue of volumes to wipe is kept')
+flags.DEFINE_integer('volume_wipe_rate', 100,
+                     'MB per second written when wiping a volume, '
+                     '0 for no limit')
+flags.DEFINE_integer('volume_wipe_step', 64,
+                     'MB written by each dd while wiping a volume')
+flags.DEFINE_bool('volume_wipe_skip_thin', True,
+                  'remove thin volumes without wiping them, as the pool '
+                  'zeroes blocks before they are provisioned again')
+
+PARK_PREFIX = 'wipe-'
+RETRY_INTERVAL = 60
+
+MB = 1024 * 1024
+
+_queues = {}
+
+
+def _unparked_name(parked):
+    """Returns the name a parked volume had before it was deleted."""
+    name = parked[len(PARK_PREFIX):]
+    head, sep, suffix = name.rpartition('-')
+    if sep and len(suffix) == 32:
+        return head
+    return name
+
+
+def get_queue(volume_group, execute=utils.execute):
+    """Returns the started wipe queue of volume_group."""
+    wipe_queue = _queues.get(volume_group)
+    if wipe_queue is None:
+        wipe_queue = WipeQueue(volume_group, execute)
+        wipe_queue.start()
+        _queues[volume_group] = wipe_queue
+    return wipe_queue
+
+
+class WipeQueue(object):
+    """Parked volumes of one volume group, waiting to be wiped."""
+
+    def __init__(self, volume_group, execute=utils.execute):
+        self.volume_group = volume_group
+        self.state_dir = os.path.join(FLAGS.volume_wipe_state_path,
+                                      volume_group)
+        self._execute = execute
+        self._lvm = lvm.LvmInventory(execute)
+        self._queue = queue.Queue()
+        self._worker = None
+
+    def start(self):
+        """Start wiping, beginning with the volumes parked before."""
+        if self._worker is not None:
+            return
+        if not os.path.exists(self.state_dir):
+            os.makedirs(self.state_dir)
+
+        # NOTE: a restart may have come between parking a volume and
+        #       saving its entry, or between removing it and dropping it.
+        parked = self._parked_volumes()
+        for name in os.listdir(self.state_dir):
+            if (name.endswith('.json') and
+                name[:-len('.json')] not in parked):
+                os.unlink(os.path.join(self.state_dir, name))
+        for lv_name in parked:
+            if not os.path.exists(self._entry_path(lv_name)):
+                size, thin = self._volume_info(lv_name)
+                self._save(lv_name, self._new_entry(_unparked_name(lv_name),
+                                                    size, thin))
+            self._queue.put(lv_name)
+        if parked:
+            LOG.info(_('Resuming wipe of %(count)d volumes of %(vg)s') %
+                     {'count': len(parked), 'vg': self.volume_group})
+        self._worker = eventlet.spawn(self._run)
+
+    def delete(self, lv_name):
+        """Park volume lv_name and queue it to be wiped and removed."""
+        size, thin = self._volume_info(lv_name)
+        parked = '%s%s-%s' % (PARK_PREFIX, lv_name, utils.gen_uuid().hex)
+        self._execute('lvrename', self.volume_group, lv_name, parked,
+                      run_as_root=True)
+        self._lvm.invalidate(self.volume_group)
+        self._save(parked, self._new_entry(lv_name, size, thin))
+        self._queue.put(parked)
+        LOG.info(_('volume %(lv_name)s: parked as %(parked)s to be wiped') %
+                 locals())
+
+    def progress(self):
+        """Returns {parked volume: (bytes wiped, size)} of the queue."""
+        progress = {}
+        for name in os.listdir(self.state_dir):
+            if name.endswith('.json'):
+                entry = self._load(name[:-len('.json')])
+                progress[name[:-len('.json')]] = (entry['offset'],
+                                                  entry['size'])
+        return progress
+
+    def _new_entry(self, lv_name, size, thin):
+        return {'lv_name': lv_name,
+                'size': size,
+                'offset': 0,
+                'wipe': not (thin and FLAGS.volume_wipe_skip_thin)}
+
+    def _entry_path(self, lv_name):
+        return os.path.join(self.state_dir, '%s.json' % lv_name)
+
+    def _load(self, lv_name):
+        with open(self._entry_path(lv_name)) as entry_file:
+            return json.load(entry_file)
+
+    def _save(self, lv_name, entry):
+        path = self._entry_path(lv_name)
+        with open(path + '.tmp', 'w') as entry_file:
+            json.dump(entry, entry_file)
+        os.rename(path + '.tmp', path)
+
+    def _parked_volumes(self):
+        return sorted(lv_name for lv_name in
+                      self._lvm.refresh(self.volume_group)
+                      if lv_name.startswith(PARK_PREFIX))
+
+    def _volume_info(self, lv_name):
+        """Returns the size in bytes of a volume and if it is thin."""
+        volume = self._lvm.get(self.volume_group, lv_name)
+        if volume is None:
+            raise exception.Error(_('Unable to get the size of volume '
+                                    '%s') % lv_name)
+        return volume.size, volume.is_thin
+
+    def _run(self):
+        while True:
+            lv_name = self._queue.get()
+            try:
+                self._wipe(lv_name)
+            except Exception:
+                LOG.exception(_('Error wiping volume %s, retrying later'),
+                              lv_name)
+                greenthread.spawn_after(RETRY_INTERVAL, self._queue.put,
+                                        lv_name)
+
+    def _wipe(self, lv_name):
+        entry = self._load(lv_name)
+        path = os.path.join('/dev', self.volume_group, lv_name)
+        size_mb = entry['size'] / MB
+        while entry['wipe'] and entry['offset'] < size_mb * MB:
+            started = time.time()
+            offset_mb = entry['offset'] / MB
+            count = min(FLAGS.volume_wipe_step, size_mb - offset_mb)
+            self._execute('dd', 'if=/dev/zero', 'of=%s' % path, 'bs=1M',
+                          'seek=%d' % offset_mb, 'count=%d' % count,
+                          'oflag=direct', 'conv=notrunc', run_as_root=True)
+            entry['offset'] += count * MB
+            self._save(lv_name, entry)
+            LOG.debug(_('volume %(lv_name)s: wiped %(offset)d of %(size)d '
+                        'bytes') % dict(entry, lv_name=lv_name))
+            self._throttle(count * MB, time.time() - started)
+
+        self._execute('lvremove', '-f',
+                      '%s/%s' % (self.volume_group, lv_name),
+                      run_as_root=True)
+        self._lvm.forget(self.volume_group, lv_name)
+        os.unlink(self._entry_path(lv_name))
+        LOG.info(_('volume %(name)s: wiped and removed %(lv_name)s') %
+                 {'name': entry.get('lv_name'), 'lv_name': lv_name})
+
+    def _throttle(self, written, elapsed):
+        if not FLAGS.volume_wipe_rate:
+            return
+        delay = float(written) / (FLAGS.volume_wipe_rate * MB) - elapsed
+        if delay > 0:
+            greenthread.sleep(delay)
+        else:
+            greenthread.sleep(0)
@@ -36,6 +36,7 @@ from paste import deploy
 from nova import exception
 from nova import flags
 from nova import log as logging
+from nova import trace
 from nova import utils
 
 
@@ -81,6 +82,21 @@ class Server(object):
                              custom_pool=self._pool,
                              log=self._wsgi_logger)
 
+    def listen(self, backlog=128):
+        """Open the listening socket, unless it is already open.
+
+        Worker processes forked after this call all accept connections on
+        the same socket.
+
+        :param backlog: Maximum number of queued connections.
+        :returns: None
+
+        """
+        if self._socket is None:
+            self._socket = eventlet.listen((self.host, self.port),
+                                           backlog=backlog)
+            (self.host, self.port) = self._socket.getsockname()
+
     def start(self, backlog=128):
         """Start serving a WSGI application.
 
@@ -88,9 +104,8 @@ class Server(object):
         :returns: None
 
         """
-        self._socket = eventlet.listen((self.host, self.port), backlog=backlog)
+        self.listen(backlog)
         self._server = eventlet.spawn(self._start)
-        (self.host, self.port) = self._socket.getsockname()
         LOG.info(_("Started %(name)s on %(host)s:%(port)s") % self.__dict__)
 
     def stop(self):
@@ -108,6 +123,20 @@ class Server(object):
             LOG.info(_("Stopping raw TCP server."))
             self._tcp_server.kill()
 
+    def drain(self, timeout):
+        """Wait for requests in progress to finish after stop().
+
+        :param timeout: Maximum number of seconds to wait.
+        :returns: None
+
+        """
+        with eventlet.Timeout(timeout, False):
+            self._pool.waitall()
+        if self._pool.running():
+            LOG.warn(_("%(count)d requests still in progress after "
+                       "%(timeout)d seconds") %
+                     {'count': self._pool.running(), 'timeout': timeout})
+
     def start_tcp(self, listener, port, host='0.0.0.0', key=None, backlog=128):
         """Run a raw TCP server with the given application."""
         arg0 = sys.argv[0]
@@ -169,7 +198,7 @@ class Application(object):
         but using the kwarg passing it shouldn't be necessary.
 
         """
-        return cls(**local_config)
+        return trace.wrap_application(cls.__name__, cls(**local_config))
 
     def __call__(self, environ, start_response):
         r"""Subclasses will probably want to implement __call__ like this:
@@ -242,7 +271,8 @@ class Middleware(Application):
 
         """
         def _factory(app):
-            return cls(app, **local_config)
+            return trace.wrap_application(cls.__name__,
+                                          cls(app, **local_config))
         return _factory
 
     def __init__(self, application):